@@ -1,11 +1,21 @@
 import streamlit as st
+import html
+import io
 import os
-import json
 import time
 from datetime import datetime
+import numpy as np
+import pandas as pd
 from dotenv import load_dotenv
 from llm.claude_coder import ClaudeCoder
+from llm.classifier import DEFAULT_CLASSIFIER_PATH, ClassifierRouter, CodeClassifier
+from llm.rate_limit import RateLimiter
 from utils.parser import clean_response, split_compound_response
+from utils.jobs import DEFAULT_JOBS_DIR, DEFAULT_JOBS_PATH, JobQueue, start_workers
+from utils.recode import plan_recode, run_recode
+from utils.codeframe import DEFAULT_CODEFRAME_PATH, load_codeframe
+from utils.results_store import DEFAULT_RESULTS_DIR, ResultsStore
+from utils.tracing import collect, span
 
 # Load environment variables
 load_dotenv()
@@ -15,8 +25,6 @@ if 'current_question' not in st.session_state:
     st.session_state.current_question = ""
 if 'analysis_results' not in st.session_state:
     st.session_state.analysis_results = None
-if 'last_request_time' not in st.session_state:
-    st.session_state.last_request_time = 0
 if 'request_count' not in st.session_state:
     st.session_state.request_count = 0
 if 'total_cost' not in st.session_state:
@@ -24,18 +32,239 @@ if 'total_cost' not in st.session_state:
 if 'last_cost' not in st.session_state:
     st.session_state.last_cost = 0.0
 
-# Constants for rate limiting and cost tracking
-RATE_LIMIT_SECONDS = 5  # Minimum time between requests
-COST_PER_1K_TOKENS = 0.015  # Claude 3 Opus input cost per 1K tokens
-ESTIMATED_OUTPUT_TOKENS = 200  # Estimated output tokens per response
+# Constants for batch processing
+BATCH_OUTPUT_DIR = "outputs"  # Where batch results are written
+CODEFRAME_PATH = os.getenv("CODEFRAME_PATH", DEFAULT_CODEFRAME_PATH)
+STYLES_PATH = "static/styles.css"
+# Job workers run in this process; set JOB_WORKERS=0 when running worker.py instead
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 1))
+JOBS_SHOWN = 10
+# Most frequent codes shown in the analytics breakdowns
+ANALYTICS_TOP_CODES = 20
 
-# Estimate token count and cost
-def estimate_cost(text):
-    # Rough estimation: 1 token ≈ 4 characters
-    input_tokens = len(text) / 4
-    total_tokens = input_tokens + ESTIMATED_OUTPUT_TOKENS
-    cost = (total_tokens / 1000) * COST_PER_1K_TOKENS
-    return round(cost, 4)  # Round to 4 decimal places
+# Streamlit re-runs this script on every interaction, so the heavy objects
+# below are built once per process and shared by all sessions
+
+# Stylesheet markup, read once per process and again only when the file changes
+@st.cache_resource
+def load_styles(path, modified):
+    with open(path) as f:
+        return f"<style>{f.read()}</style>"
+
+# Sidebar markup per code and display title per category, built once per codeframe version
+@st.cache_resource
+def code_reference_index(_codeframe, content_hash):
+    titles = {category: category.replace("_", " ").title() for category in _codeframe.categories}
+    snippets = {
+        code: f'<div class="code-reference"><strong>{html.escape(code)}</strong>: '
+        f'{html.escape(_codeframe.description(code))}</div>'
+        for code in _codeframe.codes
+    }
+    return titles, snippets
+
+# Coder, HTTP client pool and rate limiter, shared while the settings and codeframe are unchanged
+@st.cache_resource
+def get_coder(
+    api_key,
+    model_name,
+    max_tokens,
+    temperature,
+    shortlist_k,
+    cascade_model,
+    escalation_threshold,
+    rate_limit_rpm,
+    rate_limit_tpm,
+    _codeframe,
+    codeframe_hash
+):
+    return ClaudeCoder(
+        api_key=api_key,
+        model_name=model_name,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        shortlist_k=shortlist_k,
+        codeframe=_codeframe,
+        cascade_model=cascade_model,
+        escalation_threshold=escalation_threshold,
+        rate_limiter=RateLimiter(
+            requests_per_minute=rate_limit_rpm,
+            tokens_per_minute=rate_limit_tpm
+        )
+    )
+
+# Local classifier in front of the coder for batch jobs, kept while the coder is unchanged
+@st.cache_resource
+def get_classifier_router(_coder, coder_id, classifier_path, threshold, audit_rate):
+    classifier = CodeClassifier.load(classifier_path, _coder.codeframe)
+    return ClassifierRouter(classifier, _coder, threshold=threshold, audit_rate=audit_rate, path=classifier_path)
+
+# Durable batch job queue, shared by all sessions and worker processes
+@st.cache_resource
+def get_job_queue(path, jobs_dir):
+    return JobQueue(path, jobs_dir)
+
+# Columnar store of coded results, shared by all sessions and job workers
+@st.cache_resource
+def get_results_store(directory, _codeframe, codeframe_hash):
+    return ResultsStore(_codeframe, directory)
+
+# Stored runs loaded as arrays and aggregated, until a run is added or replaced
+@st.cache_resource(max_entries=4)
+def code_analytics(_store, signature, codeframe_hash):
+    results = _store.load([name for name, _ in signature])
+    started = time.perf_counter()
+    frequencies = results.code_frequencies()
+    top_codes = np.argsort(-frequencies, kind="stable")[:ANALYTICS_TOP_CODES]
+    top_codes = top_codes[frequencies[top_codes] > 0]
+    analytics = {
+        "frequencies": frequencies,
+        "mean_confidence": results.mean_confidence(),
+        "breakdown": results.question_breakdown(),
+        "responses_per_question": results.responses_per_question(),
+        "coded_responses": int((np.diff(results.indptr) > 0).sum()),
+        "top_codes": top_codes,
+        "co_occurrence": results.co_occurrence(top_codes)
+    }
+    analytics["elapsed"] = time.perf_counter() - started
+    return results, analytics
+
+# Background job workers, started once per process outside the script run
+@st.cache_resource
+def get_job_workers(count, _queue, _coder, _results_store):
+    return start_workers(_queue, _coder, count, results_store=_results_store)
+
+# Format a duration in seconds for display
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+# Table of a traced analysis's stages, nested under their parents in start order
+def trace_table(trace):
+    if not trace:
+        return pd.DataFrame()
+    parents = {record["span_id"]: record["parent_id"] for record in trace}
+    started = min(record["start"] for record in trace)
+    rows = []
+    for record in sorted(trace, key=lambda record: record["start"]):
+        depth = 0
+        parent = record["parent_id"]
+        while parent in parents:
+            depth += 1
+            parent = parents[parent]
+        rows.append({
+            "Stage": "\u00a0\u00a0" * depth + record["name"],
+            "Start (ms)": (record["start"] - started) * 1000,
+            "Duration (ms)": record["duration_ms"],
+            "Details": ", ".join(
+                f"{key}={value}" for key, value in record["attributes"].items()
+                if isinstance(value, (int, float, str)) and key != "profile_path"
+            )
+        })
+    return pd.DataFrame(rows)
+
+# Read a results file only when its download button is clicked
+def read_output_file(path):
+    return lambda: open(path, "rb").read()
+
+# Export a running job's checkpointed rows only when its download button is clicked
+def read_partial_results(job):
+    def read():
+        path = os.path.join(BATCH_OUTPUT_DIR, f"{job['id']}_partial.{job['output_format']}")
+        return open(job_queue.export(job["id"], path), "rb").read()
+    return read
+
+# Status, progress and controls of recent jobs, refreshed every few seconds
+@st.fragment(run_every=2)
+def render_jobs():
+    jobs = job_queue.list_jobs(limit=JOBS_SHOWN)
+    if not jobs:
+        st.caption("No batch jobs yet.")
+        return
+    for job in jobs:
+        with st.container(border=True):
+            total = job["total_rows"]
+            st.markdown(f"**{job['name']}** · `{job['id']}` · {job['status']}")
+            st.progress(
+                min(job["rows_done"] / total, 1.0) if total else 1.0,
+                text=f"{job['rows_done']} / {total} rows, {job['errors']} errors"
+            )
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Rows / Second", f"{job['rows_per_second']:.1f}")
+            col2.metric("ETA", format_duration(job["eta_seconds"]))
+            with col3:
+                if job["status"] in ("queued", "running"):
+                    if st.button("Cancel", key=f"cancel_{job['id']}"):
+                        job_queue.cancel(job["id"])
+                        st.rerun()
+                elif job["status"] in ("failed", "cancelled"):
+                    if st.button("Resume", key=f"resume_{job['id']}"):
+                        job_queue.resume(job["id"])
+                        st.rerun()
+            if job["error"]:
+                st.error(f"Error: {job['error']}")
+            if job["status"] == "completed" and os.path.exists(job["output_path"]):
+                st.download_button(
+                    "Download results",
+                    data=read_output_file(job["output_path"]),
+                    file_name=os.path.basename(job["output_path"]),
+                    on_click="ignore",
+                    key=f"download_{job['id']}"
+                )
+            elif job["status"] != "completed" and job["rows_done"]:
+                st.download_button(
+                    "Download results so far",
+                    data=read_partial_results(job),
+                    file_name=f"{job['id']}_partial.{job['output_format']}",
+                    on_click="ignore",
+                    key=f"download_{job['id']}"
+                )
+
+# Render assigned codes; partial codings show only the fields received so far
+def render_codes(coding):
+    # Display codes and their details
+    st.markdown("### Assigned Codes")
+    
+    # Create columns for better layout
+    col1, col2 = st.columns([1, 3])
+    
+    with col1:
+        st.markdown("**Code**")
+        for code in coding["codes"]:
+            st.markdown(f"`{code}`")
+    
+    with col2:
+        st.markdown("**Description & Analysis**")
+        for code in coding["codes"]:
+            # Find code description
+            code_description = codeframe.description(code)
+            
+            # Display code description and analysis
+            st.markdown(f"**{code_description}**")
+            
+            # Confidence score
+            if "confidence" in coding and code in coding["confidence"]:
+                confidence = coding["confidence"][code]
+                st.progress(confidence, text=f"Confidence: {confidence:.2f}")
+            
+            # Explanation
+            if "explanation" in coding and code in coding["explanation"]:
+                st.markdown(coding["explanation"][code])
+            
+            # Relevant quote
+            if "relevant_quotes" in coding and code in coding["relevant_quotes"]:
+                st.markdown(f"> {coding['relevant_quotes'][code]}")
+            
+            st.markdown("---")
+
+# Load codeframe, parsed once per process (and again only when the file changes)
+try:
+    codeframe = load_codeframe(CODEFRAME_PATH)
+except Exception as e:
+    st.error(f"Failed to load codeframe: {str(e)}")
+    st.stop()
 
 try:
     # Get API key from environment variables or Streamlit secrets
@@ -55,14 +284,50 @@ try:
     model_name = st.secrets.get("MODEL_NAME", os.getenv("MODEL_NAME", "claude-3-opus-20240229"))
     max_tokens = int(st.secrets.get("MAX_TOKENS", os.getenv("MAX_TOKENS", 4000)))
     temperature = float(st.secrets.get("TEMPERATURE", os.getenv("TEMPERATURE", 0.7)))
+    shortlist_k = st.secrets.get("SHORTLIST_K", os.getenv("SHORTLIST_K"))
+    cascade_model = st.secrets.get("CASCADE_MODEL", os.getenv("CASCADE_MODEL"))
+    escalation_threshold = float(st.secrets.get("ESCALATION_THRESHOLD", os.getenv("ESCALATION_THRESHOLD", 0.7)))
+    rate_limit_rpm = st.secrets.get("RATE_LIMIT_RPM", os.getenv("RATE_LIMIT_RPM"))
+    rate_limit_tpm = st.secrets.get("RATE_LIMIT_TPM", os.getenv("RATE_LIMIT_TPM"))
     
-    # Initialize Claude Coder
-    coder = ClaudeCoder(
-        api_key=api_key,
-        model_name=model_name,
-        max_tokens=max_tokens,
-        temperature=temperature
+    # Reuse the process-wide Claude Coder built for these settings and codeframe
+    coder = get_coder(
+        api_key,
+        model_name,
+        max_tokens,
+        temperature,
+        int(shortlist_k) if shortlist_k else None,
+        cascade_model or None,
+        escalation_threshold,
+        int(rate_limit_rpm) if rate_limit_rpm else None,
+        int(rate_limit_tpm) if rate_limit_tpm else None,
+        codeframe,
+        codeframe.content_hash
+    )
+    
+    # Batch jobs are coded in the background, surviving reruns and closed tabs
+    job_queue = get_job_queue(
+        os.getenv("JOBS_PATH", DEFAULT_JOBS_PATH),
+        os.getenv("JOBS_DIR", DEFAULT_JOBS_DIR)
+    )
+    results_store = get_results_store(
+        os.getenv("RESULTS_STORE_DIR", DEFAULT_RESULTS_DIR),
+        codeframe,
+        codeframe.content_hash
     )
+    if JOB_WORKERS:
+        # With CLASSIFIER_THRESHOLD set, confident responses in batch jobs are coded locally
+        classifier_threshold = st.secrets.get("CLASSIFIER_THRESHOLD", os.getenv("CLASSIFIER_THRESHOLD"))
+        job_coder = coder
+        if classifier_threshold:
+            job_coder = get_classifier_router(
+                coder,
+                id(coder),
+                os.getenv("CLASSIFIER_PATH", DEFAULT_CLASSIFIER_PATH),
+                float(classifier_threshold),
+                float(os.getenv("CLASSIFIER_AUDIT_RATE", 0) or 0)
+            )
+        get_job_workers(JOB_WORKERS, job_queue, job_coder, results_store)
 except Exception as e:
     st.error(f"Failed to initialize the coding system: {str(e)}")
     st.info("Please ensure you have set up your API key in either:")
@@ -73,15 +338,6 @@ except Exception as e:
     """)
     st.stop()
 
-# Load codeframe
-def load_codeframe():
-    try:
-        with open("data/codeframe.json", "r") as f:
-            return json.load(f)
-    except Exception as e:
-        st.error(f"Failed to load codeframe: {str(e)}")
-        st.stop()
-
 # Streamlit UI setup with mobile and dark mode support
 st.set_page_config(
     page_title="AI Consultation Coder",
@@ -91,8 +347,7 @@ st.set_page_config(
 )
 
 # Load external CSS
-with open("static/styles.css") as f:
-    st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+st.markdown(load_styles(STYLES_PATH, os.stat(STYLES_PATH).st_mtime_ns), unsafe_allow_html=True)
 
 # Main title with responsive design
 st.markdown("""
@@ -102,9 +357,6 @@ st.markdown("""
     </div>
 """, unsafe_allow_html=True)
 
-# Load codeframe for reference
-codeframe = load_codeframe()
-
 # Sidebar for configuration with mobile-friendly design
 with st.sidebar:
     st.markdown("""
@@ -120,26 +372,14 @@ with st.sidebar:
         "",
         placeholder="Type to search codes...",
         key="search_input"
-    ).strip().lower()
+    )
     
-    # Display codeframe with search filtering
-    for category, codes in codeframe["categories"].items():
-        # Check if any codes in this category match the search term
-        matching_codes = {
-            code: desc for code, desc in codes.items()
-            if not search_term or 
-            search_term in code.lower() or 
-            search_term in desc.lower()
-        }
-        
-        if matching_codes:  # Only show category if it has matching codes
-            with st.expander(category.replace("_", " ").title()):
-                for code, description in matching_codes.items():
-                    st.markdown(f"""
-                        <div class="code-reference">
-                            <strong>{code}</strong>: {description}
-                        </div>
-                    """, unsafe_allow_html=True)
+    # Display codeframe with search filtering; only categories with matches are returned,
+    # each rendered as one element from the prebuilt markup
+    category_titles, code_snippets = code_reference_index(codeframe, codeframe.content_hash)
+    for category, matching_codes in codeframe.search(search_term).items():
+        with st.expander(category_titles[category]):
+            st.markdown("".join(code_snippets[code] for code in matching_codes), unsafe_allow_html=True)
     
     # Display usage statistics
     st.markdown("---")
@@ -156,8 +396,81 @@ with st.sidebar:
     if st.session_state.last_cost > 0:
         st.info(f"Last request cost: ${st.session_state.last_cost:.4f}")
 
+    # Capacity left in the organisation-wide rate limit, shared by all sessions
+    if coder.rate_limiter is not None:
+        capacity = coder.rate_limiter.status()
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Requests Available", f"{capacity['requests']:.0f} / {capacity['requests_per_minute']:.0f}")
+        with col2:
+            st.metric("Tokens Available", f"{capacity['tokens']:,.0f}")
+        if capacity["paused_seconds"] > 0:
+            st.warning(f"API rate limited; resuming in {capacity['paused_seconds']:.0f}s")
+
+    # Persistent coding cache statistics
+    if coder.cache is not None:
+        cache_stats = coder.cache.stats
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Cache Hits", cache_stats["hits"])
+        with col2:
+            st.metric("Cached Codings", cache_stats["entries"])
+    
+    # Metered API performance, from actual usage reported by the API
+    with st.expander("Performance Metrics"):
+        metrics = coder.metrics.summary()
+        col1, col2, col3 = st.columns(3)
+        col1.metric("p50", f"{metrics['latency_p50_seconds']:.2f}s")
+        col2.metric("p95", f"{metrics['latency_p95_seconds']:.2f}s")
+        col3.metric("p99", f"{metrics['latency_p99_seconds']:.2f}s")
+        col1, col2 = st.columns(2)
+        col1.metric("Tokens / Response", f"{metrics['tokens_per_response']:.0f}")
+        col2.metric("Cost / 1k Responses", f"${metrics['cost_per_1k_responses']:.2f}")
+        st.caption(
+            f"{metrics['requests']} API requests, {metrics['retries']} retries, "
+            f"{metrics['errors']} errors, {metrics['cached_responses']} cache hits"
+        )
+        
+        # Per-tier figures for tuning the cascade threshold
+        if coder.cascade_model:
+            cascade = metrics["cascade"]
+            reasons = cascade["escalation_reasons"]
+            st.markdown("**Model Cascade**")
+            col1, col2 = st.columns(2)
+            col1.metric("Fast Tier Hit Rate", f"{cascade['fast_hit_rate']:.0%}")
+            col2.metric("Escalated", cascade["escalated"])
+            st.caption(
+                f"Escalations: {reasons['low_confidence']} low confidence, "
+                f"{reasons['invalid_codes']} invalid codes, {reasons['error']} errors"
+            )
+            for model, totals in metrics["models"].items():
+                st.caption(
+                    f"`{model}`: {totals['responses']} responses, "
+                    f"p50 {totals['latency_p50_seconds']:.2f}s, p95 {totals['latency_p95_seconds']:.2f}s, "
+                    f"${totals['cost_per_response']:.4f} / response"
+                )
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button(
+                "JSON",
+                data=coder.metrics.to_json(),
+                file_name="coder_metrics.json",
+                mime="application/json",
+                on_click="ignore",
+                key="metrics_json"
+            )
+        with col2:
+            st.download_button(
+                "Prometheus",
+                data=coder.metrics.to_prometheus(),
+                file_name="coder_metrics.prom",
+                mime="text/plain",
+                on_click="ignore",
+                key="metrics_prometheus"
+            )
+
 # Main content with responsive tabs
-tab1, tab2 = st.tabs(["Single Response", "Batch Processing"])
+tab1, tab2, tab3 = st.tabs(["Single Response", "Batch Processing", "Analytics"])
 
 with tab1:
     st.markdown("""
@@ -181,6 +494,12 @@ with tab1:
         key="response_input"
     )
     
+    compact = st.checkbox(
+        "Codes and confidences only (explain codes on demand)",
+        value=False,
+        key="single_compact"
+    )
+    
     # Check if question has changed
     if question != st.session_state.current_question:
         st.session_state.current_question = question
@@ -190,47 +509,47 @@ with tab1:
         if not question or not response:
             st.warning("Please enter both a question and response!")
         else:
-            # Check rate limiting
-            current_time = time.time()
-            time_since_last_request = current_time - st.session_state.last_request_time
-            
-            if time_since_last_request < RATE_LIMIT_SECONDS:
-                st.warning(f"Please wait {RATE_LIMIT_SECONDS - int(time_since_last_request)} seconds before making another request.")
-            else:
-                with st.spinner("Analyzing response..."):
-                    try:
-                        # Estimate cost
-                        estimated_cost = estimate_cost(question + response)
-                        st.session_state.last_cost = estimated_cost
-                        
+            # Requests wait for capacity in the rate limiter shared by all sessions
+            with st.spinner("Analyzing response..."):
+                try:
+                    # Time every stage of this analysis for the Stage Timings view
+                    with collect() as trace, span("analyze_response", response_chars=len(response)):
                         # Clean and process response
                         cleaned_response = clean_response(response)
                         statements = split_compound_response(cleaned_response)
                         
-                        # Get coding from Claude
-                        coding = coder.code_response(
+                        # Stream the coding from Claude, rendering codes as they arrive
+                        progress = st.empty()
+                        single_coder = coder.with_options(compact=True) if compact else coder
+                        for coding in single_coder.stream_code_response(
                             response=cleaned_response,
                             question=question
-                        )
-                        
-                        # Update statistics
-                        st.session_state.last_request_time = current_time
-                        st.session_state.request_count += 1
-                        st.session_state.total_cost += estimated_cost
-                        
-                        # Store results in session state
-                        st.session_state.analysis_results = {
-                            "cleaned_response": cleaned_response,
-                            "statements": statements,
-                            "coding": coding
-                        }
-                        
-                        # Force UI update
-                        st.rerun()
-                        
-                    except Exception as e:
-                        st.error(f"An error occurred during analysis: {str(e)}")
-    
+                        ):
+                            if coding.get("codes"):
+                                with progress.container():
+                                    render_codes(coding)
+                    
+                    # Update statistics with the metered cost (zero on a cache hit)
+                    request_cost = single_coder.last_request_cost
+                    st.session_state.last_cost = request_cost
+                    st.session_state.request_count += 1
+                    st.session_state.total_cost += request_cost
+                    
+                    # Store results in session state
+                    st.session_state.analysis_results = {
+                        "question": question,
+                        "cleaned_response": cleaned_response,
+                        "statements": statements,
+                        "coding": coding,
+                        "trace": trace
+                    }
+                    
+                    # Force UI update
+                    st.rerun()
+                    
+                except Exception as e:
+                    st.error(f"An error occurred during analysis: {str(e)}")
+
     # Display results if available
     if st.session_state.analysis_results:
         results = st.session_state.analysis_results
@@ -247,49 +566,34 @@ with tab1:
             for i, statement in enumerate(results["statements"], 1):
                 st.markdown(f"{i}. {statement}")
         
+        # Show where the time went
+        with st.expander("Stage Timings"):
+            st.dataframe(
+                trace_table(results.get("trace")),
+                hide_index=True,
+                column_config={
+                    "Start (ms)": st.column_config.NumberColumn(format="%.1f"),
+                    "Duration (ms)": st.column_config.NumberColumn(format="%.1f")
+                }
+            )
+        
         # Show assigned codes with descriptions
         coding = results["coding"]
         if "codes" in coding and coding["codes"]:
             st.success("Analysis complete!")
+            render_codes(coding)
             
-            # Display codes and their details
-            st.markdown("### Assigned Codes")
-            
-            # Create columns for better layout
-            col1, col2 = st.columns([1, 3])
-            
-            with col1:
-                st.markdown("**Code**")
-                for code in coding["codes"]:
-                    st.markdown(f"`{code}`")
-            
-            with col2:
-                st.markdown("**Description & Analysis**")
-                for code in coding["codes"]:
-                    # Find code description
-                    code_description = None
-                    for category in codeframe["categories"].values():
-                        if code in category:
-                            code_description = category[code]
-                            break
-                    
-                    # Display code description and analysis
-                    st.markdown(f"**{code_description}**")
-                    
-                    # Confidence score
-                    if "confidence" in coding and code in coding["confidence"]:
-                        confidence = coding["confidence"][code]
-                        st.progress(confidence, text=f"Confidence: {confidence:.2f}")
-                    
-                    # Explanation
-                    if "explanation" in coding and code in coding["explanation"]:
-                        st.markdown(coding["explanation"][code])
-                    
-                    # Relevant quote
-                    if "relevant_quotes" in coding and code in coding["relevant_quotes"]:
-                        st.markdown(f"> {coding['relevant_quotes'][code]}")
-                    
-                    st.markdown("---")
+            # Compact codings fetch explanations one code at a time
+            unexplained = [code for code in coding["codes"] if code not in coding.get("explanation", {})]
+            if unexplained:
+                columns = st.columns(len(unexplained))
+                for column, code in zip(columns, unexplained):
+                    if column.button(f"Explain {code}", key=f"explain_{code}"):
+                        with st.spinner(f"Explaining {code}..."):
+                            explained = coder.explain_codes(results["cleaned_response"], results["question"], [code])
+                        for key in ("explanation", "relevant_quotes"):
+                            coding.setdefault(key, {}).update(explained[key])
+                        st.rerun()
         else:
             st.warning("No codes were assigned to this response.")
             if "error" in coding:
@@ -310,11 +614,192 @@ with tab2:
         help="CSV should have columns: 'question' and 'response'"
     )
     
+    output_format = st.radio(
+        "Output format",
+        ["jsonl", "csv"],
+        horizontal=True,
+        key="batch_output_format"
+    )
+    packed = st.checkbox(
+        "Pack short responses into shared requests",
+        value=False,
+        key="batch_packed"
+    )
+    dedup = st.checkbox(
+        "Collapse duplicate and near-duplicate responses",
+        value=False,
+        key="batch_dedup"
+    )
+    batch_compact = st.checkbox(
+        "Codes and confidences only (far fewer output tokens)",
+        value=False,
+        key="batch_compact"
+    )
+    
     if uploaded_file:
-        st.info("Batch processing coming soon!")
-        
         if st.button("Process Batch", key="batch_button"):
-            st.warning("Batch processing is not yet implemented")
+            # Queue the file; workers code it in the background with per-row checkpoints
+            try:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                uploaded_file.seek(0)
+                job_id = job_queue.submit(
+                    uploaded_file,
+                    os.path.join(BATCH_OUTPUT_DIR, f"batch_{timestamp}.{output_format}"),
+                    name=uploaded_file.name,
+                    output_format=output_format,
+                    packed=packed,
+                    dedup=dedup,
+                    compact=batch_compact
+                )
+                st.success(f"Batch queued as job {job_id}. You can close this tab; progress is saved.")
+            except ValueError as e:
+                st.error(f"Invalid batch file: {str(e)}")
+            except Exception as e:
+                st.error(f"An error occurred while queueing the batch: {str(e)}")
+    
+    # Bring earlier results up to date after the codeframe was edited
+    with st.expander("Recode previous results after a codeframe change"):
+        previous_file = st.file_uploader(
+            "Upload earlier batch results",
+            type=["jsonl", "csv"],
+            key="recode_upload"
+        )
+        if previous_file:
+            input_format = "csv" if previous_file.name.endswith(".csv") else "jsonl"
+            text_file = io.TextIOWrapper(previous_file, encoding="utf-8-sig", newline="")
+            try:
+                previous_file.seek(0)
+                plan = plan_recode(codeframe, text_file, input_format)
+                reasons = plan["reasons"]
+                st.caption(
+                    f"{plan['recode']} of {plan['rows']} rows need re-coding: "
+                    f"{reasons['invalidated_code']} carry removed or reworded codes, "
+                    f"{reasons['new_code_candidate']} may match new codes, "
+                    f"{reasons['error']} had errors, "
+                    f"{reasons['unknown_version']} were coded with an unknown codeframe version"
+                )
+                for version, change in plan["changes"].items():
+                    st.caption(f"Codeframe `{version[:12]}` → current: {change}")
+                
+                if plan["recode"] and st.button("Recode Changed Rows", key="recode_button"):
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    output_path = os.path.join(BATCH_OUTPUT_DIR, f"recoded_{timestamp}.{input_format}")
+                    recode_bar = st.progress(0.0, text="Recoding...")
+                    previous_file.seek(0)
+                    for progress in run_recode(
+                        coder,
+                        text_file,
+                        output_path,
+                        input_format=input_format,
+                        output_format=input_format,
+                        packed=packed
+                    ):
+                        recode_bar.progress(
+                            min(progress["rows_done"] / plan["rows"], 1.0),
+                            text=f"{progress['rows_done']} / {plan['rows']} rows, {progress['recoded']} re-coded"
+                        )
+                    st.success(
+                        f"Recode complete: {progress['recoded']} rows re-coded, "
+                        f"{progress['carried_forward']} carried forward."
+                    )
+                    st.download_button(
+                        "Download updated results",
+                        data=read_output_file(output_path),
+                        file_name=os.path.basename(output_path),
+                        on_click="ignore",
+                        key="recode_download"
+                    )
+            except (ValueError, KeyError) as e:
+                st.error(f"Invalid results file: {str(e)}")
+            finally:
+                text_file.detach()
+    
+    st.markdown("### Batch Jobs")
+    if not JOB_WORKERS:
+        st.caption("Jobs are coded by `python worker.py`.")
+    render_jobs()
+
+with tab3:
+    st.markdown("### Results Analytics")
+    st.caption("Completed batch jobs are added automatically; earlier results files can be added below.")
+    
+    with st.expander("Add a results file"):
+        stored_file = st.file_uploader(
+            "Upload batch results",
+            type=["jsonl", "csv"],
+            key="analytics_upload"
+        )
+        if stored_file and st.button("Add to Analytics", key="analytics_add"):
+            output_format = "csv" if stored_file.name.endswith(".csv") else "jsonl"
+            name = f"{os.path.splitext(stored_file.name)[0]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            text_file = io.TextIOWrapper(stored_file, encoding="utf-8-sig", newline="")
+            try:
+                results_store.add_results_file(text_file, output_format, name)
+                st.success(f"Added {stored_file.name}")
+            except (ValueError, KeyError) as e:
+                st.error(f"Invalid results file: {str(e)}")
+            finally:
+                text_file.detach()
+    
+    stored_runs = results_store.names()
+    if not stored_runs:
+        st.info("No stored results yet.")
+    else:
+        def run_label(name):
+            job = job_queue.get(name)
+            return f"{job['name']} ({name})" if job else name
+        
+        selected_runs = st.multiselect(
+            "Runs",
+            stored_runs,
+            default=stored_runs,
+            format_func=run_label,
+            key="analytics_runs"
+        )
+        results, analytics = code_analytics(
+            results_store,
+            results_store.signature(selected_runs),
+            codeframe.content_hash
+        )
+        frequencies = analytics["frequencies"]
+        top_codes = analytics["top_codes"]
+        
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Responses", f"{len(results):,}")
+        with col2:
+            st.metric("Coded Responses", f"{analytics['coded_responses']:,}")
+        with col3:
+            st.metric("Errors", f"{int(results.errors.sum()):,}")
+        with col4:
+            st.metric("Codes Used", f"{int((frequencies > 0).sum())} / {len(results.codes)}")
+        st.caption(f"Aggregated in {analytics['elapsed'] * 1000:.1f} ms")
+        
+        if len(top_codes):
+            labels = [results.codes[code_id] for code_id in top_codes]
+            
+            st.markdown("#### Code Frequencies")
+            st.bar_chart(pd.Series(frequencies[top_codes], index=labels, name="Responses"), horizontal=True)
+            st.dataframe(pd.DataFrame({
+                "Description": [codeframe.description(code) for code in labels],
+                "Responses": frequencies[top_codes],
+                "Share": frequencies[top_codes] / max(len(results), 1),
+                "Mean Confidence": analytics["mean_confidence"][top_codes]
+            }, index=labels), column_config={
+                "Share": st.column_config.ProgressColumn(format="percent", min_value=0.0, max_value=1.0),
+                "Mean Confidence": st.column_config.NumberColumn(format="%.2f")
+            })
+            
+            st.markdown("#### By Question")
+            st.caption("Share of each question's responses given each code")
+            shares = analytics["breakdown"][:, top_codes] / np.maximum(analytics["responses_per_question"], 1)[:, None]
+            st.dataframe(pd.DataFrame(shares, index=results.questions, columns=labels), column_config={
+                code: st.column_config.NumberColumn(format="percent") for code in labels
+            })
+            
+            st.markdown("#### Code Co-occurrence")
+            st.caption("Responses given both codes; the diagonal is each code's frequency")
+            st.dataframe(pd.DataFrame(analytics["co_occurrence"], index=labels, columns=labels))
 
 # Footer with responsive design
 st.markdown("""
@@ -0,0 +1,90 @@
+"""
+Throughput of the Parquet results store and its analytics.
+
+Stores --responses synthetic coded responses (codes drawn from the bundled
+codeframe, a few per response) and times loading them back and computing
+code frequencies, per-question breakdowns and code co-occurrence. No API
+requests are made.
+
+Usage:
+    python -m benchmarks.analytics_benchmark [--responses 1000000]
+"""
+import argparse
+import tempfile
+import time
+from typing import Dict, Iterator
+
+import numpy as np
+
+from utils.codeframe import load_codeframe
+from utils.results_store import ResultsStore
+
+# Questions the synthetic responses answer
+SYNTHETIC_QUESTIONS = 8
+# Codes shown in the co-occurrence matrix, as in the Analytics tab
+TOP_CODES = 20
+
+
+def synthetic_records(codes, responses: int, seed: int = 0) -> Iterator[Dict]:
+    """Yield output records with up to 4 codes each, skewed towards popular codes."""
+    rng = np.random.default_rng(seed)
+    popularity = rng.zipf(1.5, len(codes)).astype(float)
+    popularity /= popularity.sum()
+    indptr = np.concatenate([[0], np.cumsum(rng.integers(0, 5, responses))])
+    drawn = [codes[i] for i in rng.choice(len(codes), indptr[-1], p=popularity)]
+    for row in range(responses):
+        # Repeated draws collapse, as the store keeps each code once per response
+        chosen = list(dict.fromkeys(drawn[indptr[row]:indptr[row + 1]]))
+        yield {
+            "row": row,
+            "question": f"Question {row % SYNTHETIC_QUESTIONS}",
+            "response": "",
+            "cleaned_response": "",
+            "codes": chosen,
+            "confidence": {code: 0.9 for code in chosen},
+            "explanation": {},
+            "relevant_quotes": {},
+            "error": None,
+            "codeframe_version": None
+        }
+
+
+def timed(function, repeats: int = 5) -> float:
+    """Best wall time of several calls, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--responses", type=int, default=1_000_000, help="Coded responses to store")
+    args = parser.parse_args()
+
+    codeframe = load_codeframe()
+    store = ResultsStore(codeframe, tempfile.mkdtemp())
+    started = time.perf_counter()
+    store.write("synthetic", synthetic_records(codeframe.codes, args.responses))
+    write_seconds = time.perf_counter() - started
+
+    results = store.load()
+    top = np.argsort(-results.code_frequencies())[:TOP_CODES]
+    print(f"responses: {len(results)}, codes assigned: {len(results.code_ids)}")
+    print(f"{'write':<22} {write_seconds * 1000:9.1f} ms")
+    for label, function in [
+        ("load", store.load),
+        ("code frequencies", results.code_frequencies),
+        ("mean confidence", results.mean_confidence),
+        ("question breakdown", results.question_breakdown),
+        (f"co-occurrence (top {TOP_CODES})", lambda: results.co_occurrence(top)),
+        ("co-occurrence (all)", results.co_occurrence),
+        ("code matrix", results.code_matrix),
+    ]:
+        print(f"{label:<22} {timed(function):9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Startup and rerun latency of the Streamlit app.
+
+Runs app.py headlessly with Streamlit's AppTest and reports the cold start
+(first run in the process), the start of a further session once the shared
+resources are cached, and the rerun latency while typing into the codeframe
+search box. A synthetic codeframe of --codes codes shows how the sidebar
+scales; no API requests are made.
+
+Usage:
+    python -m benchmarks.app_benchmark [--codes 5000] [--search "bus services"]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from utils.codeframe import DEFAULT_CODEFRAME_PATH
+
+APP_PATH = os.path.abspath("app.py")
+# Categories the synthetic codeframe is split into
+SYNTHETIC_CATEGORIES = 20
+
+
+def make_codeframe(codes: int, path: str) -> None:
+    """
+    Write a codeframe of `codes` codes reusing the bundled descriptions.
+
+    Args:
+        codes: Number of codes to generate
+        path: Where to write the codeframe JSON
+    """
+    with open(DEFAULT_CODEFRAME_PATH) as f:
+        descriptions = [
+            description
+            for category in json.load(f)["categories"].values()
+            for description in category.values()
+        ]
+    categories: Dict[str, Dict[str, str]] = {}
+    for i in range(codes):
+        category = f"category_{i % SYNTHETIC_CATEGORIES:02d}"
+        categories.setdefault(category, {})[f"{i:05d}"] = f"{descriptions[i % len(descriptions)]} ({i})"
+    with open(path, "w") as f:
+        json.dump({"categories": categories}, f)
+
+
+def percentiles(samples: List[float]) -> str:
+    p50, p95 = np.percentile(samples, [50, 95])
+    return f"p50 {p50 * 1000:7.1f} ms   p95 {p95 * 1000:7.1f} ms"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--codes", type=int, default=5000,
+                        help="Codes in a synthetic codeframe; 0 uses the bundled one")
+    parser.add_argument("--search", default="bus services", help="Text typed into the search box")
+    parser.add_argument("--reruns", type=int, default=20, help="Plain reruns to time")
+    args = parser.parse_args()
+
+    # Keep the run offline and away from the app's own cache and limiter state
+    workdir = tempfile.mkdtemp()
+    os.environ["ANTHROPIC_API_KEY"] = "offline"
+    os.environ["CODING_CACHE_PATH"] = os.path.join(workdir, "coding_cache.sqlite")
+    os.environ["RATE_LIMIT_PATH"] = os.path.join(workdir, "rate_limit.sqlite")
+    if args.codes:
+        os.environ["CODEFRAME_PATH"] = os.path.join(workdir, "codeframe.json")
+        make_codeframe(args.codes, os.environ["CODEFRAME_PATH"])
+
+    from streamlit.testing.v1 import AppTest
+
+    def start_session() -> AppTest:
+        at = AppTest.from_file(APP_PATH, default_timeout=120)
+        at.run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        return at
+
+    started = time.perf_counter()
+    start_session()
+    cold_start = time.perf_counter() - started
+
+    starts = []
+    for _ in range(3):
+        started = time.perf_counter()
+        at = start_session()
+        starts.append(time.perf_counter() - started)
+
+    keystrokes = []
+    for end in range(1, len(args.search) + 1):
+        at.text_input("search_input").input(args.search[:end])
+        started = time.perf_counter()
+        at.run()
+        keystrokes.append(time.perf_counter() - started)
+    matches = len(at.sidebar.expander)
+
+    reruns = []
+    for _ in range(args.reruns):
+        started = time.perf_counter()
+        at.run()
+        reruns.append(time.perf_counter() - started)
+
+    print(f"codeframe: {args.codes or 'bundled'} codes")
+    print(f"{'cold start':<22} {cold_start * 1000:7.1f} ms")
+    print(f"{'new session':<22} {percentiles(starts)}")
+    print(f"{'search keystroke':<22} {percentiles(keystrokes)}   ({matches} categories match)")
+    print(f"{'rerun':<22} {percentiles(reruns)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Agreement and throughput of the local classifier.
+
+Trains a classifier on --responses synthetic coded responses, written from
+the descriptions of their codes in the bundled codeframe with words dropped
+and filler added, then reports the calibrated agreement at each threshold
+against a held-out set, its training time and its scoring throughput. No
+API requests are made.
+
+Usage:
+    python -m benchmarks.classifier_benchmark [--responses 20000] [--test 5000]
+"""
+import argparse
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from llm.classifier import DEFAULT_EPOCHS, CodeClassifier
+from utils.codeframe import Codeframe, load_codeframe
+
+# Questions the synthetic responses answer
+SYNTHETIC_QUESTIONS = 3
+# Words scattered through the synthetic responses, tied to no code
+FILLER_WORDS = "well honestly i think that overall really maybe also however the plan council".split()
+
+
+def synthetic_responses(codeframe: Codeframe, responses: int, seed: int = 0) -> Tuple[List[str], List[str], List[List[str]]]:
+    """Build responses with 1-3 codes each, skewed towards popular codes."""
+    rng = np.random.default_rng(seed)
+    codes = codeframe.codes
+    popularity = np.random.default_rng(0).zipf(1.6, len(codes)).astype(float)
+    popularity /= popularity.sum()
+    texts, questions, code_lists = [], [], []
+    for _ in range(responses):
+        chosen = sorted(set(rng.choice(codes, rng.choice([1, 1, 1, 2, 2, 3]), p=popularity)))
+        parts = []
+        for code in chosen:
+            words = codeframe.description(code).split()
+            parts.append(" ".join([word for word in words if rng.random() > 0.25] or words))
+        words = " . ".join(parts).split()
+        for _ in range(rng.integers(0, 6)):
+            words.insert(rng.integers(0, len(words) + 1), rng.choice(FILLER_WORDS))
+        texts.append(" ".join(words))
+        questions.append(f"Question {rng.integers(0, SYNTHETIC_QUESTIONS)}")
+        code_lists.append(chosen)
+    return texts, questions, code_lists
+
+
+def print_rows(title: str, rows: List[dict]) -> None:
+    print(title)
+    print(f"  {'threshold':>9} {'coverage':>9} {'agreement':>10} {'overlap':>8}")
+    for row in rows:
+        agreement = "-" if row["agreement"] is None else f"{row['agreement']:.1%}"
+        overlap = "-" if row["overlap"] is None else f"{row['overlap']:.3f}"
+        print(f"  {row['threshold']:>9.2f} {row['coverage']:>9.1%} {agreement:>10} {overlap:>8}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--responses", type=int, default=20_000, help="Synthetic responses to train on")
+    parser.add_argument("--test", type=int, default=5_000, help="Held-out synthetic responses to evaluate on")
+    parser.add_argument("--epochs", type=int, default=DEFAULT_EPOCHS, help="Passes over the training responses")
+    args = parser.parse_args()
+
+    codeframe = load_codeframe()
+    training = synthetic_responses(codeframe, args.responses, seed=0)
+    held_out = synthetic_responses(codeframe, args.test, seed=1)
+
+    classifier = CodeClassifier(codeframe.codes)
+    started = time.perf_counter()
+    learned = classifier.fit_batches([training], epochs=args.epochs)
+    train_seconds = time.perf_counter() - started
+    evaluation = classifier.evaluate(*held_out)
+
+    print(f"trained on {learned} responses in {train_seconds:.1f} s ({learned * args.epochs / train_seconds:,.0f} responses/s per epoch)")
+    print(f"scored {evaluation['responses']} responses at {evaluation['responses_per_second']:,.0f} responses/s")
+    print_rows("calibration estimate (held-out training fold)", classifier.agreement_report())
+    print_rows("held-out evaluation", evaluation["thresholds"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+"""
+Offline stand-ins for the Anthropic clients.
+
+FakeAnthropic and FakeAsyncAnthropic implement the parts of
+`messages.create` and `messages.stream` that ClaudeCoder uses, and
+FakeAnthropic also implements `messages.batches` for Message Batches runs.
+They answer the requested tool call with canned codings built from
+data/sample_responses.csv and can simulate latency, rate-limit errors and
+malformed tool input, so performance can be measured without spending money
+on the live API.
+"""
+import asyncio
+import csv
+import json
+import random
+import itertools
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, List, Optional
+
+import anthropic
+
+from llm.retrieval import CandidateIndex
+from utils.codeframe import load_codeframe
+from utils.parser import clean_response
+
+SAMPLE_RESPONSES_PATH = "data/sample_responses.csv"
+
+
+class FakeUsage:
+    def __init__(
+        self,
+        input_tokens: int,
+        output_tokens: int,
+        cache_read_input_tokens: int = 0,
+        cache_creation_input_tokens: int = 0
+    ):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cache_read_input_tokens = cache_read_input_tokens
+        self.cache_creation_input_tokens = cache_creation_input_tokens
+
+
+class FakeToolUseBlock:
+    type = "tool_use"
+
+    def __init__(self, name: str, tool_input: Dict):
+        self.id = f"toolu_{zlib.crc32(name.encode('utf-8')):08x}"
+        self.name = name
+        self.input = tool_input
+
+
+class FakeMessage:
+    def __init__(self, block: FakeToolUseBlock, usage: FakeUsage, model: str):
+        self.content = [block]
+        self.usage = usage
+        self.model = model
+        self.stop_reason = "tool_use"
+
+
+class FakeInputJSONEvent:
+    """Stream event carrying a piece of a tool call's JSON input."""
+
+    type = "input_json"
+
+    def __init__(self, partial_json: str):
+        self.partial_json = partial_json
+
+
+class FakeHTTPResponse:
+    """Minimal response object accepted by anthropic.APIStatusError."""
+
+    def __init__(self, status_code: int, headers: Dict[str, str]):
+        self.status_code = status_code
+        self.headers = headers
+        self.request = None
+
+
+def build_canned_codings(path: str = SAMPLE_RESPONSES_PATH) -> Dict[str, Dict]:
+    """
+    Build a plausible coding for each sample response.
+
+    The top codes from the local BM25 index stand in for the model's choice.
+
+    Args:
+        path: CSV with 'question' and 'response' columns
+
+    Returns:
+        Mapping of cleaned response text to coding result
+    """
+    codeframe = load_codeframe()
+    index = CandidateIndex(codeframe.categories)
+    with open(path, newline="", encoding="utf-8") as f:
+        responses = [clean_response(row["response"]) for row in csv.DictReader(f)]
+
+    codings = {}
+    for response, codes in zip(responses, index.top_k(responses, k=3)):
+        codes = codes or []
+        quote = response.split(". ")[0]
+        codings[response] = {
+            "codes": codes,
+            "confidence": {code: round(0.95 - 0.1 * i, 2) for i, code in enumerate(codes)},
+            "explanation": {
+                code: f"The response relates to: {codeframe.description(code)}." for code in codes
+            },
+            "relevant_quotes": {code: quote for code in codes},
+            "error": None
+        }
+    return codings
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class _FakeMessagesBase:
+    def __init__(
+        self,
+        latency_seconds: float = 0.2,
+        jitter_seconds: float = 0.1,
+        rate_limit_rate: float = 0.0,
+        malformed_rate: float = 0.0,
+        retry_after_seconds: float = 0.1,
+        output_tokens_per_second: float = 0.0,
+        low_confidence_rates: Optional[Dict[str, float]] = None,
+        seed: Optional[int] = 0
+    ):
+        self.latency_seconds = latency_seconds
+        self.jitter_seconds = jitter_seconds
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.retry_after_seconds = retry_after_seconds
+        # Generation speed after the first token; 0 returns the whole reply at once
+        self.output_tokens_per_second = output_tokens_per_second
+        # Share of responses given halved confidences, keyed by a substring of
+        # the model name, e.g. {"haiku": 0.3} to exercise cascade escalation
+        self.low_confidence_rates = low_confidence_rates or {}
+        self.codings = build_canned_codings()
+        self.codeframe = load_codeframe()
+        self._samples = list(self.codings.values())
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cached_prefixes = set()
+        self.calls = 0
+
+    def _coding_for(self, response: str, model: str, schema: Dict, malformed: bool) -> Dict:
+        digest = zlib.crc32(response.encode("utf-8"))
+        coding = self.codings.get(response)
+        if coding is None:
+            coding = self._samples[digest % len(self._samples)]
+        # Only the properties the tool asks for, as the real model would
+        coding = {key: json.loads(json.dumps(value)) for key, value in coding.items() if key in schema["properties"]}
+        for name, rate in self.low_confidence_rates.items():
+            if name in model and zlib.crc32(model.encode("utf-8"), digest) % 1000 < rate * 1000:
+                coding["confidence"] = {code: value / 2 for code, value in coding["confidence"].items()}
+        if malformed:
+            del coding["confidence"]
+        return coding
+
+    def _explanations_for(self, content: str) -> Dict:
+        response = content.split("\nResponse: ", 1)[-1].split("\nAssigned codes: ")[0]
+        codes = content.split("\nAssigned codes: ", 1)[-1].split("\n")[0].split(", ")
+        quote = response.split(". ")[0]
+        return {
+            "explanation": {
+                code: f"The response relates to: {self.codeframe.description(code)}." for code in codes
+            },
+            "relevant_quotes": {code: quote for code in codes}
+        }
+
+    def _latency(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency_seconds + self._random.uniform(-1, 1) * self.jitter_seconds)
+
+    def _generation_seconds(self, message: FakeMessage) -> float:
+        if not self.output_tokens_per_second:
+            return 0.0
+        return message.usage.output_tokens / self.output_tokens_per_second
+
+    def _respond(self, request: Dict) -> FakeMessage:
+        with self._lock:
+            self.calls += 1
+            rate_limited = self._random.random() < self.rate_limit_rate
+            malformed = self._random.random() < self.malformed_rate
+
+        if rate_limited:
+            raise anthropic.RateLimitError(
+                "Simulated rate limit",
+                response=FakeHTTPResponse(429, {"retry-after": str(self.retry_after_seconds)}),
+                body={"error": {"type": "rate_limit_error"}}
+            )
+
+        content = request["messages"][0]["content"]
+        tool = request["tool_choice"]["name"]
+        schemas = {t["name"]: t["input_schema"] for t in request["tools"]}
+        if tool == "record_explanations":
+            reply = self._explanations_for(content)
+        elif tool == "record_codings":
+            schema = schemas[tool]["properties"]["results"]["additionalProperties"]
+            entries = json.loads(content.split("\n")[1])
+            reply = {"results": {
+                entry["id"]: self._coding_for(entry["response"], request["model"], schema, malformed)
+                for entry in entries
+            }}
+        else:
+            response = content.split("\nResponse: ", 1)[-1].split("\nCandidate codes: ")[0]
+            reply = self._coding_for(response, request["model"], schemas[tool], malformed)
+        text = json.dumps(reply)
+
+        system = "".join(block["text"] for block in request.get("system") or [])
+        with self._lock:
+            cache_hit = system in self._cached_prefixes
+            self._cached_prefixes.add(system)
+        usage = FakeUsage(
+            input_tokens=_estimate_tokens(content),
+            output_tokens=_estimate_tokens(text),
+            cache_read_input_tokens=_estimate_tokens(system) if cache_hit else 0,
+            cache_creation_input_tokens=0 if cache_hit else _estimate_tokens(system)
+        )
+        return FakeMessage(FakeToolUseBlock(tool, reply), usage, request["model"])
+
+
+class FakeMessageStream:
+    """Context manager mimicking the object returned by messages.stream."""
+
+    # Characters per streamed input_json delta
+    CHUNK_CHARS = 16
+
+    def __init__(self, messages: "_FakeMessages", request: Dict):
+        self._messages = messages
+        self._request = request
+        self._message: Optional[FakeMessage] = None
+
+    def __enter__(self) -> "FakeMessageStream":
+        time.sleep(self._messages._latency())
+        self._message = self._messages._respond(self._request)
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+    def __iter__(self):
+        text = json.dumps(self._message.content[0].input)
+        chunks = range(0, len(text), self.CHUNK_CHARS)
+        delay = self._messages._generation_seconds(self._message) / max(len(chunks), 1)
+        for start in chunks:
+            yield FakeInputJSONEvent(text[start:start + self.CHUNK_CHARS])
+            if delay:
+                time.sleep(delay)
+
+    def get_final_message(self) -> FakeMessage:
+        return self._message
+
+
+class FakeRequestCounts:
+    def __init__(self, processing: int):
+        self.processing = processing
+        self.succeeded = 0
+        self.errored = 0
+        self.canceled = 0
+        self.expired = 0
+
+
+class FakeMessageBatch:
+    """Status object returned by the messages.batches endpoints."""
+
+    type = "message_batch"
+
+    def __init__(self, batch_id: str, requests: int):
+        self.id = batch_id
+        self.processing_status = "in_progress"
+        self.request_counts = FakeRequestCounts(requests)
+        self.created_at = time.time()
+        self.ended_at = None
+        self.cancel_initiated_at = None
+        self.expires_at = self.created_at + 24 * 3600
+        self.results_url = None
+
+
+class FakeBatchError:
+    """Shaped like the SDK's ErrorResponse, read as result.error.error.message."""
+
+    type = "error"
+
+    def __init__(self, message: str, error_type: str = "api_error"):
+        self.error = FakeErrorDetail(message, error_type)
+
+
+class FakeErrorDetail:
+    def __init__(self, message: str, error_type: str):
+        self.type = error_type
+        self.message = message
+
+
+class FakeBatchResult:
+    """Outcome of one batch request: 'succeeded' with a message, or a failure."""
+
+    def __init__(self, result_type: str, message: Optional[FakeMessage] = None, error: Optional[FakeBatchError] = None):
+        self.type = result_type
+        self.message = message
+        self.error = error
+
+
+class FakeBatchResponse:
+    def __init__(self, custom_id: str, result: FakeBatchResult):
+        self.custom_id = custom_id
+        self.result = result
+
+
+class FakeMessageBatches:
+    """
+    Stand-in for `messages.batches` that processes batches in memory.
+
+    A batch ends `processing_seconds` after it is created, and its requests
+    are answered by the owning fake's messages.create logic on first
+    retrieval after that. Simulated rate limits become 'errored' results,
+    and `expired_rate` of requests expire unprocessed.
+    """
+
+    def __init__(self, messages: "_FakeMessages", processing_seconds: float = 1.0, expired_rate: float = 0.0):
+        self._messages = messages
+        self.processing_seconds = processing_seconds
+        self.expired_rate = expired_rate
+        self._batches: Dict[str, FakeMessageBatch] = {}
+        self._requests: Dict[str, List[Dict]] = {}
+        self._results: Dict[str, List[FakeBatchResponse]] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.created = 0
+
+    def create(self, requests: List[Dict]) -> FakeMessageBatch:
+        custom_ids = [request["custom_id"] for request in requests]
+        if len(set(custom_ids)) != len(custom_ids):
+            raise anthropic.BadRequestError(
+                "custom_id values must be unique within a batch",
+                response=FakeHTTPResponse(400, {}),
+                body={"error": {"type": "invalid_request_error"}}
+            )
+        with self._lock:
+            batch_id = f"msgbatch_fake{next(self._ids):012d}"
+            self._batches[batch_id] = FakeMessageBatch(batch_id, len(requests))
+            self._requests[batch_id] = [json.loads(json.dumps(request)) for request in requests]
+            self.created += 1
+        return self._batches[batch_id]
+
+    def _batch(self, batch_id: str) -> FakeMessageBatch:
+        if batch_id not in self._batches:
+            raise anthropic.NotFoundError(
+                f"Batch {batch_id} not found",
+                response=FakeHTTPResponse(404, {}),
+                body={"error": {"type": "not_found_error"}}
+            )
+        return self._batches[batch_id]
+
+    def _process(self, batch: FakeMessageBatch) -> None:
+        results = []
+        counts = batch.request_counts
+        for request in self._requests.pop(batch.id):
+            if batch.cancel_initiated_at is not None:
+                result = FakeBatchResult("canceled")
+                counts.canceled += 1
+            elif self._messages._random.random() < self.expired_rate:
+                result = FakeBatchResult("expired")
+                counts.expired += 1
+            else:
+                try:
+                    result = FakeBatchResult("succeeded", self._messages._respond(request["params"]))
+                    counts.succeeded += 1
+                except anthropic.APIStatusError as e:
+                    result = FakeBatchResult("errored", error=FakeBatchError(str(e), "rate_limit_error"))
+                    counts.errored += 1
+            results.append(FakeBatchResponse(request["custom_id"], result))
+        counts.processing = 0
+        self._results[batch.id] = results
+        batch.processing_status = "ended"
+        batch.ended_at = time.time()
+
+    def retrieve(self, batch_id: str) -> FakeMessageBatch:
+        with self._lock:
+            batch = self._batch(batch_id)
+            if batch.processing_status != "ended" and (
+                batch.cancel_initiated_at is not None
+                or time.time() >= batch.created_at + self.processing_seconds
+            ):
+                self._process(batch)
+            return batch
+
+    def results(self, batch_id: str) -> Iterator[FakeBatchResponse]:
+        with self._lock:
+            batch = self._batch(batch_id)
+            if batch.processing_status != "ended":
+                raise anthropic.BadRequestError(
+                    f"Batch {batch_id} has not ended",
+                    response=FakeHTTPResponse(400, {}),
+                    body={"error": {"type": "invalid_request_error"}}
+                )
+            results = list(self._results[batch_id])
+        return iter(results)
+
+    def cancel(self, batch_id: str) -> FakeMessageBatch:
+        with self._lock:
+            batch = self._batch(batch_id)
+            if batch.processing_status == "in_progress":
+                batch.processing_status = "canceling"
+                batch.cancel_initiated_at = time.time()
+            return batch
+
+
+class _FakeMessages(_FakeMessagesBase):
+    def __init__(self, batch_processing_seconds: float = 1.0, batch_expired_rate: float = 0.0, **options):
+        super().__init__(**options)
+        self.batches = FakeMessageBatches(self, batch_processing_seconds, batch_expired_rate)
+
+    def create(self, **request) -> FakeMessage:
+        time.sleep(self._latency())
+        message = self._respond(request)
+        time.sleep(self._generation_seconds(message))
+        return message
+
+    def stream(self, **request) -> FakeMessageStream:
+        return FakeMessageStream(self, request)
+
+
+class _FakeAsyncMessages(_FakeMessagesBase):
+    async def create(self, **request) -> FakeMessage:
+        await asyncio.sleep(self._latency())
+        message = self._respond(request)
+        await asyncio.sleep(self._generation_seconds(message))
+        return message
+
+
+class FakeAnthropic:
+    """Drop-in replacement for anthropic.Anthropic in offline runs."""
+
+    def __init__(self, **options):
+        self.messages = _FakeMessages(**options)
+
+
+class FakeAsyncAnthropic:
+    """Drop-in replacement for anthropic.AsyncAnthropic in offline runs."""
+
+    def __init__(self, **options):
+        self.messages = _FakeAsyncMessages(**options)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return None
@@ -0,0 +1,122 @@
+"""
+Micro-benchmark for utils.parser.
+
+Compares the original per-call regex implementation against the
+precompiled scalar functions and their batch variants, and checks that
+all three produce identical output.
+
+Usage:
+    python -m benchmarks.parser_benchmark [--rows 1000000]
+"""
+import argparse
+import csv
+import random
+import re
+import time
+from typing import Callable, Dict, List
+
+from utils.codeframe import load_codeframe
+from utils.parser import (
+    clean_response,
+    clean_response_batch,
+    split_compound_response,
+    split_compound_response_batch,
+    validate_code_assignment,
+    validate_code_assignment_batch,
+)
+
+
+def reference_clean_response(text: str) -> str:
+    """The original clean_response, compiling patterns on every call."""
+    text = re.sub(r'\s+', ' ', text).strip()
+    text = re.sub(r'\[.*?\]', '', text)
+    text = re.sub(r'\(.*?\)', '', text)
+    text = re.sub(r'\.{2,}', '.', text)
+    text = re.sub(r'!{2,}', '!', text)
+    text = re.sub(r'\?{2,}', '?', text)
+    return text
+
+
+def reference_split_compound_response(text: str) -> List[str]:
+    """The original split_compound_response."""
+    statements = re.split(r'\s*(?:but|however|although|though|and|or|;|\.)\s+', text)
+    return [reference_clean_response(s) for s in statements if s.strip()]
+
+
+# Artifacts mixed into sample responses so every normalization path is exercised
+NOISE = [
+    "", "  ", "\n\n", " [inaudible] ", " (see attached) ", "...", "!!", "??",
+    " (unclosed", " ]stray[ ", "\t", " .. ", "!!!?? ", " [a (b] c) "
+]
+
+
+def make_responses(rows: int, seed: int = 0) -> List[str]:
+    """
+    Build synthetic responses from the bundled sample file.
+
+    Args:
+        rows: Number of responses to generate
+        seed: Random seed
+
+    Returns:
+        List of response texts
+    """
+    with open("data/sample_responses.csv", newline="", encoding="utf-8") as f:
+        samples = [row["response"] for row in csv.DictReader(f)]
+    rng = random.Random(seed)
+    responses = []
+    for _ in range(rows):
+        words = rng.choice(samples).split(" ")
+        cut = rng.randrange(1, len(words) + 1)
+        responses.append(
+            " ".join(words[:cut]) + rng.choice(NOISE) + " ".join(words[cut:]) + rng.choice(NOISE)
+        )
+    return responses
+
+
+def timed(label: str, rows: int, fn: Callable[[], object]) -> Dict:
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<45} {elapsed:8.2f}s {rows / elapsed:>12,.0f} rows/s")
+    return {"label": label, "seconds": elapsed, "result": result}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    responses = make_responses(args.rows)
+    codeframe = load_codeframe()
+    code_lists = [random.sample(list(codeframe.codes) + ["999", "x"], 3) for _ in range(args.rows)]
+    print(f"{args.rows:,} responses")
+
+    reference = timed("clean_response (original)", args.rows,
+                      lambda: [reference_clean_response(t) for t in responses])
+    scalar = timed("clean_response", args.rows,
+                   lambda: [clean_response(t) for t in responses])
+    batch = timed("clean_response_batch", args.rows,
+                  lambda: clean_response_batch(responses))
+    assert reference["result"] == scalar["result"] == batch["result"]
+
+    reference = timed("split_compound_response (original)", args.rows,
+                      lambda: [reference_split_compound_response(t) for t in responses])
+    scalar = timed("split_compound_response", args.rows,
+                   lambda: [split_compound_response(t) for t in responses])
+    batch = timed("split_compound_response_batch", args.rows,
+                  lambda: split_compound_response_batch(responses))
+    assert reference["result"] == scalar["result"] == batch["result"]
+
+    raw = codeframe.to_dict()
+    reference = timed("validate_code_assignment (dict)", args.rows,
+                      lambda: [validate_code_assignment(c, raw) for c in code_lists])
+    batch = timed("validate_code_assignment_batch", args.rows,
+                  lambda: validate_code_assignment_batch(code_lists, codeframe))
+    assert reference["result"] == batch["result"]
+
+    print("Outputs identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+Offline end-to-end benchmarks for the coding pipeline.
+
+Runs ClaudeCoder against the fake Anthropic clients in
+benchmarks/fake_client.py, so results are reproducible and free. Reports
+throughput, latency percentiles, tokens per response, errors and peak
+memory per scenario, and can compare a run against a saved baseline.
+
+Usage:
+    python -m benchmarks.run_benchmarks [--rows 200] [--save-baseline]
+    python -m benchmarks.run_benchmarks --compare benchmarks/baseline.json
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from benchmarks.fake_client import FakeAnthropic, FakeAsyncAnthropic
+from benchmarks.parser_benchmark import make_responses
+from llm.claude_coder import ClaudeCoder
+from llm.metrics import MetricsRecorder
+from llm.rate_limit import RateLimiter
+from utils.parser import clean_response_batch, split_compound_response_batch
+
+DEFAULT_BASELINE_PATH = "benchmarks/baseline.json"
+SCENARIOS = ("single", "stream", "batch", "packed", "cascade", "compact", "parser")
+# Fast model used by the cascade scenario, and the share of its codings made uncertain
+CASCADE_MODEL = "claude-3-haiku-20240307"
+CASCADE_LOW_CONFIDENCE_RATE = 0.3
+# Relative change tolerated before a metric counts as a regression
+DEFAULT_TOLERANCE = 0.2
+# Metrics compared against the baseline, and whether higher values are better
+COMPARED_METRICS = {
+    "rows_per_second": True,
+    "latency_p95_seconds": False,
+    "first_code_p95_seconds": False,
+    "tokens_per_response": False,
+    "output_tokens_per_response": False,
+    "cost_per_1k_responses": False,
+    "peak_memory_mb": False,
+}
+
+
+def load_questions(rows: int) -> List[Dict]:
+    """Build `rows` question/response pairs from the sample file."""
+    with open("data/sample_responses.csv", newline="", encoding="utf-8") as f:
+        samples = list(csv.DictReader(f))
+    return [
+        {"question": samples[i % len(samples)]["question"], "response": response}
+        for i, response in enumerate(clean_response_batch(make_responses(rows)))
+    ]
+
+
+def make_coder(
+    args: argparse.Namespace,
+    metrics: MetricsRecorder,
+    cascade: bool = False,
+    compact: bool = False
+) -> ClaudeCoder:
+    options = {
+        "latency_seconds": args.latency,
+        "jitter_seconds": args.jitter,
+        "rate_limit_rate": args.rate_limit_rate,
+        "malformed_rate": args.malformed_rate,
+        "output_tokens_per_second": args.output_tokens_per_second,
+        "low_confidence_rates": {"haiku": CASCADE_LOW_CONFIDENCE_RATE},
+    }
+    rate_limiter = None
+    if args.rpm or args.tpm:
+        # A private state file, so runs do not share a budget with the app
+        rate_limiter = RateLimiter(
+            path=os.path.join(tempfile.mkdtemp(), "rate_limit.sqlite"),
+            requests_per_minute=args.rpm or 10**9,
+            tokens_per_minute=args.tpm or 10**12
+        )
+    return ClaudeCoder(
+        api_key="offline",
+        use_cache=False,
+        rate_limiter=rate_limiter,
+        use_rate_limiter=rate_limiter is not None,
+        cascade_model=CASCADE_MODEL if cascade else None,
+        compact=compact,
+        metrics=metrics,
+        concurrency=args.concurrency,
+        client=FakeAnthropic(**options),
+        async_client_factory=lambda: FakeAsyncAnthropic(**options)
+    )
+
+
+def measure(
+    rows: int,
+    run: Callable[[], int],
+    metrics: MetricsRecorder = None,
+    separate_memory_run: bool = False
+) -> Dict:
+    """
+    Time a scenario and collect its metrics.
+
+    Args:
+        rows: Number of rows processed by the scenario
+        run: Callable doing the work and returning the number of failed rows
+        metrics: Recorder used by the scenario's coder, if any
+        separate_memory_run: Time the scenario without tracemalloc, then run
+            it again to measure peak memory. Used for CPU-bound scenarios,
+            which tracemalloc slows down considerably.
+
+    Returns:
+        Dictionary of benchmark results
+    """
+    if separate_memory_run:
+        started = time.perf_counter()
+        errors = run()
+        elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    if separate_memory_run:
+        run()
+    else:
+        started = time.perf_counter()
+        errors = run()
+        elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    summary = metrics.summary() if metrics else {}
+    return {
+        "rows": rows,
+        "seconds": round(elapsed, 4),
+        "rows_per_second": round(rows / elapsed, 2) if elapsed else 0.0,
+        "requests": summary.get("requests", 0),
+        "retries": summary.get("retries", 0),
+        "errors": errors,
+        "latency_p50_seconds": round(summary.get("latency_p50_seconds", 0.0), 4),
+        "latency_p95_seconds": round(summary.get("latency_p95_seconds", 0.0), 4),
+        "latency_p99_seconds": round(summary.get("latency_p99_seconds", 0.0), 4),
+        "tokens_per_response": round(summary.get("tokens_per_response", 0.0), 2),
+        "output_tokens_per_response": round(summary.get("output_tokens_per_response", 0.0), 2),
+        "cost_per_1k_responses": round(summary.get("cost_per_1k_responses", 0.0), 4),
+        "peak_memory_mb": round(peak / 1e6, 3),
+    }
+
+
+def run_scenario(name: str, args: argparse.Namespace) -> Dict:
+    metrics = MetricsRecorder()
+    if name == "parser":
+        texts = make_responses(args.parser_rows)
+
+        def run():
+            split_compound_response_batch(clean_response_batch(texts))
+            return 0
+        return measure(args.parser_rows, run, separate_memory_run=True)
+
+    coder = make_coder(args, metrics, cascade=name == "cascade", compact=name == "compact")
+    if name in ("single", "stream"):
+        rows = load_questions(args.single_rows)
+        first_code_seconds = []
+
+        def run():
+            errors = 0
+            for row in rows:
+                started = time.perf_counter()
+                if name == "single":
+                    coding = coder.code_response(row["response"], row["question"])
+                    first_code_seconds.append(time.perf_counter() - started)
+                else:
+                    first_code = None
+                    for coding in coder.stream_code_response(row["response"], row["question"]):
+                        if first_code is None and coding.get("codes"):
+                            first_code = time.perf_counter() - started
+                    first_code_seconds.append(first_code or time.perf_counter() - started)
+                errors += 1 if coding.get("error") else 0
+            return errors
+
+        result = measure(len(rows), run, metrics)
+        p50, p95 = np.percentile(first_code_seconds, [50, 95])
+        result["first_code_p50_seconds"] = round(float(p50), 4)
+        result["first_code_p95_seconds"] = round(float(p95), 4)
+        return result
+
+    rows = load_questions(args.rows)
+
+    def run():
+        return sum(
+            1 for item in coder.iter_code_responses(rows, packed=name == "packed")
+            if item["coding"].get("error")
+        )
+    result = measure(len(rows), run, metrics)
+    if name == "cascade":
+        result["fast_hit_rate"] = round(metrics.summary()["cascade"]["fast_hit_rate"], 4)
+    return result
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Find metrics that got worse than the baseline by more than `tolerance`.
+
+    Args:
+        results: Results of this run, keyed by scenario
+        baseline: Saved results, keyed by scenario
+        tolerance: Relative change tolerated
+
+    Returns:
+        Descriptions of the regressions found
+    """
+    regressions = []
+    for scenario, result in results.items():
+        reference = baseline.get("scenarios", {}).get(scenario)
+        if not reference:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = reference.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            if higher_is_better:
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance) and new - old > 1e-3
+            if worse:
+                regressions.append(f"{scenario}.{metric}: {old} -> {new}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--rows", type=int, default=200, help="Rows for the batch scenarios")
+    parser.add_argument("--single-rows", type=int, default=10, help="Rows for the sequential scenario")
+    parser.add_argument("--parser-rows", type=int, default=100_000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.2, help="Simulated API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.02)
+    parser.add_argument("--malformed-rate", type=float, default=0.01)
+    parser.add_argument("--output-tokens-per-second", type=float, default=200.0,
+                        help="Simulated generation speed after the first token")
+    parser.add_argument("--rpm", type=int, help="Apply a shared rate limiter with this many requests per minute")
+    parser.add_argument("--tpm", type=int, help="Apply a shared rate limiter with this many tokens per minute")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE_PATH)
+    parser.add_argument("--compare", metavar="BASELINE")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the coder's retry and parse-error logs")
+    args = parser.parse_args()
+    # Simulated failures are expected; keep their logs out of the report unless asked
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL, force=True)
+
+    results = {}
+    print(f"{'scenario':<10} {'rows':>7} {'rows/s':>10} {'p50':>8} {'p95':>8} {'p99':>8} "
+          f"{'1st code':>9} {'tok/resp':>9} {'out/resp':>9} {'$/1k':>8} {'errors':>7} {'peak MB':>8}")
+    for name in args.scenarios:
+        result = run_scenario(name, args)
+        results[name] = result
+        print(f"{name:<10} {result['rows']:>7} {result['rows_per_second']:>10,.1f} "
+              f"{result['latency_p50_seconds']:>8.3f} {result['latency_p95_seconds']:>8.3f} "
+              f"{result['latency_p99_seconds']:>8.3f} {result.get('first_code_p50_seconds', 0.0):>9.3f} "
+              f"{result['tokens_per_response']:>9.1f} {result['output_tokens_per_response']:>9.1f} "
+              f"{result['cost_per_1k_responses']:>8.2f} "
+              f"{result['errors']:>7} {result['peak_memory_mb']:>8.2f}")
+        if "fast_hit_rate" in result:
+            print(f"{'':<10} fast tier kept {result['fast_hit_rate']:.0%} of codings")
+
+    report = {"config": {k: v for k, v in vars(args).items() if k not in ("save_baseline", "compare", "output", "verbose")},
+              "scenarios": results}
+    for path in filter(None, (args.save_baseline, args.output)):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
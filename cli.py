@@ -0,0 +1,376 @@
+"""
+Headless batch coding from the command line.
+
+Codes a CSV or JSONL file of `question,response` rows without the Streamlit
+app. Rows are split into shards by a hash of their content; each shard is
+coded by its own process and written to its own file, and the shard files
+are merged into one results file in input order, verified to contain every
+row exactly once. With --message-batches, rows are instead submitted to the
+Message Batches API, at half the price, and collected when processed
+(within 24 hours); rerunning an interrupted command resumes it. Settings are
+read from the environment (or .env) as in the app.
+
+Usage:
+    # One machine, 4 processes
+    python cli.py code responses.csv -o outputs/run.jsonl --processes 4
+
+    # Several machines: run shard i of n on each, then merge the shard files
+    python cli.py code responses.csv -o outputs/run.jsonl --shard-index 0 --shard-count 3
+    python cli.py merge -o outputs/run.jsonl --input responses.csv
+
+    # Overnight, through the Message Batches API
+    python cli.py code responses.csv -o outputs/run.jsonl --message-batches
+
+    # Train the local classifier on stored results and see how much it could take off the API
+    python cli.py train-classifier
+    python cli.py classifier-report --run held_out_run
+"""
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from llm.classifier import (
+    DEFAULT_CLASSIFIER_PATH,
+    DEFAULT_EPOCHS,
+    REPORT_THRESHOLDS,
+    ClassifierRouter,
+    CodeClassifier,
+    train_from_store
+)
+from llm.message_batches import DEFAULT_BATCH_REQUESTS, run_message_batches
+from utils.batch import DEFAULT_CHUNK_SIZE, INPUT_FORMATS, iter_input_rows, run_batch
+from utils.codeframe import DEFAULT_CODEFRAME_PATH, load_codeframe
+from utils.results_store import DEFAULT_RESULTS_DIR, ResultsStore
+from utils.shards import find_shard_paths, merge_shards, output_format_for, shard_output_path
+from worker import build_coder
+
+
+def input_format_for(path: str) -> str:
+    """Infer the input format from a file extension, defaulting to CSV."""
+    return "jsonl" if path.lower().endswith(".jsonl") else "csv"
+
+
+def count_input_rows(path: str, input_format: str) -> int:
+    """Count the data rows of an input file."""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        return sum(1 for _ in iter_input_rows(f, input_format))
+
+
+def store_results(path: str) -> None:
+    """Add a results file to the store read by the app's Analytics tab, named after the file."""
+    store = ResultsStore(
+        load_codeframe(os.getenv("CODEFRAME_PATH", DEFAULT_CODEFRAME_PATH)),
+        os.getenv("RESULTS_STORE_DIR", DEFAULT_RESULTS_DIR)
+    )
+    with open(path, encoding="utf-8", newline="") as f:
+        stored = store.add_results_file(f, output_format_for(path), os.path.splitext(os.path.basename(path))[0])
+    logging.info(f"Results stored in {stored}")
+
+
+def code_shard(
+    input_path: str,
+    input_format: str,
+    output_path: str,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    packed: bool = False,
+    dedup: bool = False
+) -> Dict:
+    """
+    Code one shard of an input file in this process.
+
+    Args:
+        input_path: CSV or JSONL file of responses
+        input_format: 'csv' or 'jsonl'
+        output_path: Results file of this shard
+        shard_index: Shard to code
+        shard_count: Number of shards
+        chunk_size: Rows per chunk
+        packed: Code several responses per request
+        dedup: Collapse near-duplicate responses within the shard
+
+    Returns:
+        Final progress dictionary of run_batch, with 'shard_index' and
+        'output_path'
+    """
+    coder = build_coder()
+    progress = {"rows_done": 0, "errors": 0, "rows_per_second": 0.0}
+    with open(input_path, encoding="utf-8-sig", newline="") as f:
+        for progress in run_batch(
+            coder,
+            f,
+            output_path,
+            output_format=output_format_for(output_path),
+            chunk_size=chunk_size,
+            packed=packed,
+            dedup=dedup,
+            input_format=input_format,
+            shard_index=shard_index,
+            shard_count=shard_count
+        ):
+            logging.info(
+                f"Shard {shard_index + 1}/{shard_count}: {progress['rows_done']} rows, "
+                f"{progress['errors']} errors, {progress['rows_per_second']:.1f} rows/s"
+            )
+    if isinstance(coder, ClassifierRouter):
+        report = coder.report()
+        logging.info(
+            f"Shard {shard_index + 1}/{shard_count}: {report['local_responses']} responses coded by the "
+            f"classifier ({report['local_share']:.0%}), {report['api_responses']} by the API"
+        )
+    return {**progress, "shard_index": shard_index, "output_path": output_path}
+
+
+def batch_shard(
+    input_path: str,
+    input_format: str,
+    output_path: str,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    packed: bool = False,
+    batch_requests: int = DEFAULT_BATCH_REQUESTS
+) -> Dict:
+    """
+    Code one shard of an input file through the Message Batches API.
+
+    Args:
+        input_path: CSV or JSONL file of responses
+        input_format: 'csv' or 'jsonl'
+        output_path: Results file of this shard
+        shard_index: Shard to code
+        shard_count: Number of shards
+        packed: Code several responses per request
+        batch_requests: Requests per submitted batch
+
+    Returns:
+        Final progress dictionary of run_message_batches
+    """
+    coder = build_coder(route=False)
+    progress = {}
+    with open(input_path, encoding="utf-8-sig", newline="") as f:
+        for progress in run_message_batches(
+            coder,
+            f,
+            output_path,
+            output_format=output_format_for(output_path),
+            input_format=input_format,
+            packed=packed,
+            shard_index=shard_index,
+            shard_count=shard_count,
+            max_requests=batch_requests
+        ):
+            logging.info(
+                f"Batches: {progress['batches_done']}/{progress['batches']} done, "
+                f"{progress['rows_done']}/{progress['rows_submitted']} rows collected, "
+                f"{progress['errors']} errors"
+            )
+    return progress
+
+
+def run_code(args: argparse.Namespace) -> int:
+    input_format = args.input_format or input_format_for(args.input)
+    output_format_for(args.output)
+    if not 0 <= args.shard_index < args.shard_count:
+        raise ValueError(f"--shard-index must be between 0 and {args.shard_count - 1}")
+
+    if args.message_batches:
+        if args.processes > 1 or args.dedup:
+            raise ValueError("--processes and --dedup cannot be used with --message-batches")
+        output_path = args.output
+        if args.shard_count > 1:
+            output_path = shard_output_path(args.output, args.shard_index, args.shard_count)
+        batch_shard(args.input, input_format, output_path, args.shard_index, args.shard_count,
+                    args.packed, args.batch_requests)
+        logging.info(f"Results written to {output_path}")
+        if args.shard_count > 1:
+            logging.info(
+                f"When every machine has finished, merge with: "
+                f"python cli.py merge -o {args.output} --input {args.input}{' --store' if args.store else ''}"
+            )
+        elif args.store:
+            store_results(args.output)
+        return 0
+
+    # Each machine's shard is split again across its local processes
+    shard_count = args.shard_count * args.processes
+    shards = [args.shard_index * args.processes + p for p in range(args.processes)]
+    if shard_count == 1:
+        code_shard(args.input, input_format, args.output,
+                   chunk_size=args.chunk_size, packed=args.packed, dedup=args.dedup)
+        logging.info(f"Results written to {args.output}")
+        if args.store:
+            store_results(args.output)
+        return 0
+
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        futures = [
+            pool.submit(
+                code_shard, args.input, input_format,
+                shard_output_path(args.output, shard, shard_count),
+                shard, shard_count, args.chunk_size, args.packed, args.dedup
+            )
+            for shard in shards
+        ]
+        results = [future.result() for future in futures]
+    for result in results:
+        logging.info(
+            f"Shard {result['shard_index'] + 1}/{shard_count}: {result['rows_done']} rows "
+            f"written to {result['output_path']}"
+        )
+
+    if args.shard_count > 1:
+        logging.info(
+            f"When every machine has finished, merge with: "
+            f"python cli.py merge -o {args.output} --input {args.input}{' --store' if args.store else ''}"
+        )
+        return 0
+    return run_merge(args, expected_rows=count_input_rows(args.input, input_format))
+
+
+def run_merge(args: argparse.Namespace, expected_rows: Optional[int] = None) -> int:
+    if expected_rows is None and args.input:
+        expected_rows = count_input_rows(args.input, args.input_format or input_format_for(args.input))
+    summary = merge_shards(find_shard_paths(args.output), args.output, expected_rows)
+    logging.info(
+        f"Merged {summary['shards']} shards into {summary['output_path']}: "
+        f"{summary['rows']} rows, {summary['errors']} errors"
+    )
+    if args.store:
+        store_results(args.output)
+    return 0
+
+
+def load_classifier():
+    """
+    Load the classifier at CLASSIFIER_PATH (or a new one) and the results store.
+
+    Returns:
+        Tuple of the CodeClassifier and ResultsStore, both for the configured codeframe
+    """
+    codeframe = load_codeframe(os.getenv("CODEFRAME_PATH", DEFAULT_CODEFRAME_PATH))
+    classifier = CodeClassifier.load(os.getenv("CLASSIFIER_PATH", DEFAULT_CLASSIFIER_PATH), codeframe)
+    return classifier, ResultsStore(codeframe, os.getenv("RESULTS_STORE_DIR", DEFAULT_RESULTS_DIR))
+
+
+def log_agreement(rows) -> None:
+    logging.info("Threshold  Coded locally  Exact agreement  Code overlap")
+    for row in rows:
+        if row["agreement"] is None:
+            logging.info(f"{row['threshold']:>9.2f}  {row['coverage']:>13.1%}  {'-':>15}  {'-':>12}")
+        else:
+            logging.info(
+                f"{row['threshold']:>9.2f}  {row['coverage']:>13.1%}  "
+                f"{row['agreement']:>15.1%}  {row['overlap']:>12.1%}"
+            )
+
+
+def run_train_classifier(args: argparse.Namespace) -> int:
+    classifier, store = load_classifier()
+    missing = [name for name in args.runs or () if name not in store.names()]
+    if missing:
+        raise ValueError(f"Runs not in the results store: {', '.join(missing)}")
+    learned = train_from_store(classifier, store, args.runs, args.epochs)
+    if not learned:
+        logging.info("No new stored runs to learn from")
+        return 0
+    path = os.getenv("CLASSIFIER_PATH", DEFAULT_CLASSIFIER_PATH)
+    classifier.save(path)
+    logging.info(
+        f"Learned from {sum(learned.values())} responses of {len(learned)} runs "
+        f"({classifier.trained_responses} in total); saved to {path}"
+    )
+    log_agreement(classifier.agreement_report())
+    return 0
+
+
+def run_classifier_report(args: argparse.Namespace) -> int:
+    classifier, store = load_classifier()
+    if not classifier.trained_responses:
+        raise ValueError("The classifier has not been trained; run train-classifier first")
+    if not args.run:
+        logging.info(
+            f"Agreement with the model on {classifier.bin_counts.sum():.0f} recent responses "
+            f"predicted before they were learned from:"
+        )
+        log_agreement(classifier.agreement_report(args.thresholds))
+        return 0
+
+    if args.run not in store.names():
+        raise ValueError(f"Run not in the results store: {args.run}")
+    if args.run in classifier.trained_runs:
+        logging.warning(f"The classifier has learned from {args.run}; agreement on it is optimistic")
+    responses, questions, code_lists = [], [], []
+    for batch in store.iter_codings([args.run]):
+        responses.extend(batch[0])
+        questions.extend(batch[1])
+        code_lists.extend(batch[2])
+    report = classifier.evaluate(responses, questions, code_lists, args.thresholds)
+    logging.info(
+        f"Agreement with the model on {report['responses']} responses of {args.run}, "
+        f"classified at {report['responses_per_second']:.0f} responses/s:"
+    )
+    log_agreement(report["thresholds"])
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    code = commands.add_parser("code", help="Code a file of responses, optionally one shard of it")
+    code.add_argument("input", help="CSV or JSONL file with 'question' and 'response'")
+    code.add_argument("-o", "--output", required=True, help="Results file (.jsonl or .csv)")
+    code.add_argument("--input-format", choices=INPUT_FORMATS, help="Defaults to the input's extension")
+    code.add_argument("--processes", type=int, default=1, help="Local processes, each coding one shard")
+    code.add_argument("--shard-index", type=int, default=0, help="This machine's shard, from 0")
+    code.add_argument("--shard-count", type=int, default=1, help="Number of machines sharing the input")
+    code.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per chunk")
+    code.add_argument("--packed", action="store_true", help="Code several responses per request")
+    code.add_argument("--dedup", action="store_true", help="Collapse near-duplicate responses")
+    code.add_argument("--store", action="store_true", help="Add the merged results to the analytics store")
+    code.add_argument("--message-batches", action="store_true",
+                      help="Submit through the Message Batches API and wait for the results; rerun to resume")
+    code.add_argument("--batch-requests", type=int, default=DEFAULT_BATCH_REQUESTS,
+                      help="Requests per submitted message batch")
+
+    merge = commands.add_parser("merge", help="Merge and verify the shard files of a results file")
+    merge.add_argument("-o", "--output", required=True, help="Results file whose shards to merge")
+    merge.add_argument("--input", help="Original input, to check no trailing rows are missing")
+    merge.add_argument("--input-format", choices=INPUT_FORMATS, help="Defaults to the input's extension")
+    merge.add_argument("--store", action="store_true", help="Add the merged results to the analytics store")
+
+    train = commands.add_parser("train-classifier", help="Train the local classifier on stored results")
+    train.add_argument("--runs", nargs="+", help="Stored runs to learn from; all new runs by default")
+    train.add_argument("--epochs", type=int, default=DEFAULT_EPOCHS, help="Passes over each new run")
+
+    report = commands.add_parser("classifier-report", help="Report the local classifier's agreement with the model")
+    report.add_argument("--run", help="Stored run to evaluate on, ideally one not trained on")
+    report.add_argument("--thresholds", type=float, nargs="+", default=list(REPORT_THRESHOLDS),
+                        help="Confidence thresholds to report")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, force=True)
+    try:
+        if args.command == "code":
+            if args.processes < 1 or args.shard_count < 1:
+                raise ValueError("--processes and --shard-count must be at least 1")
+            return run_code(args)
+        if args.command == "train-classifier":
+            return run_train_classifier(args)
+        if args.command == "classifier-report":
+            return run_classifier_report(args)
+        return run_merge(args)
+    except ValueError as e:
+        logging.error(f"{args.command} failed: {str(e)}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
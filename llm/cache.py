@@ -0,0 +1,281 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+# Default location of the on-disk coding cache
+DEFAULT_CACHE_PATH = os.getenv("CODING_CACHE_PATH", ".cache/coding_cache.sqlite")
+DEFAULT_MAX_ENTRIES = 200_000
+DEFAULT_TTL_SECONDS = 30 * 24 * 3600
+# Run eviction once every this many writes
+EVICT_EVERY = 500
+# Cache hits update recency in one write per this many hits, and before eviction
+TOUCH_BATCH = 256
+
+
+def normalize_response(response: str) -> str:
+    """
+    Normalize a response for use in a cache key.
+
+    Args:
+        response: Response text
+
+    Returns:
+        Response with whitespace collapsed and trimmed
+    """
+    return " ".join(response.split())
+
+
+class CodingCache:
+    """
+    Disk-backed, content-addressed cache of coding results.
+
+    Entries are stored in SQLite so they survive app restarts and are shared
+    between worker processes. Entries expire after `ttl_seconds` and the
+    least recently used entries are dropped beyond `max_entries`.
+
+    Hits are served without writing: their access times are buffered and
+    written in batches, so a read-mostly workload does not take the write
+    lock per row. The entry count in `stats` is kept as entries are added
+    and removed, and recounted at each eviction; with several processes
+    sharing the file it can lag their writes until then.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: Optional[float] = DEFAULT_TTL_SECONDS
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        # Access times of hits not yet written, by key
+        self._touched: Dict[str, float] = {}
+        self._unflushed_hits = 0
+        # Entry count, None until first counted
+        self._entries: Optional[int] = None
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    @staticmethod
+    def make_key(
+        model_name: str,
+        temperature: float,
+        prompt_version: str,
+        codeframe_hash: str,
+        question: str,
+        response: str
+    ) -> str:
+        """
+        Build the content address for a coding request.
+
+        Args:
+            model_name: Model used for coding
+            temperature: Sampling temperature
+            prompt_version: Version of the prompt template
+            codeframe_hash: Content hash of the codeframe
+            question: The consultation question
+            response: The consultation response
+
+        Returns:
+            Hex digest identifying the request
+        """
+        payload = json.dumps([
+            model_name,
+            float(temperature),
+            prompt_version,
+            codeframe_hash,
+            question.strip(),
+            normalize_response(response)
+        ])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so reopen in child processes
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS codings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS codings_accessed ON codings (accessed_at)"
+            )
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Look up a cached coding result.
+
+        Args:
+            key: Key from make_key
+
+        Returns:
+            The cached result, or None on a miss
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute(
+                    "SELECT value, created_at FROM codings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                    if conn.execute("DELETE FROM codings WHERE key = ?", (key,)).rowcount:
+                        self._count(-1)
+                    conn.commit()
+                    self._touched.pop(key, None)
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                self._touched[key] = now
+                self._unflushed_hits += 1
+                self.hits += 1
+                if self._unflushed_hits >= TOUCH_BATCH:
+                    # The hit is served even if its flush fails; the access
+                    # times are kept and written with the next batch
+                    try:
+                        self._flush_touched(conn)
+                    except sqlite3.Error as e:
+                        logging.error(f"Coding cache write failed: {str(e)}")
+                        conn.rollback()
+                        self._unflushed_hits = 0
+            return json.loads(row[0])
+        except sqlite3.Error as e:
+            logging.error(f"Coding cache read failed: {str(e)}")
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: Dict) -> None:
+        """
+        Store a coding result.
+
+        Args:
+            key: Key from make_key
+            value: Coding result dictionary
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                serialized = json.dumps(value)
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO codings (key, value, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, serialized, now, now)
+                ).rowcount
+                if inserted:
+                    self._count(1)
+                else:
+                    conn.execute(
+                        "UPDATE codings SET value = ?, created_at = ?, accessed_at = ? WHERE key = ?",
+                        (serialized, now, now, key)
+                    )
+                conn.commit()
+                self._touched.pop(key, None)
+                self._writes += 1
+                if self._writes % EVICT_EVERY == 0:
+                    self._evict(conn, now)
+        except sqlite3.Error as e:
+            logging.error(f"Coding cache write failed: {str(e)}")
+
+    def _count(self, change: int) -> None:
+        if self._entries is not None:
+            self._entries = max(self._entries + change, 0)
+
+    def _flush_touched(self, conn: sqlite3.Connection) -> None:
+        """Write the buffered access times of hits."""
+        if not self._touched:
+            self._unflushed_hits = 0
+            return
+        conn.executemany(
+            "UPDATE codings SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+            [(accessed, key) for key, accessed in self._touched.items()]
+        )
+        conn.commit()
+        self._touched.clear()
+        self._unflushed_hits = 0
+
+    def flush(self) -> None:
+        """Write the buffered access times of hits, e.g. before shutting down."""
+        try:
+            with self._lock:
+                self._flush_touched(self._connection())
+        except sqlite3.Error as e:
+            logging.error(f"Coding cache write failed: {str(e)}")
+
+    def evict(self) -> None:
+        """Drop expired entries and trim the cache to max_entries."""
+        with self._lock:
+            self._evict(self._connection(), time.time())
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        # Recently hit entries must not be evicted for want of their access time
+        self._flush_touched(conn)
+        if self.ttl_seconds:
+            conn.execute(
+                "DELETE FROM codings WHERE created_at < ?", (now - self.ttl_seconds,)
+            )
+        if self.max_entries:
+            conn.execute(
+                """DELETE FROM codings WHERE key IN (
+                    SELECT key FROM codings ORDER BY accessed_at DESC
+                    LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,)
+            )
+        conn.commit()
+        self._entries = conn.execute("SELECT COUNT(*) FROM codings").fetchone()[0]
+
+    def clear(self) -> None:
+        """Remove every cached entry."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM codings")
+            conn.commit()
+            self._touched.clear()
+            self._unflushed_hits = 0
+            self._entries = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM codings").fetchone()[0]
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss counters for this process plus the entry count (see the class docstring)."""
+        if self._entries is None:
+            try:
+                self._entries = len(self)
+            except sqlite3.Error as e:
+                logging.error(f"Coding cache read failed: {str(e)}")
+                self._entries = 0
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": self._entries
+        }
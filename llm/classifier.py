@@ -0,0 +1,728 @@
+import copy
+import json
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from llm.retrieval import tokenize
+from utils.codeframe import Codeframe
+
+DEFAULT_CLASSIFIER_PATH = os.getenv("CLASSIFIER_PATH", ".cache/classifier.npz")
+# Largest hashed feature space; the weights are features × codes float32
+HASH_FEATURES = 2 ** 17
+# The feature space is halved from HASH_FEATURES, down to MIN_HASH_FEATURES,
+# until the weights fit in MAX_WEIGHT_BYTES, as every worker process holds a copy
+MIN_HASH_FEATURES = 2 ** 13
+MAX_WEIGHT_BYTES = 32 * 1024 * 1024
+# Responses whose calibrated confidence reaches this are coded locally
+DEFAULT_CLASSIFIER_THRESHOLD = 0.95
+# Nothing is coded locally until the classifier has learned from this many responses
+MIN_TRAINING_RESPONSES = 500
+# Mini-batch SGD settings for the per-code logistic models; the rate applies to the batch-mean gradient
+LEARNING_RATE = 30.0
+L2_PENALTY = 1e-6
+TRAINING_BATCH_SIZE = 256
+DEFAULT_EPOCHS = 5
+# Every CALIBRATION_FOLD-th response of a training run is held out to calibrate on, then learned from
+CALIBRATION_FOLD = 10
+# Calibration tallies halve in weight every this many responses, so they follow the current model
+CALIBRATION_HALF_LIFE = 5000
+# Calibration bins over a response's "nines" score, -log10(1 - score), from 0.5 to 0.9999
+CALIBRATION_EDGES = np.linspace(np.log10(2), 4.0, 25)
+# Thresholds shown in agreement reports
+REPORT_THRESHOLDS = (0.8, 0.9, 0.95, 0.98, 0.99)
+
+
+def _feature_ids(response: str, question: str, n_features: int) -> List[int]:
+    """Hash a response's word unigrams and bigrams, and its question's words, into feature IDs."""
+    terms = tokenize(response)
+    features = terms + [f"{a} {b}" for a, b in zip(terms, terms[1:])]
+    features += [f"q:{term}" for term in tokenize(question)]
+    return [zlib.crc32(feature.encode("utf-8")) % n_features for feature in features]
+
+
+def feature_space(n_codes: int) -> int:
+    """Hashed feature space for a codeframe with n_codes codes."""
+    n_features = HASH_FEATURES
+    while n_features > MIN_HASH_FEATURES and n_features * max(n_codes, 1) * 4 > MAX_WEIGHT_BYTES:
+        n_features //= 2
+    return n_features
+
+
+def _isotonic(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Weighted pool-adjacent-violators fit: the closest non-decreasing sequence."""
+    blocks: List[List[float]] = []
+    for value, weight in zip(values.tolist(), weights.tolist()):
+        blocks.append([value, weight, 1])
+        while len(blocks) > 1 and blocks[-2][0] > blocks[-1][0]:
+            value2, weight2, size2 = blocks.pop()
+            value1, weight1, size1 = blocks.pop()
+            total = weight1 + weight2
+            blocks.append([(value1 * weight1 + value2 * weight2) / total, total, size1 + size2])
+    return np.repeat([block[0] for block in blocks], [block[2] for block in blocks])
+
+
+class CodeClassifier:
+    """
+    Multi-label classifier imitating the codings of past responses.
+
+    Responses are featurized as TF-IDF over hashed word unigrams, bigrams
+    and question words, with document frequencies learned incrementally,
+    and each code has its own logistic model, trained by mini-batch SGD.
+    Everything is held in NumPy arrays: a batch is a sparse CSR matrix, so
+    scoring is a gather of weight rows and a segmented sum.
+
+    A response's raw score is the least certain of its per-code decisions,
+    min over codes of max(p, 1 - p). Responses the model has not learned
+    from yet are predicted, and whether the predicted codes match their
+    stored ones exactly is tallied by score bin: a held-out share of each
+    training run, and every response learned from online. The calibrated
+    confidence of a score is the (isotonic, smoothed) match rate of its
+    bin. The tallies decay, so they describe the current model, and being
+    out-of-sample they also give the agreement report.
+
+    Args:
+        codes: Codes to classify, e.g. a codeframe's codes
+        n_features: Size of the hashed feature space; by default sized from
+            the number of codes (see feature_space)
+    """
+
+    def __init__(self, codes: Sequence[str], n_features: Optional[int] = None):
+        self.codes = tuple(codes)
+        self.n_features = n_features or feature_space(len(self.codes))
+        self.weights = np.zeros((self.n_features, len(self.codes)), dtype=np.float32)
+        self.bias = np.zeros(len(self.codes), dtype=np.float32)
+        self.document_frequency = np.zeros(self.n_features, dtype=np.int64)
+        self.documents = 0
+        self.trained_responses = 0
+        # Decayed out-of-sample tallies per calibration bin: responses, exact matches and summed Jaccard overlap
+        bins = len(CALIBRATION_EDGES) + 1
+        self.bin_counts = np.zeros(bins)
+        self.bin_matches = np.zeros(bins)
+        self.bin_overlap = np.zeros(bins)
+        # Stored runs learned from, by name, with their modification time
+        self.trained_runs: Dict[str, float] = {}
+        self._code_ids = {code: position for position, code in enumerate(self.codes)}
+        self._calibration: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def _term_counts(self, responses: Sequence[str], questions: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Hashed term counts of a batch as a CSR matrix.
+
+        Returns:
+            Tuple of indptr, feature indices and counts
+        """
+        indptr = np.zeros(len(responses) + 1, dtype=np.int64)
+        indices = []
+        counts = []
+        for row, (response, question) in enumerate(zip(responses, questions)):
+            features, frequencies = np.unique(
+                np.array(_feature_ids(response, question, self.n_features), dtype=np.int64),
+                return_counts=True
+            )
+            indices.append(features)
+            counts.append(frequencies)
+            indptr[row + 1] = indptr[row] + len(features)
+        if not indices:
+            return indptr, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return indptr, np.concatenate(indices), np.concatenate(counts)
+
+    def _tfidf(self, indptr: np.ndarray, indices: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """Sublinear TF-IDF values of a CSR batch, L2-normalized per response."""
+        idf = np.log((1.0 + self.documents) / (1.0 + self.document_frequency[indices])) + 1.0
+        values = (1.0 + np.log(counts)) * idf
+        lengths = np.diff(indptr)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        norms = np.sqrt(np.bincount(rows, weights=values * values, minlength=len(lengths)))
+        return (values / np.maximum(norms[rows], 1e-12)).astype(np.float32)
+
+    def _logits(self, indptr: np.ndarray, indices: np.ndarray, values: np.ndarray) -> np.ndarray:
+        contributions = self.weights[indices] * values[:, None]
+        # A zero row past the end keeps reduceat valid for responses without features
+        contributions = np.vstack([contributions, np.zeros((1, len(self.codes)), dtype=np.float32)])
+        logits = np.add.reduceat(contributions, indptr[:-1], axis=0)
+        logits[np.diff(indptr) == 0] = 0.0
+        return logits + self.bias
+
+    @staticmethod
+    def _sigmoid(logits: np.ndarray) -> np.ndarray:
+        return 1.0 / (1.0 + np.exp(-np.clip(logits, -30.0, 30.0)))
+
+    def predict_proba(self, responses: Sequence[str], questions: Sequence[str]) -> np.ndarray:
+        """
+        Probability of each code for each response.
+
+        Returns:
+            Float matrix of shape (responses, codes)
+        """
+        indptr, indices, counts = self._term_counts(responses, questions)
+        return self._sigmoid(self._logits(indptr, indices, self._tfidf(indptr, indices, counts)))
+
+    @staticmethod
+    def _scores(probabilities: np.ndarray) -> np.ndarray:
+        """Raw score of each response: its least certain per-code decision."""
+        if probabilities.shape[1] == 0:
+            return np.ones(len(probabilities))
+        return np.maximum(probabilities, 1.0 - probabilities).min(axis=1)
+
+    @staticmethod
+    def _bins(scores: np.ndarray) -> np.ndarray:
+        nines = -np.log10(np.maximum(1.0 - scores, 1e-12))
+        return np.searchsorted(CALIBRATION_EDGES, nines, side="right")
+
+    def _label_matrix(self, code_lists: Sequence[Sequence[str]]) -> np.ndarray:
+        labels = np.zeros((len(code_lists), len(self.codes)), dtype=np.float32)
+        for row, codes in enumerate(code_lists):
+            columns = [self._code_ids[code] for code in codes if code in self._code_ids]
+            labels[row, columns] = 1.0
+        return labels
+
+    @staticmethod
+    def _agreement(predicted: np.ndarray, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact-match flags and Jaccard overlap of predicted and stored code sets."""
+        union = (predicted | labels).sum(axis=1)
+        overlap = np.where(union > 0, (predicted & labels).sum(axis=1) / np.maximum(union, 1), 1.0)
+        return (predicted == labels).all(axis=1), overlap
+
+    def calibration(self) -> np.ndarray:
+        """Calibrated confidence of each score bin, non-decreasing with the score."""
+        if self._calibration is None:
+            # Smoothed towards 1/2 so sparse bins are not trusted
+            rates = (self.bin_matches + 1.0) / (self.bin_counts + 2.0)
+            self._calibration = _isotonic(rates, self.bin_counts + 2.0)
+        return self._calibration
+
+    def confidence(self, probabilities: np.ndarray) -> np.ndarray:
+        """
+        Calibrated confidence that each predicted code set is the one the
+        model would assign; 0 until MIN_TRAINING_RESPONSES have been learned.
+        """
+        if self.trained_responses < MIN_TRAINING_RESPONSES:
+            return np.zeros(len(probabilities))
+        return self.calibration()[self._bins(self._scores(probabilities))]
+
+    def predict(self, responses: Sequence[str], questions: Sequence[str]) -> Tuple[List[Dict], np.ndarray]:
+        """
+        Code a batch of responses.
+
+        Args:
+            responses: Cleaned response texts
+            questions: The question each response answers
+
+        Returns:
+            Tuple of a coding result per response, in the coder's format
+            with probabilities as confidences and 'coded_by' set to
+            'classifier', and the calibrated confidence of each
+        """
+        with self._lock:
+            probabilities = self.predict_proba(responses, questions)
+            confidence = self.confidence(probabilities)
+        codings = []
+        for row in probabilities:
+            codes = [self.codes[position] for position in np.flatnonzero(row >= 0.5)]
+            codings.append({
+                "codes": codes,
+                "confidence": {code: round(float(row[self._code_ids[code]]), 3) for code in codes},
+                "explanation": {},
+                "relevant_quotes": {},
+                "error": None,
+                "coded_by": "classifier"
+            })
+        return codings, confidence
+
+    def _tally(self, probabilities: np.ndarray, labels: np.ndarray) -> None:
+        """Add the outcome of predicting unseen responses to the calibration tallies."""
+        exact, overlap = self._agreement(probabilities >= 0.5, labels > 0)
+        bins = self._bins(self._scores(probabilities))
+        decay = 0.5 ** (len(labels) / CALIBRATION_HALF_LIFE)
+        size = len(self.bin_counts)
+        self.bin_counts = self.bin_counts * decay + np.bincount(bins, minlength=size)
+        self.bin_matches = self.bin_matches * decay + np.bincount(bins, weights=exact, minlength=size)
+        self.bin_overlap = self.bin_overlap * decay + np.bincount(bins, weights=overlap, minlength=size)
+        self._calibration = None
+
+    def partial_fit(
+        self,
+        responses: Sequence[str],
+        questions: Sequence[str],
+        code_lists: Sequence[Sequence[str]],
+        calibrate: bool = True,
+        new: bool = True
+    ) -> None:
+        """
+        Learn from a batch of coded responses with one SGD step.
+
+        Args:
+            responses: Cleaned response texts
+            questions: The question each response answers
+            code_lists: Codes assigned to each response
+            calibrate: Tally how the batch is predicted before learning from it
+            new: The responses were not learned from before; off for repeat
+                passes, so they are not counted twice in document frequencies
+        """
+        if not len(responses):
+            return
+        with self._lock:
+            indptr, indices, counts = self._term_counts(responses, questions)
+            labels = self._label_matrix(code_lists)
+            if new:
+                self.documents += len(responses)
+                self.trained_responses += len(responses)
+                np.add.at(self.document_frequency, indices, 1)
+            values = self._tfidf(indptr, indices, counts)
+            probabilities = self._sigmoid(self._logits(indptr, indices, values))
+            if calibrate:
+                self._tally(probabilities, labels)
+
+            # Gradient of the mean log loss, summed per feature over the batch
+            errors = (probabilities - labels) / len(responses)
+            rows = np.repeat(np.arange(len(responses)), np.diff(indptr))
+            order = np.argsort(indices, kind="stable")
+            sorted_indices = indices[order]
+            if len(sorted_indices):
+                starts = np.flatnonzero(np.r_[True, sorted_indices[1:] != sorted_indices[:-1]])
+                gradients = np.add.reduceat((values[:, None] * errors[rows])[order], starts, axis=0)
+                features = sorted_indices[starts]
+                self.weights[features] -= LEARNING_RATE * (gradients + L2_PENALTY * self.weights[features])
+            self.bias -= LEARNING_RATE * errors.sum(axis=0)
+
+    def calibrate(self, responses: Sequence[str], questions: Sequence[str], code_lists: Sequence[Sequence[str]]) -> None:
+        """Tally how responses not learned from are predicted, without learning from them."""
+        if not len(responses):
+            return
+        with self._lock:
+            self._tally(self.predict_proba(responses, questions), self._label_matrix(code_lists))
+
+    def fit_batches(self, batches: Iterable[Tuple[List[str], List[str], List[List[str]]]], epochs: int = DEFAULT_EPOCHS) -> int:
+        """
+        Learn from batches of (responses, questions, code lists), e.g. a stored run.
+
+        Every CALIBRATION_FOLD-th response is held out while the rest are
+        learned from for `epochs` shuffled passes; the held-out responses
+        are then predicted for calibration and learned from once. The
+        batches are held in memory meanwhile.
+
+        Returns:
+            Number of responses learned from
+        """
+        training = []
+        held_out = ([], [], [])
+        for responses, questions, code_lists in batches:
+            for start in range(0, len(responses), TRAINING_BATCH_SIZE):
+                batch = ([], [], [])
+                for offset, example in enumerate(zip(
+                    responses[start:start + TRAINING_BATCH_SIZE],
+                    questions[start:start + TRAINING_BATCH_SIZE],
+                    code_lists[start:start + TRAINING_BATCH_SIZE]
+                )):
+                    target = held_out if (start + offset) % CALIBRATION_FOLD == 0 else batch
+                    for column, value in zip(target, example):
+                        column.append(value)
+                self.partial_fit(*batch, calibrate=False)
+                training.append(batch)
+        for _ in range(epochs - 1):
+            random.shuffle(training)
+            for batch in training:
+                self.partial_fit(*batch, calibrate=False, new=False)
+
+        self.calibrate(*held_out)
+        for start in range(0, len(held_out[0]), TRAINING_BATCH_SIZE):
+            self.partial_fit(*(column[start:start + TRAINING_BATCH_SIZE] for column in held_out), calibrate=False)
+        return sum(len(batch[0]) for batch in training) + len(held_out[0])
+
+    def agreement_report(self, thresholds: Sequence[float] = REPORT_THRESHOLDS) -> List[Dict]:
+        """
+        Traffic the classifier would take off the API at each threshold,
+        and how often it agrees with the model there.
+
+        Based on the calibration tallies, i.e. responses predicted before
+        they were learned from, weighted towards the most recent.
+
+        Returns:
+            One dictionary per threshold with 'threshold', 'coverage' (share
+            of responses coded locally), 'agreement' (exact match rate of
+            those) and 'overlap' (mean Jaccard overlap of their code sets)
+        """
+        return agreement_by_threshold(
+            self.calibration(), self.bin_counts, self.bin_matches, self.bin_overlap, thresholds
+        )
+
+    def evaluate(
+        self,
+        responses: Sequence[str],
+        questions: Sequence[str],
+        code_lists: Sequence[Sequence[str]],
+        thresholds: Sequence[float] = REPORT_THRESHOLDS
+    ) -> Dict:
+        """
+        Compare predictions on held-out coded responses with their codes.
+
+        Returns:
+            Dictionary with 'responses', 'responses_per_second' (featurizing
+            and scoring) and 'thresholds', rows as in agreement_report
+        """
+        started = time.perf_counter()
+        probabilities = self.predict_proba(responses, questions)
+        elapsed = time.perf_counter() - started
+        exact, overlap = self._agreement(probabilities >= 0.5, self._label_matrix(code_lists) > 0)
+        bins = self._bins(self._scores(probabilities))
+        size = len(self.bin_counts)
+        return {
+            "responses": len(responses),
+            "responses_per_second": len(responses) / elapsed if elapsed > 0 else 0.0,
+            "thresholds": agreement_by_threshold(
+                self.calibration(),
+                np.bincount(bins, minlength=size),
+                np.bincount(bins, weights=exact, minlength=size),
+                np.bincount(bins, weights=overlap, minlength=size),
+                thresholds
+            )
+        }
+
+    def with_codes(self, codes: Sequence[str]) -> "CodeClassifier":
+        """Return this classifier over another code list, e.g. after a codeframe edit; new codes start untrained."""
+        if tuple(codes) == self.codes:
+            return self
+        classifier = CodeClassifier(codes, self.n_features)
+        for name in ("document_frequency", "documents", "trained_responses", "bin_counts",
+                     "bin_matches", "bin_overlap", "trained_runs"):
+            setattr(classifier, name, getattr(self, name))
+        for position, code in enumerate(classifier.codes):
+            if code in self._code_ids:
+                classifier.weights[:, position] = self.weights[:, self._code_ids[code]]
+                classifier.bias[position] = self.bias[self._code_ids[code]]
+        return classifier
+
+    def save(self, path: str = DEFAULT_CLASSIFIER_PATH) -> None:
+        """Save the classifier atomically."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        metadata = {
+            "codes": self.codes,
+            "n_features": self.n_features,
+            "documents": self.documents,
+            "trained_responses": self.trained_responses,
+            "trained_runs": self.trained_runs
+        }
+        temp_path = f"{path}.tmp"
+        with self._lock, open(temp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                metadata=np.array(json.dumps(metadata)),
+                weights=self.weights,
+                bias=self.bias,
+                document_frequency=self.document_frequency,
+                bin_counts=self.bin_counts,
+                bin_matches=self.bin_matches,
+                bin_overlap=self.bin_overlap
+            )
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_CLASSIFIER_PATH, codeframe: Optional[Codeframe] = None) -> "CodeClassifier":
+        """
+        Load a saved classifier, or create an untrained one if there is none.
+
+        Args:
+            path: Saved classifier
+            codeframe: Codeframe to classify with; its codes replace the saved ones
+
+        Returns:
+            CodeClassifier
+        """
+        if not os.path.exists(path):
+            if codeframe is None:
+                raise ValueError(f"No classifier saved at {path}")
+            return cls(codeframe.codes)
+        with np.load(path) as saved:
+            metadata = json.loads(str(saved["metadata"]))
+            classifier = cls(metadata["codes"], metadata["n_features"])
+            classifier.weights = saved["weights"]
+            classifier.bias = saved["bias"]
+            classifier.document_frequency = saved["document_frequency"]
+            classifier.bin_counts = saved["bin_counts"]
+            classifier.bin_matches = saved["bin_matches"]
+            classifier.bin_overlap = saved["bin_overlap"]
+        classifier.documents = metadata["documents"]
+        classifier.trained_responses = metadata["trained_responses"]
+        classifier.trained_runs = metadata["trained_runs"]
+        if codeframe is not None:
+            classifier = classifier.with_codes(codeframe.codes)
+        return classifier
+
+
+def agreement_by_threshold(
+    calibration: np.ndarray,
+    counts: np.ndarray,
+    matches: np.ndarray,
+    overlap: np.ndarray,
+    thresholds: Sequence[float] = REPORT_THRESHOLDS
+) -> List[Dict]:
+    """
+    Coverage and agreement at each threshold, from per-bin tallies.
+
+    Args:
+        calibration: Calibrated confidence of each bin
+        counts: Responses per bin
+        matches: Exact matches per bin
+        overlap: Summed Jaccard overlap per bin
+        thresholds: Confidence thresholds to report
+
+    Returns:
+        One dictionary per threshold with 'threshold', 'coverage',
+        'agreement' and 'overlap' (None where nothing is covered)
+    """
+    total = max(int(counts.sum()), 1)
+    rows = []
+    for threshold in thresholds:
+        covered = calibration >= threshold
+        local = counts[covered].sum()
+        rows.append({
+            "threshold": threshold,
+            "coverage": float(local / total),
+            "agreement": float(matches[covered].sum() / local) if local else None,
+            "overlap": float(overlap[covered].sum() / local) if local else None
+        })
+    return rows
+
+
+def train_from_store(
+    classifier: CodeClassifier,
+    store,
+    names: Optional[Sequence[str]] = None,
+    epochs: int = DEFAULT_EPOCHS
+) -> Dict[str, int]:
+    """
+    Learn from the stored runs the classifier has not learned from yet.
+
+    A run is learned from again if it was rewritten since. Rows with errors
+    are skipped.
+
+    Args:
+        classifier: Classifier to update
+        store: ResultsStore holding coded runs
+        names: Runs to consider; all by default
+        epochs: Passes over each new run
+
+    Returns:
+        Responses learned from, by run name
+    """
+    learned = {}
+    for name, modified in store.signature(names):
+        if classifier.trained_runs.get(name) == modified:
+            continue
+        learned[name] = classifier.fit_batches(store.iter_codings([name]), epochs)
+        classifier.trained_runs[name] = modified
+        logging.info(f"Classifier learned from {learned[name]} responses of {name}")
+    return learned
+
+
+class ClassifierRouter:
+    """
+    Code responses with the local classifier where it is confident enough,
+    and with ClaudeCoder otherwise.
+
+    The router can be used in place of the coder in run_batch and
+    code_chunk. A share (`audit_rate`) of the responses the classifier is
+    confident about is sent to the coder too, to keep measuring agreement
+    on the traffic it takes.
+
+    The router does not learn: the classifier is only updated by
+    train_from_store (`cli.py train-classifier`), from the API's codings in
+    the results store. With `path`, the router reloads the classifier when
+    the saved file changes, so running workers pick up retraining.
+
+    Args:
+        classifier: Trained CodeClassifier
+        coder: ClaudeCoder for everything else
+        threshold: Calibrated confidence needed to code locally
+        audit_rate: Share of confident responses also sent to the coder
+        path: Saved classifier to reload when it changes
+    """
+
+    def __init__(
+        self,
+        classifier: CodeClassifier,
+        coder,
+        threshold: float = DEFAULT_CLASSIFIER_THRESHOLD,
+        audit_rate: float = 0.0,
+        path: Optional[str] = None
+    ):
+        self.classifier = classifier
+        self.coder = coder
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.path = path
+        self._loaded_mtime = self._saved_mtime()
+        self._reload_lock = threading.Lock()
+        self._random = random.Random(0)
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "classified": 0, "local_responses": 0, "api_responses": 0, "audited": 0, "audit_matches": 0,
+            "classifier_seconds": 0.0, "api_seconds": 0.0
+        }
+
+    def __getattr__(self, name: str):
+        # Everything else (codeframe, codeframe_hash, metrics...) is the coder's;
+        # copying looks up special methods before the coder is set
+        if name.startswith("__") or "coder" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.coder, name)
+
+    def with_options(self, **options) -> "ClassifierRouter":
+        """Return a router sharing this classifier and stats, around a copy of the coder with some settings changed."""
+        router = copy.copy(self)
+        router.coder = self.coder.with_options(**options)
+        if "codeframe" in options:
+            router.classifier = self.classifier.with_codes(router.coder.codeframe.codes)
+        return router
+
+    def _saved_mtime(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.path) if self.path else None
+        except OSError:
+            return None
+
+    def _reload(self) -> None:
+        """Load the saved classifier again if it was rewritten, e.g. by train-classifier."""
+        modified = self._saved_mtime()
+        if modified is None or modified == self._loaded_mtime:
+            return
+        with self._reload_lock:
+            if modified == self._loaded_mtime:
+                return
+            try:
+                self.classifier = CodeClassifier.load(self.path, self.coder.codeframe)
+                logging.info(f"Reloaded the classifier from {self.path}")
+            except Exception as e:
+                logging.error(f"Error reloading the classifier: {str(e)}")
+            self._loaded_mtime = modified
+
+    def _count(self, **amounts) -> None:
+        with self._stats_lock:
+            for key, amount in amounts.items():
+                self.stats[key] += amount
+
+    def route(self, items: Sequence[Dict]) -> Tuple[List[Optional[Dict]], List[Optional[Dict]]]:
+        """
+        Classify a batch of responses.
+
+        Args:
+            items: Dictionaries with 'question' and 'response'
+
+        Returns:
+            Tuple of the local coding of each response (None where it goes
+            to the coder), and the classifier's coding of each audited response
+        """
+        if not items:
+            return [], []
+        self._reload()
+        started = time.perf_counter()
+        codings, confidence = self.classifier.predict(
+            [item["response"] for item in items], [item["question"] for item in items]
+        )
+        local: List[Optional[Dict]] = [None] * len(items)
+        audits: List[Optional[Dict]] = [None] * len(items)
+        for position, coding in enumerate(codings):
+            if confidence[position] < self.threshold:
+                continue
+            if self.audit_rate and self._random.random() < self.audit_rate:
+                audits[position] = coding
+            else:
+                local[position] = coding
+        self._count(
+            classified=len(items),
+            local_responses=sum(1 for coding in local if coding is not None),
+            classifier_seconds=time.perf_counter() - started
+        )
+        return local, audits
+
+    def _audit(self, codings: List[Dict], audits: List[Optional[Dict]]) -> None:
+        """Count the coder's codings, and how many audited ones the classifier matched."""
+        audited = [(audit, coding) for audit, coding in zip(audits, codings) if audit is not None and not coding.get("error")]
+        self._count(
+            api_responses=len(codings),
+            audited=len(audited),
+            audit_matches=sum(1 for audit, coding in audited if set(audit["codes"]) == set(coding["codes"]))
+        )
+
+    def code_response(self, response: str, question: str) -> Dict:
+        """Code one response, locally if the classifier is confident enough."""
+        local, audits = self.route([{"question": question, "response": response}])
+        if local[0] is not None:
+            return local[0]
+        started = time.perf_counter()
+        coding = self.coder.code_response(response, question)
+        self._count(api_seconds=time.perf_counter() - started)
+        self._audit([coding], audits)
+        return coding
+
+    def iter_code_responses(
+        self,
+        responses: Iterable[Dict],
+        concurrency: Optional[int] = None,
+        packed: bool = False
+    ) -> Iterator[Dict]:
+        """
+        Code responses, yielding local codings first and then the coder's in
+        completion order, each with its input 'index'.
+
+        Args:
+            responses: Iterable of dictionaries containing 'question' and 'response'
+            concurrency: Maximum concurrent API requests
+            packed: Code several responses per API request
+
+        Yields:
+            Dictionaries with 'index', 'question', 'response' and 'coding'
+        """
+        items = list(responses)
+        local, audits = self.route(items)
+        remote = []
+        for index, (item, coding) in enumerate(zip(items, local)):
+            if coding is None:
+                remote.append(index)
+            else:
+                yield {"index": index, "question": item["question"], "response": item["response"], "coding": coding}
+        if not remote:
+            return
+
+        started = time.perf_counter()
+        coded = [None] * len(remote)
+        for result in self.coder.iter_code_responses((items[index] for index in remote), concurrency, packed):
+            position = result["index"]
+            coded[position] = result["coding"]
+            yield {**result, "index": remote[position]}
+        self._count(api_seconds=time.perf_counter() - started)
+        self._audit(coded, [audits[index] for index in remote])
+
+    def report(self) -> Dict:
+        """
+        Routing summary.
+
+        Returns:
+            Counts of responses coded locally and by the API, the local
+            share, the responses per second classified and coded by the
+            API, and the audited agreement rate (None without audits)
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        total = stats["local_responses"] + stats["api_responses"]
+        return {
+            **stats,
+            "local_share": stats["local_responses"] / total if total else 0.0,
+            "classifier_responses_per_second": (
+                stats["classified"] / stats["classifier_seconds"] if stats["classifier_seconds"] else 0.0
+            ),
+            "api_responses_per_second": (
+                stats["api_responses"] / stats["api_seconds"] if stats["api_seconds"] else 0.0
+            ),
+            "audit_agreement": stats["audit_matches"] / stats["audited"] if stats["audited"] else None
+        }
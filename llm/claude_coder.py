@@ -1,10 +1,25 @@
 import anthropic
+import asyncio
+import copy
 import json
-from typing import List, Dict, Optional
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 import os
 import logging
+import random
 import sys
-from functools import lru_cache
+import threading
+import time
+
+from llm.cache import CodingCache
+from llm.metrics import DEFAULT_METRICS, MetricsRecorder, usage_tokens
+from llm.rate_limit import AdaptiveConcurrency, RateLimiter
+from llm.retrieval import CandidateIndex, get_candidate_index
+from llm.streaming import IncrementalJSONParser
+from utils.codeframe import Codeframe, load_codeframe
+from utils.dedup import DEFAULT_SIMILARITY_THRESHOLD, cluster_responses
+from utils.parser import validate_code_assignment
+from utils.tracing import profiled, span
 
 # Configure logging
 logging.basicConfig(
@@ -14,164 +29,1415 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Maximum number of requests in flight during a batch run
+DEFAULT_CONCURRENCY = 8
+# Retries for rate-limited, overloaded or failed connections, with exponential backoff
+DEFAULT_MAX_RETRIES = 2
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# Estimated input tokens of responses sent in a single packed request
+DEFAULT_PACK_TOKEN_BUDGET = 3000
+# Upper bound on responses per packed request
+MAX_PACK_SIZE = 40
+# Estimated output tokens per coded response in a packed reply
+PACK_OUTPUT_TOKENS_PER_RESPONSE = 250
+# The same in compact mode, where only codes and confidences are returned
+COMPACT_OUTPUT_TOKENS_PER_RESPONSE = 40
+# Responses scored together when shortlisting candidate codes
+SHORTLIST_BATCH_SIZE = 256
+# Stands in for the codeframe in the system prompt when codes are shortlisted per response
+SHORTLIST_CODEFRAME_NOTE = "Each response is sent with its own candidate codes. Only assign codes from those candidates."
+# In cascade mode, fast-tier codings with any confidence below this are escalated
+DEFAULT_ESCALATION_THRESHOLD = 0.7
+# Bump whenever the prompt or output format changes so cached codings are not reused
+PROMPT_VERSION = "3"
+# Coder attributes computed from other settings; with_options recomputes them
+DERIVED_OPTIONS = ("codeframe_hash", "concurrency_control")
+# Settings the shared clients were created with, which a copy cannot change
+FIXED_OPTIONS = ("api_key",)
+# Tools the model is made to call, so codings follow a schema instead of free-form JSON
+CODING_TOOL = "record_coding"
+PACKED_CODING_TOOL = "record_codings"
+EXPLANATION_TOOL = "record_explanations"
+
+# Static instructions sent as a cached system prefix; {categories} is the compact
+# codeframe and {code_details} lists what to return for each assigned code
+SYSTEM_PROMPT = """You are an expert at coding consultation responses. Your task is to analyze each response you are given and assign the most appropriate codes from the provided codeframe.
+
+Codeframe Categories and Codes:
+{categories}
+
+Instructions:
+1. Carefully analyze the response, even if it contains extra information or is verbose.
+2. Focus on the core meaning and intent of the response, ignoring any irrelevant details.
+3. Assign codes based on the actual content and meaning, not just keywords.
+4. For each assigned code:
+{code_details}
+5. Only assign codes that are clearly supported by the response content.
+6. If the response is unclear or doesn't match any codes, return an empty codes list.
+7. Record your coding by calling the record_coding tool, or record_codings when you are given several responses."""
+
+FULL_CODE_DETAILS = """   - Provide a confidence score (0.0 to 1.0)
+   - Explain why this code is appropriate
+   - Include the most relevant quote from the response"""
+COMPACT_CODE_DETAILS = """   - Provide a confidence score (0.0 to 1.0)"""
+
+EXPLANATION_PROPERTIES = {
+    "explanation": {
+        "type": "object",
+        "additionalProperties": {"type": "string"},
+        "description": "Why each assigned code is appropriate, keyed by code"
+    },
+    "relevant_quotes": {
+        "type": "object",
+        "additionalProperties": {"type": "string"},
+        "description": "The most relevant quote from the response, keyed by code"
+    }
+}
+
+
+def coding_schema(compact: bool = False) -> Dict:
+    """
+    JSON schema of a single coding result.
+
+    Args:
+        compact: Return only codes and confidences
+
+    Returns:
+        JSON schema for a tool input
+    """
+    properties = {
+        "codes": {
+            "type": "array",
+            "items": {"type": "string"},
+            "description": "Codes from the codeframe that apply to the response"
+        },
+        "confidence": {
+            "type": "object",
+            "additionalProperties": {"type": "number", "minimum": 0, "maximum": 1},
+            "description": "Confidence score for each assigned code, keyed by code"
+        }
+    }
+    if not compact:
+        properties.update(EXPLANATION_PROPERTIES)
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+@lru_cache(maxsize=2)
+def coding_tools(compact: bool = False) -> List[Dict]:
+    """
+    Tool definitions sent with every request.
+
+    All tools are always sent so that every request shares one cached prompt
+    prefix; tool_choice selects the one the model must call.
+
+    Args:
+        compact: Omit explanations and quotes from codings
+
+    Returns:
+        Tool definitions for messages.create
+    """
+    return [
+        {
+            "name": CODING_TOOL,
+            "description": "Record the coding of one consultation response.",
+            "input_schema": coding_schema(compact)
+        },
+        {
+            "name": PACKED_CODING_TOOL,
+            "description": "Record the codings of several consultation responses.",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "results": {
+                        "type": "object",
+                        "additionalProperties": coding_schema(compact),
+                        "description": "Coding of each response, keyed by response ID"
+                    }
+                },
+                "required": ["results"]
+            }
+        },
+        {
+            "name": EXPLANATION_TOOL,
+            "description": "Record why each given code applies to a response, with the most relevant quote.",
+            "input_schema": {
+                "type": "object",
+                "properties": EXPLANATION_PROPERTIES,
+                "required": list(EXPLANATION_PROPERTIES)
+            }
+        }
+    ]
+
+
 class ClaudeCoder:
     def __init__(
         self,
         api_key: str,
         model_name: str = "claude-3-opus-20240229",
         max_tokens: int = 4000,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        pack_token_budget: int = DEFAULT_PACK_TOKEN_BUDGET,
+        cache: Optional[CodingCache] = None,
+        use_cache: bool = True,
+        shortlist_k: Optional[int] = None,
+        always_include_categories: Optional[List[str]] = None,
+        codeframe: Optional[Codeframe] = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        metrics: Optional[MetricsRecorder] = None,
+        client: Optional[anthropic.Anthropic] = None,
+        async_client_factory: Optional[Callable[[], anthropic.AsyncAnthropic]] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        use_rate_limiter: bool = True,
+        cascade_model: Optional[str] = None,
+        escalation_threshold: float = DEFAULT_ESCALATION_THRESHOLD,
+        compact: bool = False
     ):
-        self.client = anthropic.Anthropic(api_key=api_key)
+        self.api_key = api_key
+        # Retries are handled here rather than in the SDK so they can be counted
+        self.client = client if client is not None else anthropic.Anthropic(api_key=api_key, max_retries=0)
+        self._async_client_factory = async_client_factory
+        self.max_retries = max_retries
+        self.metrics = metrics if metrics is not None else DEFAULT_METRICS
+        self._local = threading.local()
         self.model_name = model_name
+        # Cascade mode: code with the fast model first, escalating to model_name
+        # when the result is invalid or any confidence is below the threshold
+        self.cascade_model = cascade_model
+        self.escalation_threshold = escalation_threshold
         self.max_tokens = max_tokens
         self.temperature = temperature
-        self.codeframe = self._load_codeframe()
+        # Compact mode returns only codes and confidences; see explain_codes
+        self.compact = compact
+        self.concurrency = concurrency
+        # Shrinks the in-flight window on 429/529 and grows it back up to `concurrency`
+        self.concurrency_control = AdaptiveConcurrency(concurrency)
+        # Requests and tokens per minute, shared with every session and process
+        if not use_rate_limiter:
+            self.rate_limiter = None
+        else:
+            self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.pack_token_budget = pack_token_budget
+        self.codeframe = codeframe if codeframe is not None else self._load_codeframe()
+        self.codeframe_hash = self.codeframe.content_hash
+        if not use_cache:
+            self.cache = None
+        else:
+            self.cache = cache if cache is not None else CodingCache()
+        self._system_prefix = None
+        self._system_prefix_version = None
+        # Send only the top-k candidate codes per response instead of the whole codeframe
+        self.shortlist_k = shortlist_k
+        self.always_include_categories = list(always_include_categories or [])
 
-    def _load_codeframe(self):
+    def _load_codeframe(self) -> Codeframe:
         try:
-            with open("data/codeframe.json", "r") as f:
-                return json.load(f)
+            return load_codeframe("data/codeframe.json")
         except Exception as e:
             logging.error(f"Error loading codeframe: {str(e)}")
-            return {"categories": {}}
+            return Codeframe({"categories": {}})
+
+    def _make_async_client(self) -> anthropic.AsyncAnthropic:
+        """
+        Create an async client for a single batch run.
+
+        The async client's connection pool is bound to the event loop it is
+        first used on, so each batch run gets its own client.
+        """
+        if self._async_client_factory is not None:
+            return self._async_client_factory()
+        return anthropic.AsyncAnthropic(api_key=self.api_key, max_retries=0)
+
+    def _system_blocks(self) -> List[Dict]:
+        """
+        Return the system prompt blocks for the current codeframe.
+
+        Only the codeframe categories are included, serialized compactly, and
+        the block is marked for prompt caching so repeated calls reuse it. The
+        blocks are rebuilt only when the codeframe hash, output mode or
+        shortlisting changes. When codes are shortlisted, the codeframe is
+        omitted and candidates are sent with each response instead.
+
+        Returns:
+            System content blocks for messages.create
+        """
+        version = (self.codeframe_hash, self.compact, bool(self.shortlist_k))
+        if self._system_prefix_version != version:
+            if self.shortlist_k:
+                categories = SHORTLIST_CODEFRAME_NOTE
+            else:
+                categories = self.codeframe.compact_json
+            code_details = COMPACT_CODE_DETAILS if self.compact else FULL_CODE_DETAILS
+            self._system_prefix = [
+                {
+                    "type": "text",
+                    "text": SYSTEM_PROMPT.format(categories=categories, code_details=code_details),
+                    "cache_control": {"type": "ephemeral"}
+                }
+            ]
+            self._system_prefix_version = version
+        return self._system_prefix
+
+    @staticmethod
+    def _compact_json(value) -> str:
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+    @property
+    def prompt_version(self) -> str:
+        """Prompt template version, including the shortlisting, cascade and output mode."""
+        version = PROMPT_VERSION
+        if self.shortlist_k:
+            always = ",".join(sorted(self.always_include_categories))
+            version += f":shortlist={self.shortlist_k}:{always}"
+        if self.cascade_model:
+            version += f":cascade={self.cascade_model}@{self.escalation_threshold}"
+        if self.compact:
+            version += ":compact"
+        return version
+
+    def with_options(self, **options) -> "ClaudeCoder":
+        """
+        Return a copy of this coder with some settings changed.
+
+        The copy shares the clients, cache, metrics and rate limiter, e.g.
+        `coder.with_options(compact=True)` for a bulk run. Settings derived
+        from the changed ones, such as the codeframe hash, are recomputed.
+
+        Args:
+            **options: Attributes to change, such as compact or model_name
+
+        Returns:
+            The new coder
+
+        Raises:
+            AttributeError: If an option is not a coder setting
+            ValueError: If an option is derived from other settings or fixed
+                by the shared clients
+        """
+        coder = copy.copy(self)
+        for name, value in options.items():
+            if not hasattr(self, name) or name.startswith("_"):
+                raise AttributeError(f"Unknown coder option: {name}")
+            if name in DERIVED_OPTIONS or name in FIXED_OPTIONS:
+                raise ValueError(f"Coder option {name} cannot be changed on a copy")
+            setattr(coder, name, value)
+        if "codeframe" in options:
+            coder.codeframe_hash = coder.codeframe.content_hash
+        if "concurrency" in options:
+            coder.concurrency_control = AdaptiveConcurrency(coder.concurrency)
+        coder._local = threading.local()
+        coder._system_prefix = None
+        coder._system_prefix_version = None
+        return coder
+
+    def _candidate_index(self) -> CandidateIndex:
+        return get_candidate_index(self.codeframe_hash, self.codeframe.categories)
+
+    def shortlist(self, responses: List[str]) -> List[Optional[List[str]]]:
+        """
+        Pick candidate codes for a batch of responses in one scoring pass.
+
+        Args:
+            responses: Response texts
+
+        Returns:
+            Candidate codes per response, or None for each response when
+            shortlisting is disabled or the response matches no code
+        """
+        if not self.shortlist_k:
+            return [None] * len(responses)
+        with span("shortlist", responses=len(responses), k=self.shortlist_k):
+            return self._candidate_index().top_k(
+                responses,
+                k=self.shortlist_k,
+                always_include=self.always_include_categories
+            )
+
+    def _attach_candidates(self, items: Iterable) -> Iterator:
+        """Add shortlisted 'candidates' to (index, item) pairs, scoring in blocks."""
+        if not self.shortlist_k:
+            yield from items
+            return
+        block = []
+        for pair in items:
+            block.append(pair)
+            if len(block) >= SHORTLIST_BATCH_SIZE:
+                yield from self._with_candidates(block)
+                block = []
+        if block:
+            yield from self._with_candidates(block)
+
+    def _with_candidates(self, block: List) -> Iterator:
+        candidates = self.shortlist([item["response"] for _, item in block])
+        for (index, item), codes in zip(block, candidates):
+            yield index, {**item, "candidates": codes}
+
+    def _candidates_text(self, candidates: Iterable[str]) -> str:
+        return self._compact_json(self._candidate_index().subset(candidates))
+
+    def _build_request(
+        self,
+        response: str,
+        question: str,
+        candidates: Optional[List[str]] = None,
+        model: Optional[str] = None
+    ) -> Dict:
+        """
+        Build the Messages API arguments for coding a single response.
+
+        Args:
+            response: The consultation response to code
+            question: The consultation question
+            candidates: Shortlisted codes to offer instead of the full codeframe
+            model: Model to use instead of model_name
+
+        Returns:
+            Keyword arguments for messages.create
+        """
+        with span("build_prompt", responses=1) as traced:
+            content = f"Question: {question}\nResponse: {response}"
+            if candidates is not None:
+                content += f"\nCandidate codes: {self._candidates_text(candidates)}"
+            request = self._tool_request(content, CODING_TOOL, model)
+            if traced.recording:
+                traced.set(prompt_chars=self._prompt_chars(request), candidates=len(candidates or ()))
+            return request
+
+    def _tool_request(self, content: str, tool: str, model: Optional[str] = None) -> Dict:
+        """
+        Build Messages API arguments that make the model answer by calling a tool.
+
+        Args:
+            content: User message
+            tool: Name of the tool the model must call
+            model: Model to use instead of model_name
+
+        Returns:
+            Keyword arguments for messages.create
+        """
+        return {
+            "model": model or self.model_name,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "system": self._system_blocks(),
+            "tools": coding_tools(self.compact),
+            "tool_choice": {"type": "tool", "name": tool},
+            "messages": [
+                {
+                    "role": "user",
+                    "content": content
+                }
+            ]
+        }
+
+    @staticmethod
+    def _prompt_chars(request: Dict) -> int:
+        """Characters of a request's system prompt and messages."""
+        return (
+            sum(len(block["text"]) for block in request["system"])
+            + sum(len(message["content"]) for message in request["messages"])
+        )
+
+    @staticmethod
+    def _tool_input(message, tool: str):
+        """
+        Return the arguments of the model's call to a tool.
+
+        Raises:
+            ValueError: If the message does not call the tool
+        """
+        for block in message.content:
+            if block.type == "tool_use" and block.name == tool:
+                return block.input
+        raise ValueError(f"Response did not call the {tool} tool")
+
+    @staticmethod
+    def _validate_result(result) -> Dict:
+        """
+        Validate and normalize a coding result from a tool call.
+
+        Args:
+            result: Tool input for a single response
+
+        Returns:
+            The normalized coding result, with empty 'explanation' and
+            'relevant_quotes' for compact codings and 'error' set to None
+
+        Raises:
+            ValueError: If required keys are missing
+        """
+        # Validate the response structure
+        required_keys = ["codes", "confidence"]
+        if not isinstance(result, dict) or not all(key in result for key in required_keys):
+            raise ValueError("Missing required keys in response")
+        result = dict(result)
+
+        # Ensure codes is a list
+        if not isinstance(result["codes"], list):
+            result["codes"] = []
+
+        # Ensure other fields are dictionaries
+        for key in ["confidence", "explanation", "relevant_quotes"]:
+            if not isinstance(result.get(key), dict):
+                result[key] = {}
+
+        result["error"] = None
+        return result
+
+    def _parse_message(self, message) -> Dict:
+        """
+        Extract and validate the coding from a Claude message.
+
+        Args:
+            message: Message returned by the Messages API
+
+        Returns:
+            Coding result dictionary
+
+        Raises:
+            ValueError: If the message has no valid coding tool call
+        """
+        with span("parse", tool=CODING_TOOL) as traced:
+            result = self._validate_result(self._tool_input(message, CODING_TOOL))
+            traced.set(codes=len(result["codes"]))
+            return result
+
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        # Rough estimation: 1 token ≈ 4 characters
+        return len(text) // 4 + 1
+
+    def _iter_packs(self, items: Iterable) -> Iterator[List]:
+        """
+        Group (index, item) pairs into packs that fit the token budget.
+
+        Pack size adapts to response length: a pack is closed when its
+        estimated input tokens would exceed pack_token_budget, or its
+        estimated output would exceed max_tokens.
+
+        Args:
+            items: Iterable of (index, {'question', 'response'}) pairs
+
+        Yields:
+            Lists of (index, item) pairs
+        """
+        pack = []
+        input_tokens = 0
+        output_tokens = 0
+        for index, item in items:
+            item_input = self._estimate_tokens(item["question"] + item["response"])
+            if self.compact:
+                item_output = COMPACT_OUTPUT_TOKENS_PER_RESPONSE
+            else:
+                item_output = PACK_OUTPUT_TOKENS_PER_RESPONSE + item_input // 2
+            if pack and (
+                len(pack) >= MAX_PACK_SIZE
+                or input_tokens + item_input > self.pack_token_budget
+                or output_tokens + item_output > self.max_tokens
+            ):
+                yield pack
+                pack = []
+                input_tokens = 0
+                output_tokens = 0
+            pack.append((index, item))
+            input_tokens += item_input
+            output_tokens += item_output
+        if pack:
+            yield pack
+
+    def _build_packed_request(self, pack: List, model: Optional[str] = None) -> Dict:
+        """
+        Build the Messages API arguments for coding several responses at once.
+
+        Args:
+            pack: List of (index, item) pairs; the index is used as the response ID
+            model: Model to use instead of model_name
+
+        Returns:
+            Keyword arguments for messages.create
+        """
+        with span("build_prompt", responses=len(pack)) as traced:
+            entries = [
+                {"id": f"R{index}", "question": item["question"], "response": item["response"]}
+                for index, item in pack
+            ]
+            content = (
+                "Code each of the following responses independently.\n"
+                f"{json.dumps(entries, ensure_ascii=False)}\n\n"
+            )
+            shortlists = [item.get("candidates") for _, item in pack]
+            # One shared candidate list covering every response in the pack,
+            # unless one of them matched nothing and needs the full codeframe
+            if self.shortlist_k and all(codes is not None for codes in shortlists):
+                candidates = set()
+                for codes in shortlists:
+                    candidates.update(codes)
+                content += f"Candidate codes: {self._candidates_text(candidates)}\n\n"
+            content += "Record the coding of every response with the record_codings tool, keyed by response ID."
+            request = self._tool_request(content, PACKED_CODING_TOOL, model)
+            if traced.recording:
+                traced.set(prompt_chars=self._prompt_chars(request))
+            return request
+
+    def _parse_packed_message(self, message) -> Dict[str, Dict]:
+        """
+        Split a packed reply into per-response coding results.
+
+        Args:
+            message: Message returned by the Messages API
+
+        Returns:
+            Mapping of response ID to validated coding result. Malformed
+            replies give an empty mapping and malformed entries are omitted.
+        """
+        with span("parse", tool=PACKED_CODING_TOOL) as traced:
+            try:
+                parsed = self._tool_input(message, PACKED_CODING_TOOL).get("results")
+            except (ValueError, AttributeError) as e:
+                logging.error(f"Packed reply error: {str(e)}")
+                traced.set(error=str(e))
+                return {}
+            if not isinstance(parsed, dict):
+                return {}
+
+            results = {}
+            for response_id, result in parsed.items():
+                try:
+                    results[response_id] = self._validate_result(result)
+                except ValueError:
+                    continue
+            traced.set(responses=len(results), malformed=len(parsed) - len(results))
+            return results
+
+    def _escalation_reason(self, result: Dict) -> Optional[str]:
+        """
+        Decide whether a fast-tier coding must be redone by the primary model.
+
+        Args:
+            result: Coding result from the cascade model
+
+        Returns:
+            'error' for failed or malformed replies, 'invalid_codes' for codes
+            missing from the codeframe, 'low_confidence' if any code's
+            confidence is below escalation_threshold, or None to keep it
+        """
+        if result.get("error"):
+            return "error"
+        if validate_code_assignment(result["codes"], self.codeframe)["invalid"]:
+            return "invalid_codes"
+        for code in result["codes"]:
+            confidence = result["confidence"].get(code)
+            if not isinstance(confidence, (int, float)) or confidence < self.escalation_threshold:
+                return "low_confidence"
+        return None
+
+    def _accept_fast(self, result: Dict) -> bool:
+        """Check a fast-tier coding and record the cascade outcome."""
+        reason = self._escalation_reason(result)
+        self.metrics.record_cascade(reason)
+        return reason is None
+
+    def _cache_key(self, response: str, question: str) -> str:
+        return CodingCache.make_key(
+            self.model_name,
+            self.temperature,
+            self.prompt_version,
+            self.codeframe_hash,
+            question,
+            response
+        )
+
+    def _cache_get(self, response: str, question: str) -> Optional[Dict]:
+        if self.cache is None:
+            return None
+        with span("cache_lookup") as traced:
+            cached = self.cache.get(self._cache_key(response, question))
+            traced.set(hit=cached is not None)
+        if cached is not None:
+            self.metrics.record_cache_hit()
+        return cached
+
+    def _cache_set(self, response: str, question: str, result: Dict) -> None:
+        # Never cache failures, so they are retried on the next run
+        if self.cache is not None and not result.get("error"):
+            self.cache.set(self._cache_key(response, question), result)
+
+    # The async paths keep SQLite off the event loop, with one thread hop per
+    # call or per pack
+    async def _acache_get(self, response: str, question: str) -> Optional[Dict]:
+        if self.cache is None:
+            return None
+        return await asyncio.to_thread(self._cache_get, response, question)
+
+    async def _acache_set(self, response: str, question: str, result: Dict) -> None:
+        if self.cache is None or result.get("error"):
+            return
+        await asyncio.to_thread(self._cache_set, response, question, result)
+
+    async def _acache_get_many(self, items: List[Dict]) -> List[Optional[Dict]]:
+        if self.cache is None:
+            return [None] * len(items)
+        return await asyncio.to_thread(
+            lambda: [self._cache_get(item["response"], item["question"]) for item in items]
+        )
+
+    async def _acache_set_many(self, entries: List[Tuple[Dict, Dict]]) -> None:
+        if self.cache is None or not entries:
+            return
+        await asyncio.to_thread(
+            lambda: [self._cache_set(item["response"], item["question"], result) for item, result in entries]
+        )
+
+    @staticmethod
+    def _error_result(error: str) -> Dict:
+        """Return an empty coding result carrying an error message."""
+        return {
+            "codes": [],
+            "confidence": {},
+            "explanation": {},
+            "relevant_quotes": {},
+            "error": error
+        }
+
+    @staticmethod
+    def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+        """
+        Decide whether a failed request should be retried.
+
+        Args:
+            error: Exception raised by the client
+            attempt: Number of retries already made
+
+        Returns:
+            Seconds to wait before retrying, or None if the error is not retryable
+        """
+        if isinstance(error, anthropic.APIStatusError):
+            # Retry rate limits (429), overload (529) and server errors only
+            if error.status_code != 429 and error.status_code < 500:
+                return None
+            retry_after = error.response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return min(float(retry_after), RETRY_MAX_DELAY)
+                except ValueError:
+                    pass
+        elif not isinstance(error, anthropic.APIConnectionError):
+            return None
+        delay = min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+        return delay * (0.5 + random.random() / 2)
+
+    def _record_call(
+        self,
+        model: str,
+        usage,
+        started: float,
+        retries: int,
+        responses: int,
+        error: Optional[str] = None
+    ) -> None:
+        record = self.metrics.record(
+            model,
+            usage,
+            latency_seconds=time.monotonic() - started,
+            retries=retries,
+            responses=responses,
+            error=error
+        )
+        self._local.request_cost = getattr(self._local, "request_cost", 0.0) + record["cost"]
+
+    @staticmethod
+    def _trace_call(traced, usage, retries: int) -> None:
+        """Record a request's retries and token usage on its span."""
+        if traced.recording:
+            traced.set(
+                retries=retries,
+                **{f"{kind}_tokens": count for kind, count in usage_tokens(usage).items()}
+            )
+
+    def _request_tokens(self, request: Dict, responses: int = 1) -> int:
+        """Estimate the tokens a request will count against the rate limit."""
+        text = "".join(block["text"] for block in request["system"])
+        text += "".join(message["content"] for message in request["messages"])
+        per_response = COMPACT_OUTPUT_TOKENS_PER_RESPONSE if self.compact else PACK_OUTPUT_TOKENS_PER_RESPONSE
+        expected_output = min(request["max_tokens"], per_response * responses)
+        return self._estimate_tokens(text) + expected_output
+
+    def _throttle(self, request: Dict, responses: int = 1) -> int:
+        """Wait for rate-limit capacity; returns the tokens reserved."""
+        tokens = self._request_tokens(request, responses)
+        if self.rate_limiter is not None:
+            with span("rate_limit_wait", estimated_tokens=tokens):
+                self.rate_limiter.acquire(tokens)
+        return tokens
+
+    async def _athrottle(self, request: Dict, responses: int = 1) -> int:
+        """Async counterpart of _throttle."""
+        tokens = self._request_tokens(request, responses)
+        if self.rate_limiter is not None:
+            with span("rate_limit_wait", estimated_tokens=tokens):
+                await self.rate_limiter.acquire_async(tokens)
+        return tokens
+
+    def _on_success(self, usage, reserved_tokens: int) -> None:
+        self.concurrency_control.on_success()
+        if self.rate_limiter is not None:
+            tokens = usage_tokens(usage)
+            # Cache reads do not count towards the input token limit
+            used = tokens["input"] + tokens["output"] + tokens["cache_write"]
+            self.rate_limiter.settle(reserved_tokens, used)
+
+    async def _aon_success(self, usage, reserved_tokens: int) -> None:
+        """Async counterpart of _on_success; the limiter is updated off the event loop."""
+        self.concurrency_control.on_success()
+        if self.rate_limiter is not None:
+            tokens = usage_tokens(usage)
+            used = tokens["input"] + tokens["output"] + tokens["cache_write"]
+            await self.rate_limiter.settle_async(reserved_tokens, used)
+
+    def _failure_delay(self, error: Exception, attempt: int) -> Tuple[Optional[float], bool]:
+        """
+        Retry delay for a failed request, and whether every process sharing
+        the rate limiter should pause for it (a rate-limit retry-after).
+        Overload responses also shrink the concurrency window.
+        """
+        delay = self._retry_delay(error, attempt)
+        pause = False
+        if isinstance(error, anthropic.APIStatusError) and error.status_code in (429, 529):
+            self.concurrency_control.on_overload()
+            pause = (
+                self.rate_limiter is not None
+                and delay is not None
+                and bool(error.response.headers.get("retry-after"))
+            )
+        return delay, pause
+
+    def _on_failure(self, error: Exception, attempt: int) -> Optional[float]:
+        """
+        React to a failed request and decide whether to retry it.
+
+        Overload responses shrink the concurrency window, and a rate-limit
+        retry-after pauses every process sharing the rate limiter.
+
+        Args:
+            error: Exception raised by the client
+            attempt: Number of retries already made
+
+        Returns:
+            Seconds to wait before retrying, or None if the error is not retryable
+        """
+        delay, pause = self._failure_delay(error, attempt)
+        if pause:
+            self.rate_limiter.pause(delay)
+        return delay
+
+    async def _aon_failure(self, error: Exception, attempt: int) -> Optional[float]:
+        """Async counterpart of _on_failure."""
+        delay, pause = self._failure_delay(error, attempt)
+        if pause:
+            await self.rate_limiter.pause_async(delay)
+        return delay
+
+    def _create_message(self, request: Dict, responses: int = 1):
+        """
+        Send a Messages API request with retries, recording its usage.
+
+        Args:
+            request: Keyword arguments for messages.create
+            responses: Number of consultation responses in the request
+
+        Returns:
+            The API message
+        """
+        started = time.monotonic()
+        retries = 0
+        with span("api_call", model=request["model"], responses=responses) as traced:
+            while True:
+                reserved = self._throttle(request, responses)
+                try:
+                    message = self.client.messages.create(**request)
+                except Exception as e:
+                    delay = self._on_failure(e, retries)
+                    if delay is None or retries >= self.max_retries:
+                        self._record_call(request["model"], None, started, retries, responses, str(e))
+                        traced.set(retries=retries)
+                        raise
+                    retries += 1
+                    logging.info(f"Retrying request in {delay:.1f}s after: {str(e)}")
+                    time.sleep(delay)
+                    continue
+                self._on_success(message.usage, reserved)
+                self._record_call(request["model"], message.usage, started, retries, responses)
+                self._trace_call(traced, message.usage, retries)
+                return message
+
+    async def _acreate_message(
+        self,
+        client: anthropic.AsyncAnthropic,
+        request: Dict,
+        responses: int = 1
+    ):
+        """Async counterpart of _create_message."""
+        started = time.monotonic()
+        retries = 0
+        with span("api_call", model=request["model"], responses=responses) as traced:
+            while True:
+                reserved = await self._athrottle(request, responses)
+                try:
+                    message = await client.messages.create(**request)
+                except Exception as e:
+                    delay = await self._aon_failure(e, retries)
+                    if delay is None or retries >= self.max_retries:
+                        self._record_call(request["model"], None, started, retries, responses, str(e))
+                        traced.set(retries=retries)
+                        raise
+                    retries += 1
+                    logging.info(f"Retrying request in {delay:.1f}s after: {str(e)}")
+                    await asyncio.sleep(delay)
+                    continue
+                await self._aon_success(message.usage, reserved)
+                self._record_call(request["model"], message.usage, started, retries, responses)
+                self._trace_call(traced, message.usage, retries)
+                return message
+
+    @property
+    def last_request_cost(self) -> float:
+        """Actual API cost of the latest code_response call made on this thread."""
+        return getattr(self._local, "request_cost", 0.0)
+
+    def _request_coding(
+        self,
+        response: str,
+        question: str,
+        candidates: Optional[List[str]],
+        model: Optional[str] = None
+    ) -> Dict:
+        """Code a response with one model, returning failures as error results."""
+        try:
+            message = self._create_message(
+                self._build_request(response, question, candidates, model)
+            )
+            return self._parse_message(message)
+
+        except Exception as e:
+            logging.error(f"Error coding with {model or self.model_name}: {str(e)}")
+            return self._error_result(str(e))
 
-    @lru_cache(maxsize=100)
     def code_response(self, response, question):
         """
         Analyze a consultation response and assign codes with caching.
+
+        In cascade mode the response is coded by cascade_model first and only
+        escalated to model_name when that coding is not good enough.
         """
+        with profiled("code_response", response_chars=len(response)):
+            return self._code_response(response, question)
+
+    def _code_response(self, response: str, question: str) -> Dict:
+        self._local.request_cost = 0.0
+        cached = self._cache_get(response, question)
+        if cached is not None:
+            return cached
+        self.metrics.record_coded()
+
         try:
-            # Construct a more robust prompt
-            prompt = f"""You are an expert at coding consultation responses. Your task is to analyze the response and assign the most appropriate codes from the provided codeframe.
+            # Get response from Claude
+            candidates = self.shortlist([response])[0]
+            if self.cascade_model:
+                result = self._request_coding(response, question, candidates, self.cascade_model)
+                if self._accept_fast(result):
+                    self._cache_set(response, question, result)
+                    return result
+            message = self._create_message(
+                self._build_request(response, question, candidates)
+            )
+            result = self._parse_message(message)
+            self._cache_set(response, question, result)
+            return result
 
-Question: {question}
-Response: {response}
+        except Exception as e:
+            logging.error(f"Error in code_response: {str(e)}")
+            return self._error_result(str(e))
 
-Codeframe Categories and Codes:
-{json.dumps(self.codeframe, indent=2)}
+    def stream_code_response(self, response: str, question: str) -> Iterator[Dict]:
+        """
+        Code a response, yielding partial results as the completion streams in.
 
-Instructions:
-1. Carefully analyze the response, even if it contains extra information or is verbose.
-2. Focus on the core meaning and intent of the response, ignoring any irrelevant details.
-3. Assign codes based on the actual content and meaning, not just keywords.
-4. For each assigned code:
-   - Provide a confidence score (0.0 to 1.0)
-   - Explain why this code is appropriate
-   - Include the most relevant quote from the response
-5. Only assign codes that are clearly supported by the response content.
-6. If the response is unclear or doesn't match any codes, return an empty codes list.
-7. Your response MUST be a valid JSON object.
-
-Return a JSON object with this EXACT structure:
-{{
-    "codes": ["code1", "code2", ...],
-    "confidence": {{
-        "code1": 0.95,
-        "code2": 0.85
-    }},
-    "explanation": {{
-        "code1": "explanation text",
-        "code2": "explanation text"
-    }},
-    "relevant_quotes": {{
-        "code1": "quote from response",
-        "code2": "quote from response"
-    }},
-    "error": null
-}}
-
-IMPORTANT: Your response must be ONLY the JSON object, with no additional text or explanation."""
+        Uses the Messages streaming API with an incremental JSON parser over
+        the coding tool's input. Each partial result holds only the values
+        completed so far: codes arrive first, followed by confidence,
+        explanations and quotes. A request that
+        fails is retried from the start, so partial results may begin again.
 
-            # Get response from Claude
-            message = self.client.messages.create(
-                model=self.model_name,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                system="You are an expert at coding consultation responses. Your responses must be valid JSON objects with no additional text.",
-                messages=[
+        Args:
+            response: The consultation response text
+            question: The consultation question
+
+        In cascade mode the fast tier is awaited without streaming; only an
+        escalated request to the primary model is streamed.
+
+        Yields:
+            Partial coding dictionaries, then the validated result exactly as
+            code_response would return it (cache hits and accepted fast-tier
+            codings yield only that)
+        """
+        with profiled("stream_code_response", response_chars=len(response)):
+            yield from self._stream_code_response(response, question)
+
+    def _stream_code_response(self, response: str, question: str) -> Iterator[Dict]:
+        self._local.request_cost = 0.0
+        cached = self._cache_get(response, question)
+        if cached is not None:
+            yield cached
+            return
+        self.metrics.record_coded()
+
+        try:
+            candidates = self.shortlist([response])[0]
+            if self.cascade_model:
+                # The fast tier is not streamed, so rejected codings are never shown
+                result = self._request_coding(response, question, candidates, self.cascade_model)
+                if self._accept_fast(result):
+                    self._cache_set(response, question, result)
+                    yield result
+                    return
+            request = self._build_request(response, question, candidates)
+            started = time.monotonic()
+            retries = 0
+            # Spans the yields too: time spent rendering partial results is included
+            with span("api_stream", model=request["model"]) as traced:
+                while True:
+                    parser = IncrementalJSONParser()
+                    reserved = self._throttle(request)
+                    try:
+                        with self.client.messages.stream(**request) as stream:
+                            for event in stream:
+                                if event.type != "input_json":
+                                    continue
+                                partial = parser.feed(event.partial_json)
+                                if isinstance(partial, dict) and not parser.done:
+                                    if traced.recording and "first_partial_ms" not in traced.attributes:
+                                        traced.set(first_partial_ms=(time.monotonic() - started) * 1000)
+                                    yield partial
+                            message = stream.get_final_message()
+                    except Exception as e:
+                        delay = self._on_failure(e, retries)
+                        if delay is None or retries >= self.max_retries:
+                            self._record_call(request["model"], None, started, retries, 1, str(e))
+                            traced.set(retries=retries)
+                            raise
+                        retries += 1
+                        logging.info(f"Retrying request in {delay:.1f}s after: {str(e)}")
+                        time.sleep(delay)
+                        continue
+                    self._on_success(message.usage, reserved)
+                    self._record_call(request["model"], message.usage, started, retries, 1)
+                    self._trace_call(traced, message.usage, retries)
+                    break
+
+            result = self._parse_message(message)
+            self._cache_set(response, question, result)
+
+        except Exception as e:
+            logging.error(f"Error in stream_code_response: {str(e)}")
+            result = self._error_result(str(e))
+        yield result
+
+    def _explanation_key(self, response: str, question: str, code: str) -> str:
+        return CodingCache.make_key(
+            self.model_name,
+            self.temperature,
+            f"{PROMPT_VERSION}:explain:{code}",
+            self.codeframe_hash,
+            question,
+            response
+        )
+
+    def explain_codes(self, response: str, question: str, codes: List[str]) -> Dict[str, Dict[str, str]]:
+        """
+        Fetch explanations and quotes for codes already assigned to a response.
+
+        Used with compact codings, which omit them. Each code's explanation is
+        cached on its own, so only codes not explained before are requested.
+
+        Args:
+            response: The consultation response text
+            question: The consultation question
+            codes: Codes to explain
+
+        Returns:
+            Dictionary with 'explanation' and 'relevant_quotes' keyed by code;
+            codes that could not be explained are omitted
+        """
+        explained = {"explanation": {}, "relevant_quotes": {}}
+        missing = []
+        for code in dict.fromkeys(codes):
+            cached = self.cache.get(self._explanation_key(response, question, code)) if self.cache else None
+            if cached is None:
+                missing.append(code)
+                continue
+            self.metrics.record_cache_hit()
+            explained["explanation"][code] = cached["explanation"]
+            explained["relevant_quotes"][code] = cached["relevant_quotes"]
+        if not missing:
+            return explained
+
+        content = (
+            f"Question: {question}\nResponse: {response}\n"
+            f"Assigned codes: {', '.join(missing)}\n"
+            "Record why each assigned code applies, with the most relevant quote from "
+            "the response, using the record_explanations tool."
+        )
+        try:
+            message = self._create_message(self._tool_request(content, EXPLANATION_TOOL))
+            result = self._tool_input(message, EXPLANATION_TOOL)
+        except Exception as e:
+            logging.error(f"Error in explain_codes: {str(e)}")
+            return explained
+
+        explanations = result.get("explanation") if isinstance(result.get("explanation"), dict) else {}
+        quotes = result.get("relevant_quotes") if isinstance(result.get("relevant_quotes"), dict) else {}
+        for code in missing:
+            if code not in explanations:
+                continue
+            entry = {"explanation": str(explanations[code]), "relevant_quotes": str(quotes.get(code, ""))}
+            explained["explanation"][code] = entry["explanation"]
+            explained["relevant_quotes"][code] = entry["relevant_quotes"]
+            if self.cache is not None:
+                self.cache.set(self._explanation_key(response, question, code), entry)
+        return explained
+
+    async def _arequest_coding(
+        self,
+        client: anthropic.AsyncAnthropic,
+        response: str,
+        question: str,
+        candidates: Optional[List[str]],
+        model: Optional[str] = None
+    ) -> Dict:
+        """Async counterpart of _request_coding."""
+        try:
+            message = await self._acreate_message(
+                client, self._build_request(response, question, candidates, model)
+            )
+            return self._parse_message(message)
+
+        except Exception as e:
+            logging.error(f"Error coding with {model or self.model_name}: {str(e)}")
+            return self._error_result(str(e))
+
+    async def _acode_uncached(
+        self,
+        client: anthropic.AsyncAnthropic,
+        response: str,
+        question: str,
+        candidates: Optional[List[str]] = None
+    ) -> Dict:
+        try:
+            if candidates is None:
+                candidates = self.shortlist([response])[0]
+            if self.cascade_model:
+                result = await self._arequest_coding(
+                    client, response, question, candidates, self.cascade_model
+                )
+                if self._accept_fast(result):
+                    await self._acache_set(response, question, result)
+                    return result
+            message = await self._acreate_message(
+                client, self._build_request(response, question, candidates)
+            )
+            result = self._parse_message(message)
+            await self._acache_set(response, question, result)
+            return result
+
+        except Exception as e:
+            logging.error(f"Error in acode_response: {str(e)}")
+            return self._error_result(str(e))
+
+    async def acode_response(
+        self,
+        response: str,
+        question: str,
+        client: Optional[anthropic.AsyncAnthropic] = None,
+        candidates: Optional[List[str]] = None
+    ) -> Dict:
+        """
+        Analyze a consultation response and assign codes using the async client.
+
+        Args:
+            response: The consultation response to code
+            question: The consultation question
+            client: Async client to use; a new one is created if omitted
+            candidates: Pre-computed shortlist, if shortlisting is enabled
+
+        Returns:
+            Coding result dictionary
+        """
+        cached = await self._acache_get(response, question)
+        if cached is not None:
+            return cached
+        self.metrics.record_coded()
+
+        if client is None:
+            async with self._make_async_client() as client:
+                return await self._acode_uncached(client, response, question, candidates)
+        return await self._acode_uncached(client, response, question, candidates)
+
+    async def _acode_pack(
+        self,
+        client: anthropic.AsyncAnthropic,
+        pack: List
+    ) -> List[Dict]:
+        """
+        Code a pack of responses in one request, falling back to smaller packs.
+
+        Responses whose coding is missing or malformed in the reply are
+        re-sent in halves, down to single-response requests. In cascade mode
+        the pack goes to cascade_model first, and the responses it did not
+        code well enough are packed again for model_name.
+
+        Args:
+            client: Async client to use
+            pack: List of (index, item) pairs
+
+        Returns:
+            Coding results aligned with pack
+        """
+        codings = [None] * len(pack)
+        todo = []
+        lookups = await self._acache_get_many([item for _, item in pack])
+        for position, cached in enumerate(lookups):
+            if cached is not None:
+                codings[position] = cached
+            else:
+                todo.append(position)
+        self.metrics.record_coded(len(todo))
+
+        async def code_positions(positions: List[int], model: Optional[str] = None) -> None:
+            # Only the primary model's codings are final and cached here
+            final = model is None
+            if len(positions) == 1:
+                item = pack[positions[0]][1]
+                result = await self._arequest_coding(
+                    client, item["response"], item["question"], item.get("candidates"), model
+                )
+                codings[positions[0]] = result
+                if final:
+                    await self._acache_set(item["response"], item["question"], result)
+                return
+
+            try:
+                message = await self._acreate_message(
+                    client,
+                    self._build_packed_request([pack[p] for p in positions], model),
+                    responses=len(positions)
+                )
+            except Exception as e:
+                # A failed request is not a malformed reply, so don't retry smaller
+                logging.error(f"Error in packed request: {str(e)}")
+                for p in positions:
+                    codings[p] = self._error_result(str(e))
+                return
+
+            results = self._parse_packed_message(message)
+            missing = []
+            coded = []
+            for p in positions:
+                index, item = pack[p]
+                result = results.get(f"R{index}")
+                if result is None:
+                    missing.append(p)
+                    continue
+                codings[p] = result
+                coded.append((item, result))
+            if final:
+                await self._acache_set_many(coded)
+
+            if missing:
+                logging.info(f"Packed reply missing {len(missing)} of {len(positions)} responses; retrying in smaller packs")
+                half = (len(missing) + 1) // 2
+                await asyncio.gather(
+                    code_positions(missing[:half], model),
+                    *([code_positions(missing[half:], model)] if missing[half:] else [])
+                )
+
+        if todo and self.cascade_model:
+            await code_positions(todo, self.cascade_model)
+            escalate = []
+            accepted = []
+            for p in todo:
+                if self._accept_fast(codings[p]):
+                    accepted.append((pack[p][1], codings[p]))
+                else:
+                    escalate.append(p)
+            await self._acache_set_many(accepted)
+            todo = escalate
+        if todo:
+            await code_positions(todo)
+        return codings
+
+    async def async_batch_code_responses(
+        self,
+        responses: Iterable[Dict],
+        concurrency: Optional[int] = None,
+        packed: bool = False
+    ) -> AsyncIterator[Dict]:
+        """
+        Code consultation responses concurrently, yielding in completion order.
+
+        At most `concurrency` requests are in flight at once, and `responses`
+        is consumed lazily so it may be a generator over a very large input.
+        The window also follows concurrency_control, shrinking when the API
+        reports overload and growing back as requests succeed.
+
+        Args:
+            responses: Iterable of dictionaries containing 'question' and 'response'
+            concurrency: Maximum concurrent requests (defaults to self.concurrency)
+            packed: Code several responses per request, sized to pack_token_budget
+
+        Yields:
+            Dictionaries with 'index' (position in the input), 'question',
+            'response' and 'coding'
+        """
+        limit = max(1, concurrency or self.concurrency)
+        items = self._attach_candidates(enumerate(responses))
+        if packed:
+            units = self._iter_packs(items)
+        else:
+            units = ([pair] for pair in items)
+
+        async with self._make_async_client() as client:
+            async def code_unit(unit: List) -> List[Dict]:
+                if packed:
+                    codings = await self._acode_pack(client, unit)
+                else:
+                    index, item = unit[0]
+                    codings = [await self.acode_response(
+                        response=item["response"],
+                        question=item["question"],
+                        client=client,
+                        candidates=item.get("candidates")
+                    )]
+                return [
                     {
-                        "role": "user",
-                        "content": prompt
+                        "index": index,
+                        "question": item["question"],
+                        "response": item["response"],
+                        "coding": coded
                     }
+                    for (index, item), coded in zip(unit, codings)
                 ]
-            )
-            
-            # Extract and parse the response
-            response_text = message.content[0].text.strip()
-            
-            # Try to find JSON in the response if it's not pure JSON
-            if not response_text.startswith('{'):
-                # Look for JSON-like content
-                start_idx = response_text.find('{')
-                end_idx = response_text.rfind('}') + 1
-                if start_idx != -1 and end_idx != 0:
-                    response_text = response_text[start_idx:end_idx]
-            
+
+            pending = set()
+            exhausted = False
             try:
-                result = json.loads(response_text)
-                
-                # Validate the response structure
-                required_keys = ["codes", "confidence", "explanation", "relevant_quotes", "error"]
-                if not all(key in result for key in required_keys):
-                    raise ValueError("Missing required keys in response")
-                
-                # Ensure codes is a list
-                if not isinstance(result["codes"], list):
-                    result["codes"] = []
-                
-                # Ensure other fields are dictionaries
-                for key in ["confidence", "explanation", "relevant_quotes"]:
-                    if not isinstance(result[key], dict):
-                        result[key] = {}
-                
-                return result
-                
-            except json.JSONDecodeError as e:
-                logging.error(f"JSON parsing error: {str(e)}")
-                logging.error(f"Raw response: {response_text}")
-                return {
-                    "codes": [],
-                    "confidence": {},
-                    "explanation": {},
-                    "relevant_quotes": {},
-                    "error": f"Invalid JSON response: {str(e)}"
-                }
-                
-        except Exception as e:
-            logging.error(f"Error in code_response: {str(e)}")
-            return {
-                "codes": [],
-                "confidence": {},
-                "explanation": {},
-                "relevant_quotes": {},
-                "error": str(e)
-            }
+                while True:
+                    # Top up the in-flight window
+                    while not exhausted and len(pending) < self.concurrency_control.window(limit):
+                        try:
+                            unit = next(units)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        pending.add(asyncio.ensure_future(code_unit(unit)))
+
+                    if not pending:
+                        break
+
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        for coded in task.result():
+                            yield coded
+            finally:
+                for task in pending:
+                    task.cancel()
+
+    def iter_code_responses(
+        self,
+        responses: Iterable[Dict],
+        concurrency: Optional[int] = None,
+        packed: bool = False
+    ) -> Iterator[Dict]:
+        """
+        Blocking generator over async_batch_code_responses.
+
+        Results are yielded in completion order with their input 'index', so
+        callers can report progress while the batch is still running.
+
+        Args:
+            responses: Iterable of dictionaries containing 'question' and 'response'
+            concurrency: Maximum concurrent requests (defaults to self.concurrency)
+            packed: Code several responses per request, sized to pack_token_budget
+
+        Yields:
+            Dictionaries with 'index', 'question', 'response' and 'coding'
+        """
+        loop = asyncio.new_event_loop()
+        results = self.async_batch_code_responses(responses, concurrency, packed)
+        coded = 0
+        # Requests run in tasks created here, so their spans are children of this one
+        with profiled("code_batch", packed=packed) as traced:
+            try:
+                while True:
+                    try:
+                        yield loop.run_until_complete(results.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    coded += 1
+            finally:
+                traced.set(responses=coded)
+                loop.run_until_complete(results.aclose())
+                loop.close()
 
     def batch_code_responses(
         self,
         responses: List[Dict],
-        codeframe_path: str = "data/codeframe.json"
+        codeframe_path: str = "data/codeframe.json",
+        concurrency: Optional[int] = None,
+        packed: bool = False,
+        dedup: bool = False,
+        similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD
     ) -> List[Dict]:
         """
         Code multiple consultation responses in batch.
-        
+
         Args:
             responses: List of dictionaries containing 'question' and 'response'
             codeframe_path: Path to the codeframe JSON file
-            
+            concurrency: Maximum concurrent requests (defaults to self.concurrency)
+            packed: Code several responses per request, sized to pack_token_budget
+            dedup: Code one representative per cluster of exact and
+                near-duplicate responses and copy its coding to every member
+            similarity_threshold: Similarity needed to join a near-duplicate cluster
+
         Returns:
-            List of coded responses
+            List of coded responses, in input order. With dedup, each also
+            carries the 'cluster_id' it was coded under.
         """
-        coded_responses = []
-        for response in responses:
-            coded = self.code_response(
-                response=response["response"],
-                question=response["question"]
+        if dedup:
+            cluster_ids, representatives = cluster_responses(
+                responses, threshold=similarity_threshold
+            )
+            coded_representatives = self.batch_code_responses(
+                [responses[i] for i in representatives],
+                concurrency=concurrency,
+                packed=packed
             )
-            coded_responses.append({
-                "question": response["question"],
-                "response": response["response"],
-                "coding": coded
-            })
-        return coded_responses 
\ No newline at end of file
+            logging.info(f"Deduplicated {len(responses)} responses into {len(representatives)} clusters")
+            return [
+                {
+                    "question": response["question"],
+                    "response": response["response"],
+                    "coding": dict(coded_representatives[cluster_id]["coding"]),
+                    "cluster_id": cluster_id
+                }
+                for response, cluster_id in zip(responses, cluster_ids)
+            ]
+
+        coded_responses = [None] * len(responses)
+        for coded in self.iter_code_responses(responses, concurrency, packed):
+            index = coded.pop("index")
+            coded_responses[index] = coded
+        return coded_responses
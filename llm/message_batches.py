@@ -0,0 +1,600 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import time
+from typing import Dict, IO, Iterator, List, Optional, Tuple
+
+from utils.batch import DEFAULT_CHUNK_SIZE, ResultWriter, iter_input_chunks, read_result_records, to_output_record
+from utils.codeframe import save_codeframe_version
+from utils.parser import clean_response_batch
+from utils.tracing import span
+
+# API limits on a single message batch
+MAX_BATCH_REQUESTS = 100_000
+MAX_BATCH_BYTES = 256 * 1024 * 1024
+# Requests per submitted batch; smaller batches start returning results sooner
+DEFAULT_BATCH_REQUESTS = 10_000
+# Serialized requests per batch, kept below MAX_BATCH_BYTES for the request envelope
+DEFAULT_BATCH_BYTES = 200 * 1024 * 1024
+# Seconds between status checks, doubling while no batch ends
+POLL_INITIAL_DELAY = 10.0
+POLL_MAX_DELAY = 300.0
+# Bump whenever the layout of the state file changes
+STATE_VERSION = 1
+# Result types of requests that were not coded
+FAILED_RESULT_TYPES = ("errored", "canceled", "expired")
+
+
+def batch_work_dir(output_path: str) -> str:
+    """Directory holding the state of a Message Batches run, next to its output."""
+    return f"{output_path}.batches"
+
+
+class MessageBatchRunner:
+    """
+    Code responses through the Message Batches API.
+
+    Batches are processed asynchronously by the API within 24 hours, at half
+    the price of interactive requests. Rows are turned into batch requests
+    with `custom_id`s naming their row (or, when packed, the first row of the
+    pack), and submitted in batches bounded by request count and size.
+
+    Everything needed to finish a run is kept in `work_dir`: a state file
+    with the submitted batch IDs, and for each batch a manifest of its rows
+    and, once the batch has ended, its output records. A run interrupted at
+    any point resumes from there: rows already in a batch are not submitted
+    again, and batches already collected are not downloaded again.
+
+    Cached rows are served from the coding cache and only the first of
+    identical rows within a batch is sent. Cascade mode is not used; every
+    request goes to the coder's model_name.
+
+    Args:
+        coder: ClaudeCoder whose prompts, parsing and cache are used
+        work_dir: Directory for the state, manifests and collected results
+        client: Client exposing messages.batches; the coder's client by default
+        packed: Code several responses per request
+        max_requests: Requests per batch
+        max_bytes: Serialized request bytes per batch
+        poll_interval: Initial seconds between status checks
+        max_poll_interval: Upper bound on the seconds between status checks
+    """
+
+    def __init__(
+        self,
+        coder,
+        work_dir: str,
+        client=None,
+        packed: bool = False,
+        max_requests: int = DEFAULT_BATCH_REQUESTS,
+        max_bytes: int = DEFAULT_BATCH_BYTES,
+        poll_interval: float = POLL_INITIAL_DELAY,
+        max_poll_interval: float = POLL_MAX_DELAY
+    ):
+        if not 1 <= max_requests <= MAX_BATCH_REQUESTS:
+            raise ValueError(f"Requests per batch must be between 1 and {MAX_BATCH_REQUESTS}")
+        if not 0 < max_bytes <= MAX_BATCH_BYTES:
+            raise ValueError(f"Bytes per batch must be between 1 and {MAX_BATCH_BYTES}")
+        if coder.cascade_model:
+            logging.info(f"Cascade mode is not used for message batches; coding with {coder.model_name}")
+            coder = coder.with_options(cascade_model=None)
+        self.coder = coder
+        self.client = client if client is not None else coder.client
+        # Checked before any state is written, so an old SDK leaves no work directory behind
+        if getattr(getattr(self.client, "messages", None), "batches", None) is None:
+            raise ValueError(
+                "The installed anthropic SDK has no Message Batches API (messages.batches); "
+                "upgrade it with: pip install 'anthropic>=0.41.0'"
+            )
+        self.work_dir = work_dir
+        self.packed = packed
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.state_path = os.path.join(work_dir, "state.json")
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.work_dir, name)
+
+    def _settings(self, input_format: str, shard_index: int, shard_count: int) -> Dict:
+        """Settings a resumed run must share with the run that started it."""
+        return {
+            "model": self.coder.model_name,
+            "prompt_version": self.coder.prompt_version,
+            "codeframe_version": self.coder.codeframe_hash,
+            "packed": self.packed,
+            "input_format": input_format,
+            "shard_index": shard_index,
+            "shard_count": shard_count
+        }
+
+    def load_state(self, settings: Dict) -> Dict:
+        """
+        Load the state of an interrupted run, or start a new one.
+
+        Args:
+            settings: Settings of this run, see _settings
+
+        Returns:
+            State dictionary
+
+        Raises:
+            ValueError: If the saved run used different settings
+        """
+        if not os.path.exists(self.state_path):
+            os.makedirs(self.work_dir, exist_ok=True)
+            return {
+                "version": STATE_VERSION,
+                "settings": settings,
+                "next_row": 0,
+                "input_digest": hashlib.sha256().hexdigest(),
+                "input_done": False,
+                "batches": []
+            }
+        with open(self.state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("version") != STATE_VERSION or state.get("settings") != settings:
+            raise ValueError(
+                f"{self.work_dir} belongs to a run with different settings; "
+                f"delete it to start over"
+            )
+        return state
+
+    def save_state(self, state: Dict) -> None:
+        """Write the state file atomically, so a crash leaves the previous state."""
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=1)
+        os.replace(temp_path, self.state_path)
+
+    def _build_requests(self, lines: List[Dict]) -> List[Dict]:
+        """
+        Build the batch requests for a batch's manifest lines.
+
+        Lines carrying a coding, or pointing at another line's request,
+        need no request of their own.
+
+        Returns:
+            Batch requests with 'custom_id' and 'params'
+        """
+        groups: Dict[str, List[Dict]] = {}
+        for line in lines:
+            if "candidates" in line:
+                groups.setdefault(line["custom_id"], []).append(line)
+        requests = []
+        for custom_id, group in groups.items():
+            if self.packed:
+                params = self.coder._build_packed_request([
+                    (line["row"], {
+                        "question": line["question"],
+                        "response": line["cleaned"],
+                        "candidates": line["candidates"]
+                    })
+                    for line in group
+                ])
+            else:
+                line = group[0]
+                params = self.coder._build_request(line["cleaned"], line["question"], line["candidates"])
+            requests.append({"custom_id": custom_id, "params": params})
+        return requests
+
+    def _plan_chunk(
+        self,
+        chunk: List[Dict],
+        cleaned: List[str],
+        cached: List[Optional[Dict]],
+        candidates: Dict[Tuple[str, str], Optional[List[str]]],
+        sent: Dict[Tuple[str, str], Tuple[str, str]]
+    ) -> Tuple[List[Dict], Dict[Tuple[str, str], Tuple[str, str]]]:
+        """
+        Turn a chunk of input rows into manifest lines.
+
+        Args:
+            chunk: Input rows
+            cleaned: Cleaned text of each row
+            cached: Cached coding of each row, or None
+            candidates: Shortlisted codes by (question, cleaned text)
+            sent: Request ('custom_id', 'entry') of each (question, cleaned
+                text) already in the batch
+
+        Returns:
+            Tuple of the manifest lines and the requests they add to `sent`.
+            Cached rows carry their 'coding', rows repeating one already
+            sent carry the 'custom_id' and 'entry' of its request, and the
+            rest also carry their 'candidates' and need a request.
+        """
+        lines = []
+        added: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        new = []
+        for item, text, coding in zip(chunk, cleaned, cached):
+            line = {"row": item["row"], "question": item["question"], "response": item["response"], "cleaned": text}
+            key = (item["question"], text)
+            if coding is not None:
+                line["coding"] = coding
+            elif key in sent or key in added:
+                line["repeats"] = key
+            else:
+                line["candidates"] = candidates[key]
+                added[key] = None
+                new.append(line)
+            lines.append(line)
+
+        if self.packed:
+            pairs = [(line["row"], {"question": line["question"], "response": line["cleaned"]}) for line in new]
+            packs = [[row for row, _ in pack] for pack in self.coder._iter_packs(iter(pairs))]
+            ids = {row: (f"pack-{pack[0]}", f"R{row}") for pack in packs for row in pack}
+        else:
+            ids = {line["row"]: (f"row-{line['row']}",) * 2 for line in new}
+        for line in new:
+            line["custom_id"], line["entry"] = ids[line["row"]]
+            added[(line["question"], line["cleaned"])] = ids[line["row"]]
+        for line in lines:
+            if "repeats" in line:
+                key = line.pop("repeats")
+                line["custom_id"], line["entry"] = sent.get(key) or added[key]
+        return lines, added
+
+    def _write_manifest(self, state: Dict, lines: List[Dict], requests: int) -> Dict:
+        """Write a batch's manifest and record the batch as pending submission."""
+        number = len(state["batches"])
+        manifest = f"batch-{number:04d}.manifest.jsonl"
+        temp_path = self._path(f"{manifest}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self._path(manifest))
+        entry = {
+            "number": number,
+            "id": None,
+            "status": "pending",
+            "manifest": manifest,
+            "results": f"batch-{number:04d}.results.jsonl",
+            "rows": len(lines),
+            "requests": requests,
+            "errors": 0,
+            "submitted_at": None
+        }
+        state["batches"].append(entry)
+        return entry
+
+    def _read_manifest(self, entry: Dict) -> List[Dict]:
+        with open(self._path(entry["manifest"]), encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def submit(self, entry: Dict) -> None:
+        """
+        Submit a pending batch, retrying rate limits and server errors.
+
+        Raises:
+            Exception: The client's error, once retries are exhausted
+        """
+        requests = self._build_requests(self._read_manifest(entry))
+        retries = 0
+        with span("batch_submit", batch=entry["number"], requests=len(requests)) as traced:
+            while True:
+                try:
+                    batch = self.client.messages.batches.create(requests=requests)
+                    break
+                except Exception as e:
+                    delay = self.coder._retry_delay(e, retries)
+                    if delay is None or retries >= self.coder.max_retries:
+                        traced.set(retries=retries)
+                        raise
+                    retries += 1
+                    logging.info(f"Retrying batch submission in {delay:.1f}s after: {str(e)}")
+                    time.sleep(delay)
+            traced.set(batch_id=batch.id, retries=retries)
+        entry["id"] = batch.id
+        entry["status"] = "submitted"
+        entry["submitted_at"] = time.time()
+        logging.info(f"Submitted batch {entry['number']} as {batch.id}: {len(requests)} requests")
+
+    def plan(self, file: IO[str], input_format: str, state: Dict, shard_index: int = 0, shard_count: int = 1) -> Iterator[Dict]:
+        """
+        Split the input rows not yet in a batch into batches and submit them.
+
+        Rows are planned a chunk at a time and a chunk always goes into a
+        single batch, so a repeated row only ever points at a request of
+        its own batch.
+
+        Args:
+            file: Text file object with 'question' and 'response'
+            input_format: 'csv' or 'jsonl'
+            state: Run state, updated and saved after each batch
+            shard_index: Shard of the input to code
+            shard_count: Number of shards
+
+        Yields:
+            Each batch entry once it is submitted (or complete, when every
+            row was served from the cache)
+
+        Raises:
+            ValueError: If the rows already submitted differ from the input's
+        """
+        # Digest of the rows already in a batch, to detect a changed input on resuming
+        digest = hashlib.sha256()
+        checked = state["next_row"] == 0
+        lines: List[Dict] = []
+        sent: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        requests = 0
+        size = 0
+
+        def check_input() -> None:
+            if digest.hexdigest() != state["input_digest"]:
+                raise ValueError(f"The input differs from the one {self.work_dir} was started with")
+
+        def flush() -> Dict:
+            entry = self._write_manifest(state, lines, requests)
+            state["next_row"] = lines[-1]["row"] + 1
+            state["input_digest"] = digest.hexdigest()
+            if not requests:
+                self._write_results(entry, lines, {}, {})
+            self.save_state(state)
+            if requests:
+                self.submit(entry)
+                self.save_state(state)
+            return entry
+
+        chunk_size = min(DEFAULT_CHUNK_SIZE, self.max_requests)
+        for chunk in iter_input_chunks(file, input_format, chunk_size, shard_index, shard_count):
+            done = [item for item in chunk if item["row"] < state["next_row"]]
+            for item in done:
+                digest.update(f"{item['question']}\x1f{item['response']}\x1e".encode("utf-8"))
+            chunk = chunk[len(done):]
+            if not chunk:
+                continue
+            if not checked:
+                check_input()
+                checked = True
+
+            cleaned = clean_response_batch([item["response"] for item in chunk])
+            cached = [self.coder._cache_get(text, item["question"]) for item, text in zip(chunk, cleaned)]
+            uncached = list(dict.fromkeys(
+                (item["question"], text) for item, text, coding in zip(chunk, cleaned, cached) if coding is None
+            ))
+            candidates = dict(zip(uncached, self.coder.shortlist([text for _, text in uncached])))
+
+            planned, added = self._plan_chunk(chunk, cleaned, cached, candidates, sent)
+            chunk_requests = self._build_requests(planned)
+            chunk_size_bytes = sum(len(json.dumps(request, ensure_ascii=False)) for request in chunk_requests)
+            if lines and (
+                requests + len(chunk_requests) > self.max_requests
+                or size + chunk_size_bytes > self.max_bytes
+            ):
+                yield flush()
+                lines, sent, requests, size = [], {}, 0, 0
+                planned, added = self._plan_chunk(chunk, cleaned, cached, candidates, sent)
+                chunk_requests = self._build_requests(planned)
+                chunk_size_bytes = sum(len(json.dumps(request, ensure_ascii=False)) for request in chunk_requests)
+
+            lines.extend(planned)
+            sent.update(added)
+            requests += len(chunk_requests)
+            size += chunk_size_bytes
+            for item in chunk:
+                digest.update(f"{item['question']}\x1f{item['response']}\x1e".encode("utf-8"))
+        if not checked:
+            check_input()
+        if lines:
+            yield flush()
+        state["input_done"] = True
+        self.save_state(state)
+
+    def wait(self, state: Dict) -> Iterator[Dict]:
+        """
+        Poll submitted batches with exponential backoff until each ends.
+
+        Transient errors while polling (rate limits, server and connection
+        errors) are logged and the batch is checked again at the next poll.
+
+        Yields:
+            Each batch entry whose batch has ended, once its results are collected
+        """
+        delay = self.poll_interval
+        while True:
+            outstanding = [entry for entry in state["batches"] if entry["status"] == "submitted"]
+            if not outstanding:
+                return
+            ended = False
+            for entry in outstanding:
+                try:
+                    batch = self.client.messages.batches.retrieve(entry["id"])
+                except Exception as e:
+                    if self.coder._retry_delay(e, 0) is None:
+                        raise
+                    logging.info(f"Could not check batch {entry['id']}, retrying at the next poll: {str(e)}")
+                    continue
+                if batch.processing_status == "ended":
+                    self.collect(entry)
+                    self.save_state(state)
+                    ended = True
+                    yield entry
+            if ended:
+                delay = self.poll_interval
+            else:
+                time.sleep(delay * (0.5 + random.random() / 2))
+                delay = min(delay * 2, self.max_poll_interval)
+
+    def collect(self, entry: Dict) -> None:
+        """
+        Stream an ended batch's results into output records.
+
+        Successful codings are written to the coding cache; requests that
+        errored, expired or were canceled give error results, so rerunning
+        the input codes them again.
+        """
+        started = entry["submitted_at"] or time.time()
+        codings: Dict[str, Dict] = {}
+        failures: Dict[str, str] = {}
+        with span("batch_collect", batch=entry["number"], batch_id=entry["id"]) as traced:
+            for result in self.client.messages.batches.results(entry["id"]):
+                outcome = result.result
+                if outcome.type in FAILED_RESULT_TYPES:
+                    error = getattr(getattr(getattr(outcome, "error", None), "error", None), "message", None)
+                    failures[result.custom_id] = f"Batch request {outcome.type}" + (f": {error}" if error else "")
+                    continue
+                message = outcome.message
+                if result.custom_id.startswith("pack-"):
+                    parsed = self.coder._parse_packed_message(message)
+                    codings.update(parsed)
+                else:
+                    parsed = {}
+                    try:
+                        parsed[result.custom_id] = self.coder._parse_message(message)
+                    except ValueError as e:
+                        failures[result.custom_id] = str(e)
+                    codings.update(parsed)
+                self.coder.metrics.record(
+                    message.model,
+                    message.usage,
+                    latency_seconds=time.time() - started,
+                    responses=len(parsed),
+                    batch=True
+                )
+            self._write_results(entry, self._read_manifest(entry), codings, failures)
+            traced.set(codings=len(codings), failures=len(failures))
+        entry["status"] = "collected"
+
+    def _write_results(self, entry: Dict, lines: List[Dict], codings: Dict[str, Dict], failures: Dict[str, str]) -> None:
+        """Write the output records of a batch's rows, in row order."""
+        records = []
+        for line in lines:
+            coding = line.get("coding")
+            if coding is None:
+                coding = codings.get(line["entry"])
+                if coding is None:
+                    coding = self.coder._error_result(
+                        failures.get(line["custom_id"]) or "Missing from the batch results"
+                    )
+                elif "candidates" in line:
+                    self.coder._cache_set(line["cleaned"], line["question"], coding)
+            records.append(to_output_record(line, line["cleaned"], coding, None, self.coder.codeframe_hash))
+        self.coder.metrics.record_coded(sum("candidates" in line for line in lines))
+        temp_path = self._path(f"{entry['results']}.tmp")
+        with ResultWriter(temp_path, "jsonl") as writer:
+            writer.write(records)
+        os.replace(temp_path, self._path(entry["results"]))
+        entry["status"] = "collected"
+        entry["errors"] = sum(1 for record in records if record["error"])
+
+    def iter_records(self, state: Dict) -> Iterator[Dict]:
+        """Yield every collected output record, in input row order."""
+        for entry in state["batches"]:
+            with open(self._path(entry["results"]), encoding="utf-8") as f:
+                yield from read_result_records(f, "jsonl")
+
+    def cancel(self, state: Dict) -> None:
+        """Cancel the run's batches that are still processing."""
+        for entry in state["batches"]:
+            if entry["status"] == "submitted":
+                self.client.messages.batches.cancel(entry["id"])
+                logging.info(f"Canceled batch {entry['id']}")
+
+
+def run_message_batches(
+    coder,
+    file: IO[str],
+    output_path: str,
+    output_format: str = "jsonl",
+    input_format: str = "csv",
+    packed: bool = False,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    client=None,
+    work_dir: Optional[str] = None,
+    max_requests: int = DEFAULT_BATCH_REQUESTS,
+    max_bytes: int = DEFAULT_BATCH_BYTES,
+    poll_interval: float = POLL_INITIAL_DELAY,
+    max_poll_interval: float = POLL_MAX_DELAY
+) -> Iterator[Dict]:
+    """
+    Code a file of responses through the Message Batches API.
+
+    Every batch is submitted first, then polled until it ends and its
+    results are collected. Once all are collected the results are written
+    to `output_path` in input row order, in the same format as run_batch,
+    and the work directory is removed. Calling this again with the same
+    input and output after a crash resumes the run.
+
+    Args:
+        coder: ClaudeCoder instance
+        file: Text file object with 'question' and 'response' columns
+            (CSV) or fields (JSONL)
+        output_path: Path of the JSONL or CSV output file
+        output_format: 'jsonl' or 'csv'
+        input_format: 'csv' or 'jsonl'
+        packed: Code several responses per request
+        shard_index: Shard of the input to code (see shard_of)
+        shard_count: Number of shards; 1 codes every row
+        client: Client exposing messages.batches; the coder's client by default
+        work_dir: Directory of the run's state; batch_work_dir(output_path) by default
+        max_requests: Requests per batch
+        max_bytes: Serialized request bytes per batch
+        poll_interval: Initial seconds between status checks
+        max_poll_interval: Upper bound on the seconds between status checks
+
+    Yields:
+        Progress dictionaries after each batch is submitted or collected,
+        with 'batches', 'batches_done', 'rows_submitted', 'rows_done',
+        'errors' and 'elapsed_seconds'
+
+    Raises:
+        ValueError: If the work directory belongs to a different run, or the
+            client has no Message Batches API
+    """
+    started = time.time()
+    runner = MessageBatchRunner(
+        coder, work_dir or batch_work_dir(output_path), client, packed,
+        max_requests, max_bytes, poll_interval, max_poll_interval
+    )
+    state = runner.load_state(runner._settings(input_format, shard_index, shard_count))
+    save_codeframe_version(runner.coder.codeframe)
+
+    def progress() -> Dict:
+        batches = state["batches"]
+        collected = [entry for entry in batches if entry["status"] == "collected"]
+        return {
+            "batches": len(batches),
+            "batches_done": len(collected),
+            "rows_submitted": sum(entry["rows"] for entry in batches),
+            "rows_done": sum(entry["rows"] for entry in collected),
+            "errors": sum(entry["errors"] for entry in collected),
+            "elapsed_seconds": time.time() - started
+        }
+
+    # Batches recorded but not submitted before a crash
+    for entry in state["batches"]:
+        if entry["status"] == "pending":
+            logging.warning(
+                f"Submitting batch {entry['number']} again: it may also have been submitted "
+                f"before the interruption, in which case the earlier copy can be canceled"
+            )
+            runner.submit(entry)
+            runner.save_state(state)
+    if not state["input_done"]:
+        for _ in runner.plan(file, input_format, state, shard_index, shard_count):
+            yield progress()
+    for _ in runner.wait(state):
+        yield progress()
+
+    temp_path = f"{output_path}.tmp"
+    try:
+        with ResultWriter(temp_path, output_format) as writer:
+            buffer: List[Dict] = []
+            for record in runner.iter_records(state):
+                buffer.append(record)
+                if len(buffer) >= DEFAULT_CHUNK_SIZE:
+                    writer.write(buffer)
+                    buffer = []
+            writer.write(buffer)
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    summary = progress()
+    shutil.rmtree(runner.work_dir)
+    yield summary
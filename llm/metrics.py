@@ -0,0 +1,335 @@
+import json
+import logging
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+import numpy as np
+
+# USD per million tokens
+MODEL_PRICES = {
+    "claude-3-opus-20240229": {"input": 15.0, "output": 75.0},
+    "claude-3-sonnet-20240229": {"input": 3.0, "output": 15.0},
+    "claude-3-haiku-20240307": {"input": 0.25, "output": 1.25},
+    "claude-3-5-sonnet-20240620": {"input": 3.0, "output": 15.0},
+    "claude-3-5-sonnet-20241022": {"input": 3.0, "output": 15.0},
+    "claude-3-5-haiku-20241022": {"input": 0.8, "output": 4.0},
+}
+# Prompt-cache writes and reads are billed relative to the input price
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+# Message Batches requests are billed at half price
+BATCH_PRICE_MULTIPLIER = 0.5
+# Latency samples kept for percentiles
+DEFAULT_MAX_SAMPLES = 100_000
+TOKEN_TYPES = ("input", "output", "cache_read", "cache_write")
+# Reasons a fast-tier coding is re-done by the primary model in cascade mode
+ESCALATION_REASONS = ("error", "invalid_codes", "low_confidence")
+
+
+def usage_cost(
+    model: str,
+    input_tokens: int = 0,
+    output_tokens: int = 0,
+    cache_read_tokens: int = 0,
+    cache_write_tokens: int = 0
+) -> float:
+    """
+    Price a request from its token usage.
+
+    Args:
+        model: Model name
+        input_tokens: Uncached input tokens
+        output_tokens: Output tokens
+        cache_read_tokens: Input tokens read from the prompt cache
+        cache_write_tokens: Input tokens written to the prompt cache
+
+    Returns:
+        Cost in USD, or 0.0 for models missing from MODEL_PRICES
+    """
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return 0.0
+    return (
+        input_tokens * prices["input"]
+        + output_tokens * prices["output"]
+        + cache_read_tokens * prices["input"] * CACHE_READ_MULTIPLIER
+        + cache_write_tokens * prices["input"] * CACHE_WRITE_MULTIPLIER
+    ) / 1_000_000
+
+
+def usage_tokens(usage) -> Dict[str, int]:
+    """
+    Read token counts from an API usage object.
+
+    Args:
+        usage: `usage` attribute of a Messages API response
+
+    Returns:
+        Token counts keyed by TOKEN_TYPES
+    """
+    return {
+        "input": getattr(usage, "input_tokens", 0) or 0,
+        "output": getattr(usage, "output_tokens", 0) or 0,
+        "cache_read": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_write": getattr(usage, "cache_creation_input_tokens", 0) or 0
+    }
+
+
+class MetricsRecorder:
+    """
+    Thread-safe recorder of API usage, latency, retries and cost.
+
+    Totals are kept per model; latency percentiles use the most recent
+    `max_samples` requests.
+    """
+
+    def __init__(self, max_samples: int = DEFAULT_MAX_SAMPLES):
+        self._lock = threading.Lock()
+        self._max_samples = max_samples
+        self._latencies = deque(maxlen=max_samples)
+        self._model_latencies: Dict[str, deque] = {}
+        self._models: Dict[str, Dict[str, float]] = {}
+        self.coded_responses = 0
+        self.cached_responses = 0
+        self._cascade = self._empty_cascade()
+        self._warned = set()
+
+    @staticmethod
+    def _empty_cascade() -> Dict[str, int]:
+        return {"fast_responses": 0, **{reason: 0 for reason in ESCALATION_REASONS}}
+
+    def _model_totals(self, model: str) -> Dict[str, float]:
+        totals = self._models.get(model)
+        if totals is None:
+            totals = {
+                "requests": 0, "responses": 0, "errors": 0, "retries": 0,
+                "latency_seconds": 0.0, "cost": 0.0,
+                **{f"{t}_tokens": 0 for t in TOKEN_TYPES}
+            }
+            self._models[model] = totals
+        return totals
+
+    def record(
+        self,
+        model: str,
+        usage=None,
+        latency_seconds: float = 0.0,
+        retries: int = 0,
+        responses: int = 1,
+        error: Optional[str] = None,
+        batch: bool = False
+    ) -> Dict:
+        """
+        Record one API request.
+
+        Args:
+            model: Model name
+            usage: `usage` attribute of the response, None if the request failed
+            latency_seconds: Wall-clock time including retries
+            retries: Number of retried attempts
+            responses: Number of consultation responses coded by the request,
+                counted towards its model's breakdown only; record_coded
+                counts each response once for the overall totals
+            error: Error message if the request failed
+            batch: The request was part of a message batch, billed at
+                BATCH_PRICE_MULTIPLIER
+
+        Returns:
+            The request record, including its 'cost'
+        """
+        tokens = usage_tokens(usage)
+        cost = usage_cost(
+            model, tokens["input"], tokens["output"], tokens["cache_read"], tokens["cache_write"]
+        )
+        if batch:
+            cost *= BATCH_PRICE_MULTIPLIER
+        if model not in MODEL_PRICES and model not in self._warned:
+            self._warned.add(model)
+            logging.warning(f"No price configured for model {model}; costs will be reported as 0")
+
+        with self._lock:
+            totals = self._model_totals(model)
+            totals["requests"] += 1
+            totals["responses"] += responses
+            totals["errors"] += 1 if error else 0
+            totals["retries"] += retries
+            totals["latency_seconds"] += latency_seconds
+            totals["cost"] += cost
+            for token_type in TOKEN_TYPES:
+                totals[f"{token_type}_tokens"] += tokens[token_type]
+            self._latencies.append(latency_seconds)
+            if model not in self._model_latencies:
+                self._model_latencies[model] = deque(maxlen=self._max_samples)
+            self._model_latencies[model].append(latency_seconds)
+
+        return {
+            "model": model,
+            "tokens": tokens,
+            "latency_seconds": latency_seconds,
+            "retries": retries,
+            "responses": responses,
+            "cost": cost,
+            "error": error
+        }
+
+    def record_coded(self, responses: int = 1) -> None:
+        """
+        Record responses coded through the API, once each however many
+        requests (cascade escalations, packed retries) went into coding them.
+
+        Args:
+            responses: Number of responses coded
+        """
+        with self._lock:
+            self.coded_responses += responses
+
+    def record_cache_hit(self) -> None:
+        """Record a response served from the coding cache."""
+        with self._lock:
+            self.cached_responses += 1
+
+    def record_cascade(self, escalation_reason: Optional[str] = None) -> None:
+        """
+        Record a response coded by the fast tier in cascade mode.
+
+        Args:
+            escalation_reason: One of ESCALATION_REASONS if the response was
+                escalated to the primary model, None if the fast coding was kept
+        """
+        with self._lock:
+            self._cascade["fast_responses"] += 1
+            if escalation_reason is not None:
+                self._cascade[escalation_reason] += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self._latencies.clear()
+            self._model_latencies.clear()
+            self._models.clear()
+            self.coded_responses = 0
+            self.cached_responses = 0
+            self._cascade = self._empty_cascade()
+
+    def summary(self) -> Dict:
+        """
+        Summarize everything recorded so far.
+
+        Returns:
+            Dictionary with request, token, latency and cost totals, derived
+            per-response figures, and a per-model breakdown
+        """
+        with self._lock:
+            latencies = np.array(self._latencies, dtype=float)
+            model_latencies = {
+                model: np.array(samples, dtype=float)
+                for model, samples in self._model_latencies.items()
+            }
+            models = {model: dict(totals) for model, totals in self._models.items()}
+            coded = self.coded_responses
+            cached = self.cached_responses
+            cascade = dict(self._cascade)
+
+        totals = {
+            key: sum(m[key] for m in models.values())
+            for key in ("requests", "errors", "retries", "cost",
+                        *(f"{t}_tokens" for t in TOKEN_TYPES))
+        }
+        all_responses = coded + cached
+        tokens = sum(totals[f"{t}_tokens"] for t in TOKEN_TYPES)
+
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        else:
+            p50 = p95 = p99 = 0.0
+
+        for model, model_totals in models.items():
+            samples = model_latencies.get(model, [])
+            if len(samples):
+                model_p50, model_p95 = np.percentile(samples, [50, 95])
+            else:
+                model_p50 = model_p95 = 0.0
+            model_totals["latency_p50_seconds"] = float(model_p50)
+            model_totals["latency_p95_seconds"] = float(model_p95)
+            model_totals["cost_per_response"] = (
+                model_totals["cost"] / model_totals["responses"] if model_totals["responses"] else 0.0
+            )
+
+        escalated = sum(cascade[reason] for reason in ESCALATION_REASONS)
+        fast = cascade["fast_responses"]
+
+        return {
+            **totals,
+            "responses": coded,
+            "cached_responses": cached,
+            "latency_p50_seconds": float(p50),
+            "latency_p95_seconds": float(p95),
+            "latency_p99_seconds": float(p99),
+            "tokens_per_response": tokens / coded if coded else 0.0,
+            "output_tokens_per_response": totals["output_tokens"] / coded if coded else 0.0,
+            "cost_per_1k_responses": 1000 * totals["cost"] / all_responses if all_responses else 0.0,
+            "models": models,
+            "cascade": {
+                "fast_responses": fast,
+                "resolved_by_fast": fast - escalated,
+                "escalated": escalated,
+                "fast_hit_rate": (fast - escalated) / fast if fast else 0.0,
+                "escalation_reasons": {reason: cascade[reason] for reason in ESCALATION_REASONS}
+            }
+        }
+
+    def to_json(self) -> str:
+        """Return the summary as a JSON document."""
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self, prefix: str = "consultation_coder") -> str:
+        """
+        Return the metrics in the Prometheus text exposition format.
+
+        Args:
+            prefix: Metric name prefix
+
+        Returns:
+            Exposition text
+        """
+        summary = self.summary()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+
+        models = summary["models"]
+        metric("requests_total", "counter", "API requests made",
+               [({"model": m}, t["requests"]) for m, t in models.items()])
+        metric("errors_total", "counter", "API requests that failed",
+               [({"model": m}, t["errors"]) for m, t in models.items()])
+        metric("retries_total", "counter", "Retried API attempts",
+               [({"model": m}, t["retries"]) for m, t in models.items()])
+        metric("tokens_total", "counter", "Tokens billed by type",
+               [({"model": m, "type": tt}, t[f"{tt}_tokens"]) for m, t in models.items() for tt in TOKEN_TYPES])
+        metric("cost_usd_total", "counter", "Estimated spend in USD",
+               [({"model": m}, round(t["cost"], 6)) for m, t in models.items()])
+        metric("responses_total", "counter", "Consultation responses coded",
+               [({"source": "api"}, summary["responses"]), ({"source": "cache"}, summary["cached_responses"])])
+        metric("request_latency_seconds", "summary", "API request latency including retries", [
+            ({"quantile": "0.5"}, summary["latency_p50_seconds"]),
+            ({"quantile": "0.95"}, summary["latency_p95_seconds"]),
+            ({"quantile": "0.99"}, summary["latency_p99_seconds"]),
+        ])
+        lines.append(f"{prefix}_request_latency_seconds_sum {sum(t['latency_seconds'] for t in models.values())}")
+        lines.append(f"{prefix}_request_latency_seconds_count {summary['requests']}")
+        cascade = summary["cascade"]
+        metric("cascade_responses_total", "counter", "Responses coded by the fast tier in cascade mode, by outcome",
+               [({"outcome": "accepted"}, cascade["resolved_by_fast"])]
+               + [({"outcome": reason}, count) for reason, count in cascade["escalation_reasons"].items()])
+        metric("cost_per_1k_responses_usd", "gauge", "Spend per thousand responses, cache hits included",
+               [({}, round(summary["cost_per_1k_responses"], 6))])
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide recorder shared by every ClaudeCoder unless one is passed in
+DEFAULT_METRICS = MetricsRecorder()
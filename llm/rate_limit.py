@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+# Default location of the shared limiter state
+DEFAULT_RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", ".cache/rate_limit.sqlite")
+# Organisation-wide API limits shared by every session and worker process,
+# overridable with RATE_LIMIT_RPM and RATE_LIMIT_TPM
+DEFAULT_REQUESTS_PER_MINUTE = 50
+DEFAULT_TOKENS_PER_MINUTE = 40_000
+# Additive increase / multiplicative decrease of the concurrency window
+CONCURRENCY_DECREASE_FACTOR = 0.5
+# Ignore further overload signals for this long after shrinking the window,
+# since requests already in flight report the same overload
+CONCURRENCY_DECREASE_COOLDOWN = 2.0
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter for requests and tokens per minute.
+
+    Bucket levels live in SQLite, and every reservation runs in an immediate
+    transaction, so the budget is shared by all sessions and worker processes
+    pointing at the same file. Reservations may overdraw a bucket: the caller
+    waits until the debt has refilled, which queues callers in arrival order.
+    A rate-limit response with retry-after pauses every process at once.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_RATE_LIMIT_PATH,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None
+    ):
+        self.path = path
+        if requests_per_minute is None:
+            requests_per_minute = int(os.getenv("RATE_LIMIT_RPM", DEFAULT_REQUESTS_PER_MINUTE))
+        if tokens_per_minute is None:
+            tokens_per_minute = int(os.getenv("RATE_LIMIT_TPM", DEFAULT_TOKENS_PER_MINUTE))
+        self.limits = {
+            "requests": float(requests_per_minute),
+            "tokens": float(tokens_per_minute)
+        }
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so reopen in child processes
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS buckets (
+                    name TEXT PRIMARY KEY,
+                    level REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS pauses (
+                    name TEXT PRIMARY KEY,
+                    until REAL NOT NULL
+                )"""
+            )
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _levels(self, conn: sqlite3.Connection, now: float) -> Dict[str, float]:
+        """Read bucket levels refilled up to `now`; full for unseen buckets."""
+        rows = dict(
+            (name, (level, updated_at))
+            for name, level, updated_at in conn.execute("SELECT name, level, updated_at FROM buckets")
+        )
+        levels = {}
+        for name, capacity in self.limits.items():
+            if name in rows:
+                level, updated_at = rows[name]
+                level += (now - updated_at) * capacity / 60
+                levels[name] = min(level, capacity)
+            else:
+                levels[name] = capacity
+        return levels
+
+    def _update(self, changes: Dict[str, float]) -> Dict[str, float]:
+        """Apply level changes in one transaction and return the new levels."""
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                levels = self._levels(conn, now)
+                for name, change in changes.items():
+                    levels[name] += change
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (name, level, updated_at) VALUES (?, ?, ?)",
+                    [(name, level, now) for name, level in levels.items()]
+                )
+                row = conn.execute("SELECT until FROM pauses WHERE name = 'global'").fetchone()
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        levels["paused_seconds"] = max(0.0, row[0] - now) if row else 0.0
+        return levels
+
+    def reserve(self, tokens: int) -> float:
+        """
+        Reserve one request and an estimated number of tokens.
+
+        Args:
+            tokens: Estimated tokens the request will use
+
+        Returns:
+            Seconds the caller must wait before sending the request
+        """
+        tokens = min(float(tokens), self.limits["tokens"])
+        try:
+            levels = self._update({"requests": -1.0, "tokens": -tokens})
+        except sqlite3.Error as e:
+            logging.error(f"Rate limiter unavailable, not throttling: {str(e)}")
+            return 0.0
+        wait = levels["paused_seconds"]
+        for name, capacity in self.limits.items():
+            if levels[name] < 0:
+                wait = max(wait, -levels[name] * 60 / capacity)
+        return wait
+
+    def acquire(self, tokens: int) -> float:
+        """Reserve capacity and sleep until it is available. Returns the time waited."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens: int) -> float:
+        """
+        Async counterpart of acquire.
+
+        The reservation runs in a worker thread: its transaction may wait on
+        other processes' locks, which would otherwise stall the event loop.
+        """
+        wait = await asyncio.to_thread(self.reserve, tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """
+        Correct the token bucket once a request's real usage is known.
+
+        Args:
+            estimated_tokens: Tokens reserved for the request
+            actual_tokens: Tokens the API reported using
+        """
+        estimated = min(float(estimated_tokens), self.limits["tokens"])
+        if actual_tokens == estimated:
+            return
+        try:
+            self._update({"tokens": estimated - actual_tokens})
+        except sqlite3.Error as e:
+            logging.error(f"Rate limiter update failed: {str(e)}")
+
+    async def settle_async(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Async counterpart of settle, run in a worker thread like acquire_async."""
+        await asyncio.to_thread(self.settle, estimated_tokens, actual_tokens)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hold back every process sharing this limiter, e.g. for a retry-after.
+
+        Args:
+            seconds: How long from now no new requests should be sent
+        """
+        until = time.time() + seconds
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT INTO pauses (name, until) VALUES ('global', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET until = MAX(until, excluded.until)",
+                    (until,)
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Rate limiter update failed: {str(e)}")
+
+    async def pause_async(self, seconds: float) -> None:
+        """Async counterpart of pause, run in a worker thread like acquire_async."""
+        await asyncio.to_thread(self.pause, seconds)
+
+    def status(self) -> Dict[str, float]:
+        """
+        Report the capacity currently available.
+
+        Returns:
+            Dictionary with available 'requests' and 'tokens', the configured
+            per-minute limits and any remaining 'paused_seconds'
+        """
+        try:
+            levels = self._update({})
+        except sqlite3.Error as e:
+            logging.error(f"Rate limiter unavailable: {str(e)}")
+            levels = {**self.limits, "paused_seconds": 0.0}
+        return {
+            "requests": max(0.0, levels["requests"]),
+            "tokens": max(0.0, levels["tokens"]),
+            "requests_per_minute": self.limits["requests"],
+            "tokens_per_minute": self.limits["tokens"],
+            "paused_seconds": levels["paused_seconds"]
+        }
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller for the number of requests in flight.
+
+    The window grows by one after a full window of successful requests and
+    is halved when the API reports overload (429 or 529), never exceeding
+    `maximum` or dropping below `minimum`.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self._limit = float(self.maximum)
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def window(self, requested: int) -> int:
+        """
+        Return how many requests may be in flight for a caller wanting `requested`.
+
+        A request above `maximum` raises it, keeping the current headroom.
+        """
+        with self._lock:
+            if requested > self.maximum:
+                self._limit += requested - self.maximum
+                self.maximum = requested
+        return max(1, min(requested, self.limit))
+
+    def on_success(self) -> None:
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                self._limit = min(self._limit + 1, self.maximum)
+
+    def on_overload(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_decrease < CONCURRENCY_DECREASE_COOLDOWN:
+                return
+            self._last_decrease = now
+            self._successes = 0
+            self._limit = max(self._limit * CONCURRENCY_DECREASE_FACTOR, self.minimum)
+            logging.info(f"API overloaded; reducing concurrency to {self.limit}")
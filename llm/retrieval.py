@@ -0,0 +1,197 @@
+import re
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence
+
+import numpy as np
+
+DEFAULT_TOP_K = 12
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have i in is it its of on or "
+    "our that the their there they this to was we were will with would".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lower-cased, lightly stemmed terms.
+
+    Args:
+        text: Text to tokenize
+
+    Returns:
+        List of terms with stopwords removed
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        # Light plural stemming so "delays" matches "delay"
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        terms.append(token)
+    return terms
+
+
+class CandidateIndex:
+    """
+    BM25 index over codeframe code descriptions.
+
+    The index is a dense code × term weight matrix, so scoring a batch of
+    responses is a single matrix product.
+    """
+
+    def __init__(
+        self,
+        categories: Mapping[str, Mapping[str, str]],
+        k1: float = 1.5,
+        b: float = 0.75
+    ):
+        self.codes: List[str] = []
+        self.code_categories: List[str] = []
+        self.descriptions: List[str] = []
+        documents = []
+        for category, codes in categories.items():
+            category_terms = tokenize(category.replace("_", " "))
+            for code, description in codes.items():
+                self.codes.append(code)
+                self.code_categories.append(category)
+                self.descriptions.append(description)
+                documents.append(tokenize(description) + category_terms)
+
+        self.vocabulary: Dict[str, int] = {}
+        for terms in documents:
+            for term in terms:
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+
+        counts = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, terms in enumerate(documents):
+            for term in terms:
+                counts[row, self.vocabulary[term]] += 1
+
+        lengths = counts.sum(axis=1, keepdims=True)
+        average_length = float(lengths.mean()) if len(documents) else 0.0
+        document_frequency = (counts > 0).sum(axis=0)
+        idf = np.log(1.0 + (len(documents) - document_frequency + 0.5) / (document_frequency + 0.5))
+        norm = k1 * (1.0 - b + b * lengths / max(average_length, 1e-9))
+        self.weights = (idf * counts * (k1 + 1.0) / (counts + norm)).astype(np.float32)
+
+        self._category_codes: Dict[str, List[int]] = {}
+        for position, category in enumerate(self.code_categories):
+            self._category_codes.setdefault(category, []).append(position)
+
+    def query_matrix(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Build the response × term presence matrix for a batch of texts.
+
+        Args:
+            texts: Response texts
+
+        Returns:
+            Binary float32 matrix over the index vocabulary
+        """
+        matrix = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            columns = [self.vocabulary[t] for t in set(tokenize(text)) if t in self.vocabulary]
+            matrix[row, columns] = 1.0
+        return matrix
+
+    def score(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Score every code against every text.
+
+        Args:
+            texts: Response texts
+
+        Returns:
+            Matrix of BM25 scores with shape (len(texts), len(self.codes))
+        """
+        return self.query_matrix(texts) @ self.weights.T
+
+    def top_k(
+        self,
+        texts: Sequence[str],
+        k: int = DEFAULT_TOP_K,
+        always_include: Optional[Iterable[str]] = None,
+        min_score: float = 0.0
+    ) -> List[Optional[List[str]]]:
+        """
+        Shortlist the most relevant codes for each text.
+
+        Codes tied at the cut-off are taken in codeframe order, so the
+        shortlist of a text never depends on the rest of the batch.
+
+        Args:
+            texts: Response texts
+            k: Number of top-scoring codes to keep per text
+            always_include: Categories whose codes are always included
+            min_score: Texts whose best score is no higher than this match
+                nothing in the codeframe and get no shortlist
+
+        Returns:
+            For each text, its candidate codes in codeframe order, or None
+            if it should be offered the full codeframe
+        """
+        if not texts:
+            return []
+        scores = self.score(texts)
+        k = min(k, len(self.codes))
+        if k < len(self.codes):
+            # Everything above the k-th best score, then ties at it in codeframe order
+            cutoff = -np.partition(-scores, k - 1, axis=1)[:, k - 1:k]
+            above = scores > cutoff
+            tied = scores == cutoff
+            room = k - above.sum(axis=1, keepdims=True)
+            selected = above | (tied & (np.cumsum(tied, axis=1) <= room))
+        else:
+            selected = np.ones(scores.shape, dtype=bool)
+        matched = scores.max(axis=1) > min_score if len(self.codes) else np.zeros(len(texts), dtype=bool)
+
+        forced = np.zeros(len(self.codes), dtype=bool)
+        for category in always_include or ():
+            forced[self._category_codes.get(category, [])] = True
+
+        return [
+            [self.codes[p] for p in np.flatnonzero(row | forced)] if match else None
+            for row, match in zip(selected, matched)
+        ]
+
+    def subset(self, codes: Iterable[str]) -> Dict[str, Dict[str, str]]:
+        """
+        Group candidate codes by category for inclusion in a prompt.
+
+        Args:
+            codes: Codes to include
+
+        Returns:
+            Mapping of category to {code: description}, in codeframe order
+        """
+        wanted = set(codes)
+        grouped: Dict[str, Dict[str, str]] = {}
+        for position, code in enumerate(self.codes):
+            if code in wanted:
+                grouped.setdefault(self.code_categories[position], {})[code] = self.descriptions[position]
+        return grouped
+
+
+_INDEXES: Dict[str, CandidateIndex] = {}
+
+
+def get_candidate_index(
+    codeframe_hash: str,
+    categories: Mapping[str, Mapping[str, str]]
+) -> CandidateIndex:
+    """
+    Return the candidate index for a codeframe, building it once per version.
+
+    Args:
+        codeframe_hash: Content hash identifying the codeframe version
+        categories: The codeframe's categories
+
+    Returns:
+        Shared CandidateIndex
+    """
+    index = _INDEXES.get(codeframe_hash)
+    if index is None:
+        index = CandidateIndex(categories)
+        _INDEXES[codeframe_hash] = index
+    return index
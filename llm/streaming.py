@@ -0,0 +1,111 @@
+import json
+from typing import Any, List, Optional
+
+# Characters opening a JSON container, and the character that closes each
+CLOSERS = {"{": "}", "[": "]"}
+
+
+class IncrementalJSONParser:
+    """
+    Parse a JSON document as it streams in.
+
+    Text is scanned once, as it arrives. The parser remembers the last
+    position where the document could be cut and closed to form valid JSON
+    (after a complete string value, number, object or array), so each
+    snapshot holds only complete values: codes appear one by one, and a
+    confidence or quote is never reported half-written. Text before the
+    first '{' or '[' and after the root value closes is ignored.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._scanned = 0
+        self._start: Optional[int] = None
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        self._string_is_key = False
+        self._safe_end: Optional[int] = None
+        self._safe_closers = ""
+        self._parsed_end: Optional[int] = None
+        self.value: Any = None
+        self.done = False
+
+    def _mark_safe(self, end: int) -> None:
+        self._safe_end = end
+        self._safe_closers = "".join(CLOSERS[c] for c in reversed(self._stack))
+
+    def _scan(self) -> None:
+        text = self._text
+        for i in range(self._scanned, len(text)):
+            c = text[i]
+            if self._start is None:
+                if c in CLOSERS:
+                    self._start = i
+                    self._stack.append(c)
+                    self._expect_key = c == "{"
+                    self._mark_safe(i + 1)
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if not self._string_is_key:
+                        self._mark_safe(i + 1)
+                continue
+
+            if c == '"':
+                self._in_string = True
+                self._string_is_key = self._expect_key
+            elif c in CLOSERS:
+                self._stack.append(c)
+                self._expect_key = c == "{"
+                self._mark_safe(i + 1)
+            elif c in "}]":
+                self._stack.pop()
+                self._expect_key = False
+                self._mark_safe(i + 1)
+                if not self._stack:
+                    self.done = True
+                    self._scanned = len(text)
+                    return
+            elif c == ",":
+                # The value before a comma is complete, even a bare number
+                self._mark_safe(i)
+                self._expect_key = self._stack[-1] == "{"
+            elif c == ":":
+                self._expect_key = False
+        self._scanned = len(text)
+
+    def feed(self, chunk: str) -> Optional[Any]:
+        """
+        Add streamed text.
+
+        Args:
+            chunk: Next piece of the document
+
+        Returns:
+            A snapshot of the document parsed so far if it gained a complete
+            value, otherwise None
+        """
+        if self.done:
+            return None
+        self._text += chunk
+        self._scan()
+
+        if self._safe_end is None or self._safe_end == self._parsed_end:
+            return None
+        try:
+            value = json.loads(self._text[self._start:self._safe_end] + self._safe_closers)
+        except ValueError:
+            return None
+        self._parsed_end = self._safe_end
+        if value == self.value:
+            return None
+        self.value = value
+        return value
@@ -0,0 +1,517 @@
+import csv
+import hashlib
+import json
+import os
+import time
+from typing import Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple
+
+from utils.codeframe import save_codeframe_version
+from utils.dedup import NearDuplicateIndex
+from utils.parser import clean_response_batch
+
+# Rows read from the input and sent to the coder at a time
+DEFAULT_CHUNK_SIZE = 200
+# Duplicate clusters remembered across chunks when deduplicating; older
+# clusters are forgotten so memory stays flat however long the input
+DEFAULT_DEDUP_CLUSTERS = 10_000
+REQUIRED_COLUMNS = ("question", "response")
+INPUT_FORMATS = ("csv", "jsonl")
+OUTPUT_FORMATS = ("jsonl", "csv")
+CSV_FIELDS = [
+    "row", "question", "response", "cleaned_response",
+    "codes", "confidence", "explanation", "relevant_quotes", "error",
+    "cluster_id", "codeframe_version", "coded_by"
+]
+
+
+def iter_input_rows(file: IO[str], input_format: str = "csv") -> Iterator[Dict]:
+    """
+    Read `question,response` rows from a CSV or JSONL file.
+
+    Args:
+        file: Text file object positioned at the start (the header row for CSV)
+        input_format: 'csv', or 'jsonl' with one object per line
+
+    Yields:
+        Dictionaries with 'row' (0-based data row number), 'question' and
+        'response'
+
+    Raises:
+        ValueError: If the format is unsupported or a required column is missing
+    """
+    if input_format not in INPUT_FORMATS:
+        raise ValueError(f"Unsupported input format: {input_format}")
+    if input_format == "csv":
+        reader = csv.DictReader(file)
+        missing = [c for c in REQUIRED_COLUMNS if c not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"CSV is missing required columns: {', '.join(missing)}")
+        rows = reader
+    else:
+        rows = (json.loads(line) for line in file if line.strip())
+
+    for row_number, row in enumerate(rows):
+        if input_format == "jsonl":
+            missing = [c for c in REQUIRED_COLUMNS if c not in row]
+            if missing:
+                raise ValueError(f"JSONL row {row_number} is missing required fields: {', '.join(missing)}")
+        yield {
+            "row": row_number,
+            "question": row["question"] or "",
+            "response": row["response"] or ""
+        }
+
+
+def shard_of(item: Dict, shard_count: int) -> int:
+    """
+    Assign a row to one of `shard_count` shards by hashing its content.
+
+    The hash is stable across processes and machines, and identical rows
+    land in the same shard, where they share codings.
+
+    Args:
+        item: Input row with 'question' and 'response'
+        shard_count: Number of shards
+
+    Returns:
+        Shard index in [0, shard_count)
+    """
+    digest = hashlib.sha256(f"{item['question']}\x1f{item['response']}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+def iter_input_chunks(
+    file: IO[str],
+    input_format: str = "csv",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    shard_index: int = 0,
+    shard_count: int = 1
+) -> Iterator[List[Dict]]:
+    """
+    Read input rows in fixed-size chunks, keeping only one shard's rows.
+
+    Rows keep their row numbers in the whole file, so shard outputs can be
+    merged back into input order.
+
+    Args:
+        file: Text file object positioned at the start
+        input_format: 'csv' or 'jsonl'
+        chunk_size: Number of rows per chunk
+        shard_index: Shard to keep
+        shard_count: Number of shards the input is split into
+
+    Yields:
+        Lists of rows as produced by iter_input_rows
+
+    Raises:
+        ValueError: If the input is invalid or the shard is out of range
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} is out of range for {shard_count} shards")
+    chunk = []
+    for item in iter_input_rows(file, input_format):
+        if shard_count > 1 and shard_of(item, shard_count) != shard_index:
+            continue
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_csv_chunks(
+    file: IO[str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[List[Dict]]:
+    """
+    Read `question,response` rows from a CSV file in fixed-size chunks.
+
+    Args:
+        file: Text file object positioned at the header row
+        chunk_size: Number of rows per chunk
+
+    Yields:
+        Lists of dictionaries with 'row' (0-based data row number),
+        'question' and 'response'
+
+    Raises:
+        ValueError: If the header lacks a required column
+    """
+    return iter_input_chunks(file, "csv", chunk_size)
+
+
+def count_csv_rows(file: IO[str]) -> int:
+    """
+    Count data rows in a CSV file without holding it in memory.
+
+    The file is rewound to the start afterwards.
+
+    Args:
+        file: Seekable text file object
+
+    Returns:
+        Number of data rows (excluding the header)
+    """
+    start = file.tell()
+    count = max(sum(1 for _ in csv.reader(file)) - 1, 0)
+    file.seek(start)
+    return count
+
+
+def to_output_record(
+    item: Dict,
+    cleaned: str,
+    coding: Dict,
+    cluster_id: Optional[int] = None,
+    codeframe_version: Optional[str] = None
+) -> Dict:
+    """
+    Flatten a coded row into the batch output record format.
+
+    Args:
+        item: Input row with 'row', 'question' and 'response'
+        cleaned: Cleaned response text that was coded
+        coding: Coding result from ClaudeCoder
+        cluster_id: Duplicate cluster the row was coded under, if deduplicating
+        codeframe_version: Content hash of the codeframe the row was coded with
+
+    Returns:
+        Output record; 'coded_by' is 'classifier' for codings made by the
+        local classifier, None for the model's
+    """
+    return {
+        "row": item["row"],
+        "question": item["question"],
+        "response": item["response"],
+        "cleaned_response": cleaned,
+        "codes": coding.get("codes", []),
+        "confidence": coding.get("confidence", {}),
+        "explanation": coding.get("explanation", {}),
+        "relevant_quotes": coding.get("relevant_quotes", {}),
+        "error": coding.get("error"),
+        "cluster_id": cluster_id,
+        "codeframe_version": codeframe_version,
+        "coded_by": coding.get("coded_by")
+    }
+
+
+class DuplicateClusters:
+    """
+    The most recent duplicate clusters of a batch run, with the cleaned text
+    of each one's representative and, once coded, its coding.
+
+    Only max_clusters clusters are kept: a duplicate of a forgotten cluster
+    starts a new one and is coded again (or served from the coding cache).
+
+    Args:
+        max_clusters: Clusters remembered
+    """
+
+    def __init__(self, max_clusters: int = DEFAULT_DEDUP_CLUSTERS):
+        self.index = NearDuplicateIndex(max_clusters=max_clusters)
+        self.texts: Dict[int, str] = {}
+        self.codings: Dict[int, Dict] = {}
+
+    def add(self, item: Dict, cleaned: str) -> Tuple[int, str]:
+        """
+        Place a row in a cluster.
+
+        Returns:
+            Tuple of the cluster ID and the representative's cleaned text
+        """
+        cluster_id, is_new = self.index.add(item["response"], item["question"])
+        if is_new:
+            self.texts[cluster_id] = cleaned
+        text = self.texts[cluster_id]
+        # Forget what the index forgot; clusters are kept in creation order
+        while self.texts and next(iter(self.texts)) not in self.index:
+            forgotten = next(iter(self.texts))
+            del self.texts[forgotten]
+            self.codings.pop(forgotten, None)
+        return cluster_id, text
+
+    def restore(self, saved: Iterable[Tuple[int, int, str, str, Optional[Dict]]], rows_added: int) -> None:
+        """
+        Rebuild the clusters saved by an earlier run, e.g. of a job taken over
+        by another worker.
+
+        Args:
+            saved: (cluster_id, row, question, text, coding) of each cluster,
+                oldest first, where row is its representative's and coding
+                is None if it has none yet
+            rows_added: Rows the earlier run had placed in clusters
+        """
+        saved = list(saved)
+        self.index.restore(
+            ((cluster_id, row, text, question) for cluster_id, row, question, text, _ in saved), rows_added
+        )
+        for cluster_id, _, _, text, coding in saved:
+            if cluster_id in self.index:
+                self.texts[cluster_id] = text
+                if coding is not None:
+                    self.codings[cluster_id] = coding
+
+    def remember(self, cluster_id: int, coding: Dict) -> None:
+        """Keep a cluster's coding for its later members, unless it failed or was forgotten."""
+        if not coding.get("error") and cluster_id in self.index:
+            self.codings[cluster_id] = coding
+
+
+def assign_clusters(
+    chunk: List[Dict],
+    cleaned: List[str],
+    clusters: Optional[DuplicateClusters]
+) -> Tuple[List[Optional[int]], List[str]]:
+    """
+    Place each row of a chunk in a duplicate cluster.
+
+    Args:
+        chunk: Input rows with 'question' and 'response'
+        cleaned: Cleaned response text of each row
+        clusters: Recent clusters of the run, or None to skip dedup
+
+    Returns:
+        Tuple of each row's cluster ID (None without dedup) and the text to
+        code it with, which is its cluster representative's
+    """
+    if clusters is None:
+        return [None] * len(chunk), cleaned
+    cluster_ids = []
+    texts = []
+    for position, item in enumerate(chunk):
+        cluster_id, text = clusters.add(item, cleaned[position])
+        cluster_ids.append(cluster_id)
+        texts.append(text)
+    return cluster_ids, texts
+
+
+def code_chunk(
+    coder,
+    chunk: List[Dict],
+    packed: bool = False,
+    clusters: Optional[DuplicateClusters] = None,
+    skip: Optional[Set[int]] = None
+) -> Iterator[List[Dict]]:
+    """
+    Code a chunk of rows, yielding output records as their requests complete.
+
+    Args:
+        coder: ClaudeCoder instance
+        chunk: Input rows with 'row', 'question' and 'response'
+        packed: Code several responses per request
+        clusters: Duplicate clusters shared across chunks, if deduplicating;
+            rows of a cluster coded in an earlier chunk reuse its coding
+        skip: Row numbers already coded; they are still added to the
+            clusters so cluster IDs stay stable, but not coded
+
+    Yields:
+        Output records of the rows sharing each completed coding
+    """
+    cleaned = clean_response_batch([item["response"] for item in chunk])
+    cluster_ids, texts = assign_clusters(chunk, cleaned, clusters)
+
+    # Duplicates within a chunk are only sent once
+    unique = {}
+    requests = []
+    reused = []
+    for position, (item, text) in enumerate(zip(chunk, texts)):
+        if skip and item["row"] in skip:
+            continue
+        if clusters is not None and cluster_ids[position] in clusters.codings:
+            reused.append(position)
+            continue
+        key = (item["question"], text)
+        if key not in unique:
+            unique[key] = len(requests)
+            requests.append({"question": item["question"], "response": text, "positions": []})
+        requests[unique[key]]["positions"].append(position)
+
+    if reused:
+        yield [
+            to_output_record(
+                chunk[position], cleaned[position], clusters.codings[cluster_ids[position]],
+                cluster_ids[position], coder.codeframe_hash
+            )
+            for position in reused
+        ]
+
+    for coded in coder.iter_code_responses(
+        ({"question": r["question"], "response": r["response"]} for r in requests),
+        packed=packed
+    ):
+        positions = requests[coded["index"]]["positions"]
+        if clusters is not None:
+            clusters.remember(cluster_ids[positions[0]], coded["coding"])
+        yield [
+            to_output_record(
+                chunk[position], cleaned[position], coded["coding"],
+                cluster_ids[position], coder.codeframe_hash
+            )
+            for position in positions
+        ]
+
+
+def read_result_records(file: IO[str], output_format: str = "jsonl") -> Iterator[Dict]:
+    """
+    Read back the records of a batch results file.
+
+    Args:
+        file: Text file object written by ResultWriter
+        output_format: 'jsonl' or 'csv'
+
+    Yields:
+        Output records, as produced by to_output_record
+
+    Raises:
+        ValueError: If the output format is unsupported
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    if output_format == "jsonl":
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+        return
+    for row in csv.DictReader(file):
+        yield {
+            **row,
+            "row": int(row["row"]),
+            "codes": row["codes"].split(";") if row["codes"] else [],
+            "confidence": json.loads(row["confidence"] or "{}"),
+            "explanation": json.loads(row["explanation"] or "{}"),
+            "relevant_quotes": json.loads(row["relevant_quotes"] or "{}"),
+            "error": row["error"] or None,
+            "cluster_id": int(row["cluster_id"]) if row.get("cluster_id") else None,
+            "codeframe_version": row.get("codeframe_version") or None,
+            "coded_by": row.get("coded_by") or None
+        }
+
+
+class ResultWriter:
+    """
+    Append-only writer for batch results in JSONL or CSV format.
+
+    Every chunk is flushed to disk so the file can be read while a run is
+    still in progress.
+    """
+
+    def __init__(self, path: str, output_format: str = "jsonl"):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format: {output_format}")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.output_format = output_format
+        self._file = open(path, "w", encoding="utf-8", newline="")
+        self._csv = None
+        if output_format == "csv":
+            self._csv = csv.DictWriter(self._file, fieldnames=CSV_FIELDS)
+            self._csv.writeheader()
+
+    def write(self, records: List[Dict]) -> None:
+        """Append records and flush them to disk."""
+        for record in records:
+            if self._csv is not None:
+                self._csv.writerow({
+                    **record,
+                    "codes": ";".join(record["codes"]),
+                    "confidence": json.dumps(record["confidence"]),
+                    "explanation": json.dumps(record["explanation"]),
+                    "relevant_quotes": json.dumps(record["relevant_quotes"]),
+                    "error": record["error"] or "",
+                    "cluster_id": "" if record["cluster_id"] is None else record["cluster_id"],
+                    "codeframe_version": record.get("codeframe_version") or "",
+                    "coded_by": record.get("coded_by") or ""
+                })
+            else:
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_batch(
+    coder,
+    file: IO[str],
+    output_path: str,
+    output_format: str = "jsonl",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    total_rows: Optional[int] = None,
+    packed: bool = False,
+    dedup: bool = False,
+    input_format: str = "csv",
+    shard_index: int = 0,
+    shard_count: int = 1
+) -> Iterator[Dict]:
+    """
+    Code a file of responses chunk by chunk, writing results incrementally.
+
+    Only one chunk of rows and results is held in memory at a time, so
+    memory use does not grow with the size of the input; with dedup, the
+    most recent DEFAULT_DEDUP_CLUSTERS clusters and their codings are kept too.
+
+    Args:
+        coder: ClaudeCoder instance
+        file: Text file object with 'question' and 'response' columns
+            (CSV) or fields (JSONL)
+        output_path: Path of the JSONL or CSV output file
+        output_format: 'jsonl' or 'csv'
+        chunk_size: Number of rows per chunk
+        total_rows: Total data rows, used for the ETA if known
+        packed: Code several responses per request
+        dedup: Collapse exact and near-duplicate responses. Members of a
+            cluster get the coding of its representative, without a request,
+            as long as the cluster is among the most recent
+            DEFAULT_DEDUP_CLUSTERS; duplicates of older clusters are coded
+            again, or served from the coding cache.
+        input_format: 'csv' or 'jsonl'
+        shard_index: Shard of the input to code (see shard_of)
+        shard_count: Number of shards; 1 codes every row
+
+    Yields:
+        Progress dictionaries after each chunk with 'rows_done',
+        'total_rows', 'errors', 'elapsed_seconds', 'rows_per_second' and
+        'eta_seconds'
+    """
+    started = time.time()
+    rows_done = 0
+    errors = 0
+    # Results are tagged with the codeframe version; keep it for incremental recoding
+    save_codeframe_version(coder.codeframe)
+    clusters = DuplicateClusters() if dedup else None
+
+    with ResultWriter(output_path, output_format) as writer:
+        for chunk in iter_input_chunks(file, input_format, chunk_size, shard_index, shard_count):
+            records = [
+                record
+                for group in code_chunk(coder, chunk, packed, clusters)
+                for record in group
+            ]
+            records.sort(key=lambda record: record["row"])
+            writer.write(records)
+
+            rows_done += len(chunk)
+            errors += sum(1 for record in records if record["error"])
+            elapsed = time.time() - started
+            rate = rows_done / elapsed if elapsed > 0 else 0.0
+            eta = None
+            if total_rows is not None and rate > 0:
+                eta = max(total_rows - rows_done, 0) / rate
+
+            yield {
+                "rows_done": rows_done,
+                "total_rows": total_rows,
+                "errors": errors,
+                "elapsed_seconds": elapsed,
+                "rows_per_second": rate,
+                "eta_seconds": eta
+            }
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Iterable, Mapping, Optional, Set, Tuple
+
+DEFAULT_CODEFRAME_PATH = "data/codeframe.json"
+# Snapshots of every codeframe version results were coded with, by content hash
+DEFAULT_VERSIONS_DIR = os.getenv("CODEFRAME_VERSIONS_DIR", ".cache/codeframes")
+# Substring length used by the search index
+NGRAM_SIZE = 3
+
+
+class Codeframe:
+    """
+    Immutable, pre-indexed view of a codeframe's categories.
+
+    Provides O(1) code lookup, an n-gram inverted index for substring search
+    over codes and descriptions, and a content hash identifying the version.
+    """
+
+    def __init__(self, data: Mapping):
+        categories = data.get("categories", {})
+        self.categories: Mapping[str, Mapping[str, str]] = MappingProxyType({
+            category: MappingProxyType(dict(codes))
+            for category, codes in categories.items()
+        })
+        self.content_hash = hashlib.sha256(
+            json.dumps(categories, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        self.compact_json = json.dumps(
+            categories, separators=(",", ":"), ensure_ascii=False
+        )
+
+        self._lookup: Dict[str, Tuple[str, str]] = {}
+        for category, codes in categories.items():
+            for code, description in codes.items():
+                # The first category listing a code wins, as in the results view
+                self._lookup.setdefault(code, (category, description))
+        self.codes: Tuple[str, ...] = tuple(self._lookup)
+
+        # Lower-cased "code\0description" per code; \0 stops matches spanning both
+        self._haystacks = [
+            f"{code.lower()}\0{description.lower()}"
+            for code, (_, description) in self._lookup.items()
+        ]
+        self._ngrams: Dict[str, Set[int]] = {}
+        for position, haystack in enumerate(self._haystacks):
+            for i in range(len(haystack) - NGRAM_SIZE + 1):
+                self._ngrams.setdefault(haystack[i:i + NGRAM_SIZE], set()).add(position)
+
+    @classmethod
+    def from_file(cls, path: str = DEFAULT_CODEFRAME_PATH) -> "Codeframe":
+        """
+        Load a codeframe from a JSON file.
+
+        Args:
+            path: Path to the codeframe JSON file
+
+        Returns:
+            Codeframe instance
+        """
+        with open(path, "r") as f:
+            return cls(json.load(f))
+
+    def __contains__(self, code: str) -> bool:
+        return code in self._lookup
+
+    def __len__(self) -> int:
+        return len(self._lookup)
+
+    def lookup(self, code: str) -> Optional[Tuple[str, str]]:
+        """
+        Find the category and description of a code.
+
+        Args:
+            code: Code to look up
+
+        Returns:
+            (category, description), or None for unknown codes
+        """
+        return self._lookup.get(code)
+
+    def description(self, code: str) -> Optional[str]:
+        """Return a code's description, or None for unknown codes."""
+        entry = self._lookup.get(code)
+        return entry[1] if entry else None
+
+    def category(self, code: str) -> Optional[str]:
+        """Return a code's category, or None for unknown codes."""
+        entry = self._lookup.get(code)
+        return entry[0] if entry else None
+
+    def to_dict(self) -> Dict[str, Dict[str, Dict[str, str]]]:
+        """Return a mutable copy in the codeframe JSON format."""
+        return {
+            "categories": {
+                category: dict(codes) for category, codes in self.categories.items()
+            }
+        }
+
+    def search(self, term: str) -> Dict[str, Dict[str, str]]:
+        """
+        Find codes whose number or description contains a search term.
+
+        Matching is case-insensitive substring matching. Terms of NGRAM_SIZE
+        characters or more are answered from the inverted index.
+
+        Args:
+            term: Search term; empty matches every code
+
+        Returns:
+            Mapping of category to {code: description} for matching codes,
+            in codeframe order
+        """
+        term = term.strip().lower()
+        if not term:
+            positions: Iterable[int] = range(len(self.codes))
+        elif len(term) >= NGRAM_SIZE:
+            candidates: Optional[Set[int]] = None
+            for i in range(len(term) - NGRAM_SIZE + 1):
+                postings = self._ngrams.get(term[i:i + NGRAM_SIZE])
+                if not postings:
+                    return {}
+                candidates = set(postings) if candidates is None else candidates & postings
+            positions = sorted(p for p in candidates if term in self._haystacks[p])
+        else:
+            positions = [p for p, haystack in enumerate(self._haystacks) if term in haystack]
+
+        matches: Dict[str, Dict[str, str]] = {}
+        for position in positions:
+            code = self.codes[position]
+            category, description = self._lookup[code]
+            matches.setdefault(category, {})[code] = description
+        return matches
+
+
+@lru_cache(maxsize=8)
+def _load_codeframe(path: str, modified: int) -> Codeframe:
+    return Codeframe.from_file(path)
+
+
+def load_codeframe(path: str = DEFAULT_CODEFRAME_PATH) -> Codeframe:
+    """
+    Return the process-wide Codeframe for a file.
+
+    The file is parsed once per process and again only when it is modified,
+    so edits to the codeframe are still picked up.
+
+    Args:
+        path: Path to the codeframe JSON file
+
+    Returns:
+        Shared Codeframe instance
+    """
+    return _load_codeframe(os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+
+class CodeframeDiff:
+    """
+    Differences between two codeframe versions, by code.
+
+    Attributes:
+        added: Codes only in the new version
+        removed: Codes only in the old version, e.g. merged into another
+        changed: Codes whose description was reworded, mapped to
+            (old description, new description)
+        moved: Codes that only moved to another category, mapped to
+            (old category, new category); these do not affect codings
+    """
+
+    def __init__(self, old: Codeframe, new: Codeframe):
+        self.old_version = old.content_hash
+        self.new_version = new.content_hash
+        self.added: Tuple[str, ...] = tuple(code for code in new.codes if code not in old)
+        self.removed: Tuple[str, ...] = tuple(code for code in old.codes if code not in new)
+        self.changed: Dict[str, Tuple[str, str]] = {}
+        self.moved: Dict[str, Tuple[str, str]] = {}
+        for code in new.codes:
+            if code not in old:
+                continue
+            old_category, old_description = old.lookup(code)
+            new_category, new_description = new.lookup(code)
+            if old_description != new_description:
+                self.changed[code] = (old_description, new_description)
+            elif old_category != new_category:
+                self.moved[code] = (old_category, new_category)
+
+    @property
+    def invalidated(self) -> Set[str]:
+        """Codes whose existing assignments can no longer be trusted."""
+        return set(self.removed) | set(self.changed)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+    def summary(self) -> str:
+        """Describe the change in one line, e.g. '2 added, 1 removed, 3 reworded'."""
+        parts = [
+            f"{len(self.added)} added",
+            f"{len(self.removed)} removed",
+            f"{len(self.changed)} reworded",
+        ]
+        if self.moved:
+            parts.append(f"{len(self.moved)} moved")
+        return ", ".join(parts)
+
+
+def save_codeframe_version(codeframe: Codeframe, directory: str = DEFAULT_VERSIONS_DIR) -> str:
+    """
+    Keep a snapshot of a codeframe version, so later edits can be diffed against it.
+
+    Args:
+        codeframe: Codeframe to snapshot
+        directory: Directory of snapshots
+
+    Returns:
+        Path of the snapshot
+    """
+    path = os.path.join(directory, f"{codeframe.content_hash}.json")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(codeframe.to_dict(), f, ensure_ascii=False)
+        os.replace(temporary, path)
+    return path
+
+
+def load_codeframe_version(version: str, directory: str = DEFAULT_VERSIONS_DIR) -> Codeframe:
+    """
+    Load the snapshot of a codeframe version.
+
+    Args:
+        version: Content hash of the codeframe
+        directory: Directory of snapshots
+
+    Returns:
+        Codeframe instance
+
+    Raises:
+        FileNotFoundError: If no snapshot of the version was saved
+    """
+    return Codeframe.from_file(os.path.join(directory, f"{version}.json"))
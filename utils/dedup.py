@@ -0,0 +1,273 @@
+import hashlib
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from utils.parser import clean_response
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.9
+DEFAULT_NUM_PERM = 64
+SHINGLE_SIZE = 5
+# Mersenne prime used for the universal hash family
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+# Exact and band keys a bounded index keeps per cluster on average before
+# forgetting old clusters early; near-duplicates add keys to their cluster
+KEYS_PER_CLUSTER = 32
+
+
+def normalize_for_dedup(text: str) -> str:
+    """
+    Normalize a response for duplicate detection.
+
+    Args:
+        text: Raw response text
+
+    Returns:
+        Cleaned, lower-cased response text
+    """
+    return clean_response(text).lower()
+
+
+def _optimal_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """
+    Choose LSH bands and rows per band for a similarity threshold.
+
+    Picks the split minimizing the combined false positive and false
+    negative probability mass around the threshold.
+
+    Args:
+        num_perm: Number of MinHash permutations
+        threshold: Jaccard similarity threshold
+
+    Returns:
+        (bands, rows) with bands * rows <= num_perm
+    """
+    similarities = np.linspace(0.0, 1.0, 201)
+    best = (1, num_perm)
+    best_error = float("inf")
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        collision = 1.0 - (1.0 - similarities ** rows) ** bands
+        below = similarities < threshold
+        error = collision[below].sum() + (1.0 - collision[~below]).sum()
+        if error < best_error:
+            best_error = error
+            best = (bands, rows)
+    return best
+
+
+class NearDuplicateIndex:
+    """
+    Incremental exact and near-duplicate clustering of responses.
+
+    Exact duplicates are found by hashing the normalized text. Remaining
+    responses are compared with MinHash signatures over character shingles,
+    using LSH banding so each response is checked against a constant number
+    of candidates. Responses to different questions are never clustered
+    together. Adding a response is O(1) in the number already indexed.
+
+    With max_clusters, the index keeps only the most recent clusters: once
+    there are more, the oldest are forgotten and a later duplicate of one
+    starts a new cluster, so memory stays bounded however many responses
+    are added. Cluster IDs are never reused.
+
+    Args:
+        threshold: Estimated Jaccard similarity needed to join a cluster
+        num_perm: Number of MinHash permutations
+        seed: Seed of the hash family
+        max_clusters: Clusters kept, or None to keep every cluster
+    """
+
+    def __init__(
+        self,
+        threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+        num_perm: int = DEFAULT_NUM_PERM,
+        seed: int = 1,
+        max_clusters: Optional[int] = None
+    ):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands, self.rows = _optimal_bands(num_perm, threshold)
+        rng = np.random.default_rng(seed)
+        # a, b < 2**32 so a * x + b fits in uint64 for 32-bit shingle hashes
+        self._a = rng.integers(1, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+        self.max_clusters = max_clusters
+        self._exact: Dict[bytes, int] = {}
+        self._buckets: List[Dict[bytes, int]] = [{} for _ in range(self.bands)]
+        # Signature of each indexed cluster, oldest first
+        self._signatures: Dict[int, np.ndarray] = {}
+        # Row of each indexed cluster's representative, by cluster ID
+        self.representatives: Dict[int, int] = {}
+        # With max_clusters, the exact (-1) and band keys pointing at each cluster
+        self._keys: Dict[int, List[Tuple[int, bytes]]] = {}
+        self._key_count = 0
+        self._next_cluster = 0
+        self._count = 0
+
+    def __contains__(self, cluster_id: int) -> bool:
+        """Whether a cluster is still indexed, i.e. has not been forgotten."""
+        return cluster_id in self._signatures
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def signature(self, normalized: str) -> np.ndarray:
+        """
+        Compute the MinHash signature of a normalized response.
+
+        Args:
+            normalized: Text from normalize_for_dedup
+
+        Returns:
+            Array of num_perm uint32 hash minima
+        """
+        if len(normalized) <= SHINGLE_SIZE:
+            shingles = {normalized}
+        else:
+            shingles = {
+                normalized[i:i + SHINGLE_SIZE]
+                for i in range(len(normalized) - SHINGLE_SIZE + 1)
+            }
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles)
+        )
+        permuted = (self._a * hashes + self._b) % MERSENNE_PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    @staticmethod
+    def _exact_key(normalized: str, question: str) -> Tuple[bytes, bytes]:
+        """Return the question key and exact-duplicate key of a normalized response."""
+        question_key = hashlib.blake2b(question.strip().encode("utf-8"), digest_size=8).digest()
+        return question_key, question_key + hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+    def _band_keys(self, signature: np.ndarray, question_key: bytes) -> List[bytes]:
+        return [
+            question_key + signature[band * self.rows:(band + 1) * self.rows].tobytes()
+            for band in range(self.bands)
+        ]
+
+    def add(self, response: str, question: str = "") -> Tuple[int, bool]:
+        """
+        Assign a response to a cluster, creating one if it is new.
+
+        Args:
+            response: Raw response text
+            question: The question the response answers
+
+        Returns:
+            (cluster_id, is_new) where is_new means the response is the
+            representative of a new cluster
+        """
+        row = self._count
+        self._count += 1
+
+        normalized = normalize_for_dedup(response)
+        question_key, exact_key = self._exact_key(normalized, question)
+        cluster_id = self._exact.get(exact_key)
+        if cluster_id is not None:
+            return cluster_id, False
+
+        signature = self.signature(normalized)
+        band_keys = self._band_keys(signature, question_key)
+
+        match = None
+        checked = set()
+        for band, band_key in enumerate(band_keys):
+            candidate = self._buckets[band].get(band_key)
+            if candidate is None or candidate in checked:
+                continue
+            checked.add(candidate)
+            similarity = np.mean(signature == self._signatures[candidate])
+            if similarity >= self.threshold:
+                match = candidate
+                break
+
+        is_new = match is None
+        if is_new:
+            match = self._next_cluster
+            self._next_cluster += 1
+            self.representatives[match] = row
+            self._signatures[match] = signature
+        self._index(match, exact_key, band_keys)
+        return match, is_new
+
+    def restore(self, representatives: Iterable[Tuple[int, int, str, str]], responses_added: int) -> None:
+        """
+        Rebuild an index from the representatives of a saved one.
+
+        Clusters keep their IDs. Later responses are matched against each
+        representative, but not against the other members of its cluster.
+
+        Args:
+            representatives: (cluster_id, row, response, question) of each
+                cluster to restore, oldest first
+            responses_added: Number of responses the saved index had been given
+        """
+        for cluster_id, row, response, question in representatives:
+            normalized = normalize_for_dedup(response)
+            question_key, exact_key = self._exact_key(normalized, question)
+            signature = self.signature(normalized)
+            band_keys = self._band_keys(signature, question_key)
+            self.representatives[cluster_id] = row
+            self._signatures[cluster_id] = signature
+            self._next_cluster = max(self._next_cluster, cluster_id + 1)
+            self._index(cluster_id, exact_key, band_keys)
+        self._count = max(self._count, responses_added)
+
+    def _index(self, cluster_id: int, exact_key: bytes, band_keys: List[bytes]) -> None:
+        """Point a response's exact key and unclaimed band keys at its cluster."""
+        added = [(-1, exact_key)]
+        for band, band_key in enumerate(band_keys):
+            if band_key not in self._buckets[band]:
+                self._buckets[band][band_key] = cluster_id
+                added.append((band, band_key))
+        self._exact[exact_key] = cluster_id
+        if self.max_clusters is not None:
+            self._keys.setdefault(cluster_id, []).extend(added)
+            self._key_count += len(added)
+            self._forget_oldest()
+
+    def _forget_oldest(self) -> None:
+        """Drop the oldest clusters while over max_clusters or the key budget."""
+        while len(self._signatures) > 1 and (
+            len(self._signatures) > self.max_clusters
+            or self._key_count > self.max_clusters * KEYS_PER_CLUSTER
+        ):
+            oldest = next(iter(self._signatures))
+            del self._signatures[oldest]
+            del self.representatives[oldest]
+            keys = self._keys.pop(oldest, [])
+            self._key_count -= len(keys)
+            for band, key in keys:
+                table = self._exact if band < 0 else self._buckets[band]
+                if table.get(key) == oldest:
+                    del table[key]
+
+
+def cluster_responses(
+    responses: List[Dict],
+    threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+    num_perm: int = DEFAULT_NUM_PERM
+) -> Tuple[List[int], List[int]]:
+    """
+    Cluster exact and near-duplicate responses.
+
+    Args:
+        responses: List of dictionaries containing 'question' and 'response'
+        threshold: Estimated Jaccard similarity needed to join a cluster
+        num_perm: Number of MinHash permutations
+
+    Returns:
+        (cluster_ids, representatives): the cluster ID of every response, and
+        for each cluster ID the index of its representative response
+    """
+    index = NearDuplicateIndex(threshold=threshold, num_perm=num_perm)
+    cluster_ids = [
+        index.add(item["response"], item["question"])[0]
+        for item in responses
+    ]
+    return cluster_ids, list(index.representatives.values())
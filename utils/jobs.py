@@ -0,0 +1,735 @@
+import codecs
+import csv
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, IO, Iterator, List, Optional, Set, Tuple
+
+from utils.batch import (
+    DEFAULT_CHUNK_SIZE,
+    OUTPUT_FORMATS,
+    REQUIRED_COLUMNS,
+    DuplicateClusters,
+    ResultWriter,
+    code_chunk,
+)
+from utils.codeframe import save_codeframe_version
+from utils.results_store import ResultsStore
+
+# Queue database, and the directory holding each job's copy of its input
+DEFAULT_JOBS_PATH = os.getenv("JOBS_PATH", ".cache/jobs.sqlite")
+DEFAULT_JOBS_DIR = os.getenv("JOBS_DIR", ".cache/jobs")
+JOB_STATUSES = ("queued", "running", "completed", "failed", "cancelled")
+# A job whose worker has not sent a heartbeat for this long is taken over by another
+JOB_LEASE_SECONDS = 30
+HEARTBEAT_SECONDS = 10
+# How long an idle worker waits before polling the queue again
+POLL_SECONDS = 1.0
+# Checkpointed rows read per query when exporting results
+EXPORT_PAGE_SIZE = 1000
+JOB_COLUMNS = (
+    "id", "name", "status", "input_path", "output_path", "output_format",
+    "options", "fieldnames", "data_offset", "total_rows", "rows_done", "errors",
+    "next_row", "next_offset", "processing_seconds", "created_at", "started_at",
+    "served_at", "finished_at", "worker_id", "lease_until", "error"
+)
+
+
+def _csv_lines(file: IO[bytes]) -> Iterator[str]:
+    """Decode a binary file line by line, so file.tell() stays exact between rows."""
+    for line in iter(file.readline, b""):
+        yield line.decode("utf-8")
+
+
+def read_rows(
+    path: str,
+    offset: int,
+    first_row: int,
+    fieldnames: List[str],
+    limit: Optional[int] = None
+) -> Tuple[List[Dict], int]:
+    """
+    Read data rows of a CSV file starting at a byte offset.
+
+    Args:
+        path: CSV file path
+        offset: Byte offset of the first row to read
+        first_row: Data row number of that row
+        fieldnames: Header of the file
+        limit: Maximum number of rows to read
+
+    Returns:
+        Tuple of rows (with 'row', 'question' and 'response') and the byte
+        offset just after the last row read
+    """
+    rows = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for values in csv.reader(_csv_lines(f)):
+            offset = f.tell()
+            # Blank lines are skipped, as csv.DictReader does
+            if not values:
+                continue
+            row = dict(zip(fieldnames, values))
+            rows.append({
+                "row": first_row + len(rows),
+                "question": row.get("question") or "",
+                "response": row.get("response") or ""
+            })
+            if limit is not None and len(rows) >= limit:
+                break
+    return rows, offset
+
+
+class JobQueue:
+    """
+    Durable queue of batch coding jobs.
+
+    Jobs, their progress and every coded row live in SQLite, so a job
+    outlives the browser session and process that submitted it. Workers
+    claim a job for one slice of `chunk_size` rows at a time, always taking
+    the job served least recently, so queued jobs advance in turn. Each
+    coded row is checkpointed as soon as its request completes, and the
+    input offset is saved after each slice, so a job resumes exactly where
+    it stopped, even after a crash.
+    """
+
+    def __init__(self, path: str = DEFAULT_JOBS_PATH, jobs_dir: str = DEFAULT_JOBS_DIR):
+        self.path = path
+        self.jobs_dir = jobs_dir
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so reopen in child processes
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    input_path TEXT NOT NULL,
+                    output_path TEXT NOT NULL,
+                    output_format TEXT NOT NULL,
+                    options TEXT NOT NULL,
+                    fieldnames TEXT NOT NULL,
+                    data_offset INTEGER NOT NULL,
+                    total_rows INTEGER NOT NULL,
+                    rows_done INTEGER NOT NULL DEFAULT 0,
+                    errors INTEGER NOT NULL DEFAULT 0,
+                    next_row INTEGER NOT NULL DEFAULT 0,
+                    next_offset INTEGER NOT NULL,
+                    processing_seconds REAL NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    served_at REAL,
+                    finished_at REAL,
+                    worker_id TEXT,
+                    lease_until REAL,
+                    error TEXT
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS job_rows (
+                    job_id TEXT NOT NULL,
+                    row INTEGER NOT NULL,
+                    record TEXT NOT NULL,
+                    PRIMARY KEY (job_id, row)
+                ) WITHOUT ROWID"""
+            )
+            # Duplicate clusters of deduplicating jobs, so another worker can
+            # take one over without replaying its input
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS job_clusters (
+                    job_id TEXT NOT NULL,
+                    cluster_id INTEGER NOT NULL,
+                    row INTEGER NOT NULL,
+                    question TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    coding TEXT,
+                    PRIMARY KEY (job_id, cluster_id)
+                ) WITHOUT ROWID"""
+            )
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _transaction(self, work):
+        """Run work(conn) in an immediate transaction and return its result."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    @staticmethod
+    def _describe(row: Tuple) -> Dict:
+        """Turn a jobs row into a job dictionary with derived progress figures."""
+        job = dict(zip(JOB_COLUMNS, row))
+        job["options"] = json.loads(job["options"])
+        job["fieldnames"] = json.loads(job["fieldnames"])
+        seconds = job["processing_seconds"]
+        if job["status"] == "running" and job["worker_id"] is not None:
+            # Include the slice in progress
+            seconds += time.time() - job["served_at"]
+        rate = job["rows_done"] / seconds if seconds > 0 else 0.0
+        job["rows_per_second"] = rate
+        job["eta_seconds"] = (
+            max(job["total_rows"] - job["rows_done"], 0) / rate
+            if rate > 0 and job["status"] in ("queued", "running") else None
+        )
+        return job
+
+    def submit(
+        self,
+        file: IO[bytes],
+        output_path: str,
+        name: str = "batch.csv",
+        output_format: str = "jsonl",
+        packed: bool = False,
+        dedup: bool = False,
+        compact: bool = False,
+        chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> str:
+        """
+        Queue a CSV of responses for coding.
+
+        The file is copied into jobs_dir, so the caller's copy may go away.
+
+        Args:
+            file: Binary file object with 'question' and 'response' columns
+            output_path: Where the results are written when the job completes
+            name: Display name, e.g. the uploaded file name
+            output_format: 'jsonl' or 'csv'
+            packed: Code several responses per request
+            dedup: Collapse exact and near-duplicate responses
+            compact: Return only codes and confidences
+            chunk_size: Rows per slice, the unit of scheduling
+
+        Returns:
+            ID of the new job
+
+        Raises:
+            ValueError: If the file is not UTF-8 CSV with the required columns,
+                or the output format is unsupported
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format: {output_format}")
+        job_id = uuid.uuid4().hex[:12]
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        input_path = os.path.join(self.jobs_dir, f"{job_id}.csv")
+        with open(input_path, "wb") as f:
+            shutil.copyfileobj(file, f)
+
+        try:
+            with open(input_path, "rb") as f:
+                data_offset = len(codecs.BOM_UTF8) if f.read(3) == codecs.BOM_UTF8 else 0
+                f.seek(data_offset)
+                reader = csv.reader(_csv_lines(f))
+                fieldnames = next(reader, [])
+                data_offset = f.tell()
+                missing = [c for c in REQUIRED_COLUMNS if c not in fieldnames]
+                if missing:
+                    raise ValueError(f"CSV is missing required columns: {', '.join(missing)}")
+                total_rows = sum(1 for values in reader if values)
+        except UnicodeDecodeError as e:
+            os.remove(input_path)
+            raise ValueError(f"CSV is not UTF-8 encoded: {str(e)}")
+        except ValueError:
+            os.remove(input_path)
+            raise
+
+        options = {"packed": packed, "dedup": dedup, "compact": compact, "chunk_size": chunk_size}
+        self._transaction(lambda conn: conn.execute(
+            "INSERT INTO jobs (id, name, status, input_path, output_path, output_format, "
+            "options, fieldnames, data_offset, total_rows, next_offset, created_at) "
+            "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, name, input_path, output_path, output_format, json.dumps(options),
+             json.dumps(fieldnames), data_offset, total_rows, data_offset, time.time())
+        ))
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Return a job's state and progress, or None for unknown jobs."""
+        with self._lock:
+            row = self._connection().execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._describe(row) if row else None
+
+    def list_jobs(self, limit: int = 20) -> List[Dict]:
+        """Return the most recently submitted jobs, newest first."""
+        with self._lock:
+            rows = self._connection().execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs ORDER BY created_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [self._describe(row) for row in rows]
+
+    def claim(self, worker_id: str) -> Optional[Dict]:
+        """
+        Take the next slice of work.
+
+        Picks the queued or running job that was served least recently (new
+        jobs first) and is not held by a live worker, and leases it to
+        `worker_id`.
+
+        Args:
+            worker_id: ID of the claiming worker
+
+        Returns:
+            The claimed job, or None if there is nothing to do
+        """
+        def work(conn):
+            now = time.time()
+            row = conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs "
+                "WHERE status IN ('queued', 'running') AND (lease_until IS NULL OR lease_until < ?) "
+                "ORDER BY served_at IS NOT NULL, served_at, created_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker_id = ?, lease_until = ?, "
+                "served_at = ?, started_at = COALESCE(started_at, ?) WHERE id = ?",
+                (worker_id, now + JOB_LEASE_SECONDS, now, now, row[0])
+            )
+            return row
+        row = self._transaction(work)
+        return self._describe(row) if row else None
+
+    def _holds(self, conn: sqlite3.Connection, job_id: str, worker_id: str) -> bool:
+        held = conn.execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (time.time() + JOB_LEASE_SECONDS, job_id, worker_id)
+        )
+        return held.rowcount == 1
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Extend a worker's lease. Returns False if the job was cancelled or taken over."""
+        return self._transaction(lambda conn: self._holds(conn, job_id, worker_id))
+
+    def checkpoint(
+        self,
+        job_id: str,
+        worker_id: str,
+        records: List[Dict],
+        clusters: Optional[List[Tuple[int, int, str, str, Optional[Dict]]]] = None
+    ) -> bool:
+        """
+        Save coded rows and extend the lease.
+
+        Args:
+            job_id: Job the rows belong to
+            worker_id: Worker holding the job
+            records: Output records of coded rows
+            clusters: (cluster_id, row, question, text, coding) of the
+                duplicate clusters of the rows, if deduplicating, as for
+                DuplicateClusters.restore
+
+        Returns:
+            False if the worker no longer holds the job, in which case
+            nothing is saved and it should stop working on it
+        """
+        def work(conn):
+            if not self._holds(conn, job_id, worker_id):
+                return False
+            saved = errors = 0
+            for record in records:
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO job_rows (job_id, row, record) VALUES (?, ?, ?)",
+                    (job_id, record["row"], json.dumps(record, ensure_ascii=False))
+                ).rowcount
+                saved += inserted
+                errors += inserted if record["error"] else 0
+            conn.execute(
+                "UPDATE jobs SET rows_done = rows_done + ?, errors = errors + ? WHERE id = ?",
+                (saved, errors, job_id)
+            )
+            conn.executemany(
+                "INSERT INTO job_clusters (job_id, cluster_id, row, question, response, coding) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (job_id, cluster_id) DO UPDATE SET "
+                "row = MIN(row, excluded.row), coding = COALESCE(excluded.coding, coding)",
+                [
+                    (job_id, cluster_id, row, question, text,
+                     None if coding is None else json.dumps(coding, ensure_ascii=False))
+                    for cluster_id, row, question, text, coding in clusters or ()
+                ]
+            )
+            return True
+        return self._transaction(work)
+
+    def saved_clusters(self, job_id: str, limit: int) -> List[Tuple[int, int, str, str, Optional[Dict]]]:
+        """
+        Return the most recent duplicate clusters checkpointed for a job.
+
+        Args:
+            job_id: Job the clusters belong to
+            limit: Number of clusters to return
+
+        Returns:
+            (cluster_id, row, question, text, coding) of each cluster, oldest
+            first, as for DuplicateClusters.restore
+        """
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT cluster_id, row, question, response, coding FROM job_clusters "
+                "WHERE job_id = ? ORDER BY cluster_id DESC LIMIT ?",
+                (job_id, limit)
+            ).fetchall()
+        return [
+            (cluster_id, row, question, text, None if coding is None else json.loads(coding))
+            for cluster_id, row, question, text, coding in reversed(rows)
+        ]
+
+    def done_rows(self, job_id: str, first: int, last: int) -> Set[int]:
+        """Return the checkpointed row numbers between first and last inclusive."""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT row FROM job_rows WHERE job_id = ? AND row BETWEEN ? AND ?",
+                (job_id, first, last)
+            ).fetchall()
+        return {row for row, in rows}
+
+    def advance(
+        self,
+        job_id: str,
+        worker_id: str,
+        next_row: int,
+        next_offset: int,
+        seconds: float,
+        release: bool = True
+    ) -> bool:
+        """
+        Record a finished slice and release the job for the next claim.
+
+        Args:
+            job_id: Job the slice belongs to
+            worker_id: Worker holding the job
+            next_row: Data row number the next slice starts at
+            next_offset: Byte offset of that row in the input
+            seconds: Time spent on the slice
+            release: Give up the lease; False keeps it, e.g. to complete the job
+
+        Returns:
+            False if the worker no longer held the job
+        """
+        def work(conn):
+            if not self._holds(conn, job_id, worker_id):
+                return False
+            conn.execute(
+                "UPDATE jobs SET next_row = ?, next_offset = ?, "
+                "processing_seconds = processing_seconds + ? WHERE id = ?",
+                (next_row, next_offset, seconds, job_id)
+            )
+            if release:
+                conn.execute(
+                    "UPDATE jobs SET worker_id = NULL, lease_until = NULL WHERE id = ?", (job_id,)
+                )
+            return True
+        return self._transaction(work)
+
+    def export(self, job_id: str, path: Optional[str] = None) -> str:
+        """
+        Write a job's checkpointed rows, in row order, to an output file.
+
+        Works while the job is still running, for partial results.
+
+        Args:
+            job_id: Job to export
+            path: Output path; defaults to the job's output_path
+
+        Returns:
+            Path written
+
+        Raises:
+            KeyError: If the job does not exist
+        """
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        path = path or job["output_path"]
+        last_row = -1
+        with ResultWriter(path, job["output_format"]) as writer:
+            while True:
+                with self._lock:
+                    page = self._connection().execute(
+                        "SELECT row, record FROM job_rows WHERE job_id = ? AND row > ? "
+                        "ORDER BY row LIMIT ?",
+                        (job_id, last_row, EXPORT_PAGE_SIZE)
+                    ).fetchall()
+                if not page:
+                    break
+                writer.write([json.loads(record) for _, record in page])
+                last_row = page[-1][0]
+        return path
+
+    def complete(self, job_id: str, worker_id: str) -> bool:
+        """
+        Write a finished job's results and drop its checkpoints and input copy.
+
+        The results are exported to a temporary file that only replaces
+        output_path once the job is marked completed.
+
+        Returns:
+            False if the worker no longer held the job, in which case nothing
+            is written
+        """
+        if not self.heartbeat(job_id, worker_id):
+            return False
+        job = self.get(job_id)
+
+        def work(conn):
+            finished = conn.execute(
+                "UPDATE jobs SET status = 'completed', finished_at = ?, worker_id = NULL, "
+                "lease_until = NULL WHERE id = ? AND worker_id = ? AND status = 'running'",
+                (time.time(), job_id, worker_id)
+            ).rowcount == 1
+            if finished:
+                conn.execute("DELETE FROM job_rows WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM job_clusters WHERE job_id = ?", (job_id,))
+            return finished
+
+        temp_path = f"{job['output_path']}.{worker_id}.tmp"
+        try:
+            self.export(job_id, temp_path)
+            finished = self._transaction(work)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if not finished:
+            os.remove(temp_path)
+            return False
+        os.replace(temp_path, job["output_path"])
+        if os.path.exists(job["input_path"]):
+            os.remove(job["input_path"])
+        return True
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        """
+        Mark a job as failed; its checkpoints are kept so it can be resumed.
+
+        Args:
+            job_id: Job that failed
+            worker_id: Worker holding the job
+            error: Error message shown for the job
+
+        Returns:
+            False if the worker no longer held the job, which is then left
+            to its new owner
+        """
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, worker_id = NULL, "
+            "lease_until = NULL WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (error, time.time(), job_id, worker_id)
+        ).rowcount == 1)
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Stop a queued or running job. Its worker stops at the next checkpoint.
+
+        Returns:
+            True if the job was active
+        """
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'cancelled', finished_at = ?, worker_id = NULL, "
+            "lease_until = NULL WHERE id = ? AND status IN ('queued', 'running')",
+            (time.time(), job_id)
+        ).rowcount == 1)
+
+    def resume(self, job_id: str) -> bool:
+        """
+        Queue a failed or cancelled job again, continuing from its checkpoint.
+
+        Returns:
+            True if the job was requeued
+        """
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'queued', error = NULL, finished_at = NULL "
+            "WHERE id = ? AND status IN ('failed', 'cancelled')",
+            (job_id,)
+        ).rowcount == 1)
+
+
+class JobWorker:
+    """
+    Worker processing slices of queued jobs with a ClaudeCoder.
+
+    Runs outside the Streamlit script, in a background thread or in
+    worker.py. While a slice is being coded, a heartbeat thread keeps the
+    lease alive; if the worker dies, another one takes the job over once
+    the lease expires.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        coder,
+        worker_id: Optional[str] = None,
+        results_store: Optional[ResultsStore] = None
+    ):
+        self.queue = queue
+        self.coder = coder
+        self.results_store = results_store
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        # Duplicate clusters per deduplicating job, valid while next_row matches
+        self._dedup_state: Dict[str, Tuple[int, DuplicateClusters]] = {}
+
+    def _duplicates(self, job: Dict) -> DuplicateClusters:
+        """
+        Return a job's duplicate clusters, restoring the checkpointed ones if
+        another worker ran the last slice.
+        """
+        state = self._dedup_state.get(job["id"])
+        if state is not None and state[0] == job["next_row"]:
+            return state[1]
+        clusters = DuplicateClusters()
+        clusters.restore(self.queue.saved_clusters(job["id"], clusters.index.max_clusters), job["next_row"])
+        return clusters
+
+    @staticmethod
+    def _clusters_of(records: List[Dict], clusters: DuplicateClusters) -> List[Tuple[int, int, str, str, Optional[Dict]]]:
+        """Return the clusters of checkpointed rows, as saved with them."""
+        saved = {}
+        for record in records:
+            cluster_id = record["cluster_id"]
+            if cluster_id not in clusters.texts:
+                continue
+            if cluster_id not in saved or record["row"] < saved[cluster_id][1]:
+                saved[cluster_id] = (
+                    cluster_id, record["row"], record["question"],
+                    clusters.texts[cluster_id], clusters.codings.get(cluster_id)
+                )
+        return list(saved.values())
+
+    def _run_slice(self, job: Dict) -> None:
+        started = time.monotonic()
+        options = job["options"]
+        coder = self.coder.with_options(compact=True) if options["compact"] else self.coder
+        save_codeframe_version(coder.codeframe)
+        chunk, next_offset = read_rows(
+            job["input_path"], job["next_offset"], job["next_row"], job["fieldnames"],
+            options["chunk_size"]
+        )
+        clusters = self._duplicates(job) if options["dedup"] else None
+        skip = self.queue.done_rows(job["id"], job["next_row"], job["next_row"] + len(chunk) - 1)
+
+        for records in code_chunk(coder, chunk, options["packed"], clusters, skip):
+            saved = None if clusters is None else self._clusters_of(records, clusters)
+            if not self.queue.checkpoint(job["id"], self.worker_id, records, saved):
+                logging.info(f"Job {job['id']} was cancelled or taken over; stopping")
+                self._dedup_state.pop(job["id"], None)
+                return
+
+        next_row = job["next_row"] + len(chunk)
+        # A short slice means the input is exhausted; keep the lease to complete the job
+        finished = len(chunk) < options["chunk_size"]
+        advanced = self.queue.advance(
+            job["id"], self.worker_id, next_row, next_offset,
+            time.monotonic() - started, release=not finished
+        )
+        if not advanced or finished:
+            self._dedup_state.pop(job["id"], None)
+            if advanced and self.queue.complete(job["id"], self.worker_id):
+                self._store_results(job)
+        elif clusters is not None:
+            self._dedup_state[job["id"]] = (next_row, clusters)
+
+    def _store_results(self, job: Dict) -> None:
+        """Add a completed job's results to the results store, named by job ID."""
+        if self.results_store is None:
+            return
+        try:
+            with open(job["output_path"], encoding="utf-8", newline="") as f:
+                self.results_store.add_results_file(f, job["output_format"], job["id"])
+        except Exception as e:
+            # The job's output file is complete; only the analytics copy is missing
+            logging.error(f"Error storing results of job {job['id']}: {str(e)}")
+
+    def run_once(self) -> bool:
+        """
+        Claim and code one slice.
+
+        Returns:
+            False if there was nothing to do
+        """
+        job = self.queue.claim(self.worker_id)
+        if job is None:
+            return False
+
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(HEARTBEAT_SECONDS):
+                if not self.queue.heartbeat(job["id"], self.worker_id):
+                    return
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            self._run_slice(job)
+        except Exception as e:
+            logging.error(f"Job {job['id']} failed: {str(e)}")
+            if not self.queue.fail(job["id"], self.worker_id, str(e)):
+                logging.info(f"Job {job['id']} was taken over; leaving it to its new worker")
+        finally:
+            stopped.set()
+            beat.join()
+        return True
+
+    def run(self, stop: Optional[threading.Event] = None, poll_seconds: float = POLL_SECONDS) -> None:
+        """Process jobs until `stop` is set, polling while the queue is empty."""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if not self.run_once():
+                stop.wait(poll_seconds)
+
+
+def start_workers(
+    queue: JobQueue,
+    coder,
+    count: int,
+    stop: Optional[threading.Event] = None,
+    results_store: Optional[ResultsStore] = None
+) -> List[threading.Thread]:
+    """
+    Start `count` job workers in daemon threads.
+
+    Args:
+        queue: Queue to take jobs from
+        coder: ClaudeCoder shared by the workers
+        count: Number of workers
+        stop: Event that stops the workers when set
+        results_store: Store completed jobs' results are added to, if any
+
+    Returns:
+        The started threads
+    """
+    threads = []
+    for _ in range(count):
+        worker = JobWorker(queue, coder, results_store=results_store)
+        thread = threading.Thread(target=worker.run, args=(stop,), daemon=True, name=f"job-worker-{worker.worker_id}")
+        thread.start()
+        threads.append(thread)
+    return threads
@@ -1,5 +1,21 @@
 import re
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional, Union
+
+from utils.codeframe import Codeframe
+from utils.tracing import span
+
+# Patterns are compiled once at import rather than on every call. The bracket
+# patterns use negated classes, equivalent to `\[.*?\]` without backtracking.
+BRACKETS_PATTERN = re.compile(r'\[[^\]\n]*\]')  # [comments]
+PARENTHESES_PATTERN = re.compile(r'\([^)\n]*\)')  # (parentheses)
+# Runs of repeated punctuation and the character each collapses to
+REPEATED_PUNCTUATION = (("..", "."), ("!!", "!"), ("??", "?"))
+QUOTED_PATTERN = re.compile(r'["\'](.*?)["\']')
+REPORTED_SPEECH_PATTERN = re.compile(
+    r'\b(?:said|stated|mentioned|commented)\s+(?:that\s+)?([^.,!?]+)',
+    re.IGNORECASE
+)
+COMPOUND_SPLIT_PATTERN = re.compile(r'\s*(?:but|however|although|though|and|or|;|\.)\s+')
 
 def clean_response(text: str) -> str:
     """
@@ -11,17 +27,24 @@ def clean_response(text: str) -> str:
     Returns:
         Cleaned response text
     """
+    with span("clean_response", input_chars=len(text)):
+        return _clean_response(text)
+
+def _clean_response(text: str) -> str:
+    # Untraced body of clean_response, also run per text by the batch functions
     # Remove extra whitespace
-    text = re.sub(r'\s+', ' ', text).strip()
+    text = " ".join(text.split())
     
-    # Remove common artifacts
-    text = re.sub(r'\[.*?\]', '', text)  # Remove [comments]
-    text = re.sub(r'\(.*?\)', '', text)  # Remove (parentheses)
+    # Remove common artifacts, skipping the regex when there is nothing to remove
+    if "[" in text:
+        text = BRACKETS_PATTERN.sub('', text)  # Remove [comments]
+    if "(" in text:
+        text = PARENTHESES_PATTERN.sub('', text)  # Remove (parentheses)
     
-    # Normalize punctuation
-    text = re.sub(r'\.{2,}', '.', text)  # Replace multiple dots with single
-    text = re.sub(r'!{2,}', '!', text)   # Replace multiple ! with single
-    text = re.sub(r'\?{2,}', '?', text)  # Replace multiple ? with single
+    # Normalize punctuation: halving pairs until none remain collapses each run to one
+    for pair, single in REPEATED_PUNCTUATION:
+        while pair in text:
+            text = text.replace(pair, single)
     
     return text
 
@@ -36,10 +59,10 @@ def extract_quotes(text: str) -> List[str]:
         List of quoted phrases
     """
     # Match text between quotes
-    quotes = re.findall(r'["\'](.*?)["\']', text)
+    quotes = QUOTED_PATTERN.findall(text)
     
     # Also match text that might be intended as quotes without actual quotes
-    potential_quotes = re.findall(r'\b(?:said|stated|mentioned|commented)\s+(?:that\s+)?([^.,!?]+)', text, re.IGNORECASE)
+    potential_quotes = REPORTED_SPEECH_PATTERN.findall(text)
     
     return list(set(quotes + potential_quotes))
 
@@ -53,24 +76,26 @@ def split_compound_response(text: str) -> List[str]:
     Returns:
         List of individual statements
     """
-    # Split on common conjunctions and punctuation
-    statements = re.split(r'\s*(?:but|however|although|though|and|or|;|\.)\s+', text)
-    
-    # Clean and filter empty statements
-    statements = [clean_response(s) for s in statements if s.strip()]
-    
-    return statements
+    with span("split_compound_response", input_chars=len(text)) as traced:
+        # Split on common conjunctions and punctuation
+        statements = COMPOUND_SPLIT_PATTERN.split(text)
+        
+        # Clean and filter empty statements
+        statements = [_clean_response(s) for s in statements if s.strip()]
+        
+        traced.set(statements=len(statements))
+        return statements
 
 def validate_code_assignment(
     codes: List[str],
-    codeframe: Dict
+    codeframe: Union[Codeframe, Dict]
 ) -> Dict[str, List[str]]:
     """
     Validate code assignments against the codeframe.
     
     Args:
         codes: List of assigned codes
-        codeframe: Codeframe dictionary
+        codeframe: Codeframe instance or codeframe dictionary
         
     Returns:
         Dictionary with valid and invalid codes
@@ -78,10 +103,7 @@ def validate_code_assignment(
     valid_codes = []
     invalid_codes = []
     
-    # Flatten codeframe into list of all valid codes
-    all_valid_codes = []
-    for category in codeframe.get("categories", {}).values():
-        all_valid_codes.extend(category.keys())
+    all_valid_codes = _valid_code_set(codeframe)
     
     # Check each assigned code
     for code in codes:
@@ -93,4 +115,99 @@ def validate_code_assignment(
     return {
         "valid": valid_codes,
         "invalid": invalid_codes
-    } 
\ No newline at end of file
+    }
+
+def _valid_code_set(codeframe: Union[Codeframe, Dict]):
+    # Codeframe supports O(1) membership; plain dictionaries are flattened to a set
+    if isinstance(codeframe, Codeframe):
+        return codeframe
+    all_valid_codes = set()
+    for category in codeframe.get("categories", {}).values():
+        all_valid_codes.update(category.keys())
+    return all_valid_codes
+
+def _as_texts(texts: Iterable) -> List[str]:
+    # Missing values (None/NaN in a pandas Series) are treated as empty responses
+    return [text if isinstance(text, str) else "" for text in texts]
+
+def _like_input(texts: Iterable, values: List):
+    """Wrap batch results in a Series when the input was a pandas Series."""
+    if type(texts).__module__.startswith("pandas"):
+        import pandas as pd
+        return pd.Series(values, index=texts.index, name=texts.name, dtype=object)
+    return values
+
+def clean_response_batch(texts: Iterable[str]):
+    """
+    Clean and normalize many responses.
+    
+    Output is identical to calling clean_response on each text.
+    
+    Args:
+        texts: List (or pandas Series) of raw response texts
+        
+    Returns:
+        List of cleaned texts, or a Series with the same index
+    """
+    texts_list = _as_texts(texts)
+    with span("clean_response_batch", texts=len(texts_list)):
+        return _like_input(texts, [_clean_response(text) for text in texts_list])
+
+def extract_quotes_batch(texts: Iterable[str]):
+    """
+    Extract quoted phrases from many responses.
+    
+    Args:
+        texts: List (or pandas Series) of response texts
+        
+    Returns:
+        List of quote lists, or a Series with the same index
+    """
+    return _like_input(texts, [extract_quotes(text) for text in _as_texts(texts)])
+
+def split_compound_response_batch(texts: Iterable[str]):
+    """
+    Split many compound responses into individual statements.
+    
+    Output is identical to calling split_compound_response on each text.
+    
+    Args:
+        texts: List (or pandas Series) of response texts
+        
+    Returns:
+        List of statement lists, or a Series with the same index
+    """
+    split = COMPOUND_SPLIT_PATTERN.split
+    texts_list = _as_texts(texts)
+    with span("split_compound_response_batch", texts=len(texts_list)):
+        return _like_input(texts, [
+            [_clean_response(s) for s in split(text) if s.strip()]
+            for text in texts_list
+        ])
+
+def validate_code_assignment_batch(
+    code_lists: Iterable[List[str]],
+    codeframe: Union[Codeframe, Dict]
+):
+    """
+    Validate many code assignments against the codeframe.
+    
+    The set of valid codes is built once for the whole batch.
+    
+    Args:
+        code_lists: List (or pandas Series) of assigned code lists
+        codeframe: Codeframe instance or codeframe dictionary
+        
+    Returns:
+        List of dictionaries with valid and invalid codes, or a Series
+        with the same index
+    """
+    all_valid_codes = _valid_code_set(codeframe)
+    results = []
+    for codes in code_lists:
+        codes = codes if isinstance(codes, list) else []
+        results.append({
+            "valid": [code for code in codes if code in all_valid_codes],
+            "invalid": [code for code in codes if code not in all_valid_codes]
+        })
+    return _like_input(code_lists, results)
@@ -0,0 +1,262 @@
+import time
+from typing import Dict, IO, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from llm.retrieval import DEFAULT_TOP_K, get_candidate_index
+from utils.batch import DEFAULT_CHUNK_SIZE, ResultWriter, read_result_records
+from utils.codeframe import (
+    DEFAULT_VERSIONS_DIR,
+    Codeframe,
+    CodeframeDiff,
+    load_codeframe_version,
+    save_codeframe_version,
+)
+
+# Why a row is re-sent to the model
+RECODE_REASONS = ("unknown_version", "error", "invalidated_code", "new_code_candidate")
+
+
+def select_candidates(
+    codeframe: Codeframe,
+    texts: List[str],
+    codes: Iterable[str],
+    k: int = DEFAULT_TOP_K
+) -> np.ndarray:
+    """
+    Find texts that could be given any of some codes.
+
+    A text is selected when one of the codes has a non-zero BM25 score and
+    ranks in the text's top-k codes, the same shortlist ClaudeCoder uses.
+
+    Args:
+        codeframe: Codeframe the codes belong to
+        texts: Response texts
+        codes: Codes of interest, e.g. newly added ones
+        k: Shortlist size
+
+    Returns:
+        Boolean array, True for selected texts
+    """
+    index = get_candidate_index(codeframe.content_hash, codeframe.categories)
+    positions = [p for p, code in enumerate(index.codes) if code in set(codes)]
+    if not texts or not positions:
+        return np.zeros(len(texts), dtype=bool)
+    scores = index.score(texts)
+    k = min(k, len(index.codes))
+    kth_best = -np.partition(-scores, k - 1, axis=1)[:, k - 1:k]
+    wanted = scores[:, positions]
+    return ((wanted >= kth_best) & (wanted > 0)).any(axis=1)
+
+
+class RecodePlanner:
+    """
+    Decide which previously coded rows must be re-sent after a codeframe edit.
+
+    Each record carries the codeframe version it was coded with. Rows
+    already on the current version are carried forward, as are rows whose
+    codes are all unchanged, unless they are retrieval candidates for an
+    added code. Rows with errors, or coded with a version that has no saved
+    snapshot, are always re-sent.
+    """
+
+    def __init__(
+        self,
+        codeframe: Codeframe,
+        versions_dir: str = DEFAULT_VERSIONS_DIR,
+        candidate_k: int = DEFAULT_TOP_K
+    ):
+        self.codeframe = codeframe
+        self.versions_dir = versions_dir
+        self.candidate_k = candidate_k
+        self._diffs: Dict[str, Optional[CodeframeDiff]] = {}
+
+    def diff(self, version: Optional[str]) -> Optional[CodeframeDiff]:
+        """Diff from a previous version to the current one; None if it is unknown."""
+        if not version:
+            return None
+        if version not in self._diffs:
+            try:
+                old = load_codeframe_version(version, self.versions_dir)
+                self._diffs[version] = CodeframeDiff(old, self.codeframe)
+            except FileNotFoundError:
+                self._diffs[version] = None
+        return self._diffs[version]
+
+    def changes(self) -> Dict[str, str]:
+        """Summarize the diff from each previous version seen so far."""
+        return {
+            version: diff.summary() if diff is not None else "unknown version"
+            for version, diff in self._diffs.items()
+        }
+
+    def reasons(self, records: List[Dict]) -> List[Optional[str]]:
+        """
+        Decide which records of a chunk to re-send.
+
+        Args:
+            records: Output records of a previous run
+
+        Returns:
+            For each record, the reason to re-send it (one of RECODE_REASONS),
+            or None to carry it forward
+        """
+        reasons: List[Optional[str]] = [None] * len(records)
+        # Records grouped by the version they were coded with, for candidate scoring
+        by_version: Dict[str, List[int]] = {}
+        for position, record in enumerate(records):
+            version = record.get("codeframe_version")
+            if version == self.codeframe.content_hash and not record.get("error"):
+                continue
+            diff = self.diff(version)
+            if diff is None:
+                reasons[position] = "unknown_version"
+            elif record.get("error"):
+                reasons[position] = "error"
+            elif diff.invalidated.intersection(record.get("codes") or ()):
+                reasons[position] = "invalidated_code"
+            elif diff.added:
+                by_version.setdefault(version, []).append(position)
+
+        for version, positions in by_version.items():
+            selected = select_candidates(
+                self.codeframe,
+                [records[p]["cleaned_response"] for p in positions],
+                self._diffs[version].added,
+                self.candidate_k
+            )
+            for position, is_candidate in zip(positions, selected):
+                if is_candidate:
+                    reasons[position] = "new_code_candidate"
+        return reasons
+
+
+def _chunks(records: Iterator[Dict], chunk_size: int) -> Iterator[List[Dict]]:
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def plan_recode(
+    codeframe: Codeframe,
+    file: IO[str],
+    input_format: str = "jsonl",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    versions_dir: str = DEFAULT_VERSIONS_DIR,
+    candidate_k: int = DEFAULT_TOP_K
+) -> Dict:
+    """
+    Count the rows a recode would re-send, without calling the API.
+
+    Args:
+        codeframe: Current codeframe
+        file: Text file object of previous results
+        input_format: 'jsonl' or 'csv'
+        chunk_size: Records scored at a time
+        versions_dir: Directory of codeframe snapshots
+        candidate_k: Shortlist size for new-code candidates
+
+    Returns:
+        Dictionary with 'rows', 'recode' (rows to re-send), a count per
+        reason in 'reasons' and a summary of each previous version's diff
+        in 'changes'
+    """
+    planner = RecodePlanner(codeframe, versions_dir, candidate_k)
+    counts = {reason: 0 for reason in RECODE_REASONS}
+    rows = 0
+    for chunk in _chunks(read_result_records(file, input_format), chunk_size):
+        rows += len(chunk)
+        for reason in planner.reasons(chunk):
+            if reason:
+                counts[reason] += 1
+    return {
+        "rows": rows,
+        "recode": sum(counts.values()),
+        "reasons": counts,
+        "changes": planner.changes()
+    }
+
+
+def run_recode(
+    coder,
+    file: IO[str],
+    output_path: str,
+    input_format: str = "jsonl",
+    output_format: str = "jsonl",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    packed: bool = False,
+    versions_dir: str = DEFAULT_VERSIONS_DIR,
+    candidate_k: int = DEFAULT_TOP_K
+) -> Iterator[Dict]:
+    """
+    Bring a previous run's results up to date with the coder's codeframe.
+
+    Only rows that could be affected by the codeframe changes are re-sent
+    (see RecodePlanner); every other record is carried forward unchanged,
+    re-tagged with the current codeframe version. Rows are processed chunk
+    by chunk, as in run_batch.
+
+    Args:
+        coder: ClaudeCoder using the new codeframe
+        file: Text file object of previous results
+        output_path: Path of the updated results
+        input_format: Format of the previous results, 'jsonl' or 'csv'
+        output_format: 'jsonl' or 'csv'
+        chunk_size: Number of records per chunk
+        packed: Code several responses per request
+        versions_dir: Directory of codeframe snapshots
+        candidate_k: Shortlist size for new-code candidates
+
+    Yields:
+        Progress dictionaries after each chunk with 'rows_done', 'recoded',
+        'carried_forward', 'errors', 'elapsed_seconds' and 'rows_per_second'
+    """
+    started = time.time()
+    save_codeframe_version(coder.codeframe, versions_dir)
+    planner = RecodePlanner(coder.codeframe, versions_dir, candidate_k)
+    version = coder.codeframe_hash
+    rows_done = recoded = errors = 0
+
+    with ResultWriter(output_path, output_format) as writer:
+        for chunk in _chunks(read_result_records(file, input_format), chunk_size):
+            records = [{**record, "codeframe_version": version} for record in chunk]
+            # Identical responses in the chunk are only sent once
+            requests: Dict[tuple, List[int]] = {}
+            for position, reason in enumerate(planner.reasons(chunk)):
+                if reason:
+                    key = (records[position]["question"], records[position]["cleaned_response"])
+                    requests.setdefault(key, []).append(position)
+
+            keys = list(requests)
+            for coded in coder.iter_code_responses(
+                ({"question": question, "response": text} for question, text in keys),
+                packed=packed
+            ):
+                coding = coded["coding"]
+                for position in requests[keys[coded["index"]]]:
+                    records[position].update({
+                        "codes": coding.get("codes", []),
+                        "confidence": coding.get("confidence", {}),
+                        "explanation": coding.get("explanation", {}),
+                        "relevant_quotes": coding.get("relevant_quotes", {}),
+                        "error": coding.get("error")
+                    })
+            writer.write(records)
+
+            rows_done += len(records)
+            recoded += sum(len(positions) for positions in requests.values())
+            errors += sum(1 for record in records if record["error"])
+            elapsed = time.time() - started
+            yield {
+                "rows_done": rows_done,
+                "recoded": recoded,
+                "carried_forward": rows_done - recoded,
+                "errors": errors,
+                "elapsed_seconds": elapsed,
+                "rows_per_second": rows_done / elapsed if elapsed > 0 else 0.0
+            }
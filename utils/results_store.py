@@ -0,0 +1,371 @@
+import json
+import os
+from typing import Dict, IO, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from utils.batch import read_result_records
+from utils.codeframe import Codeframe
+
+DEFAULT_RESULTS_DIR = os.getenv("RESULTS_STORE_DIR", ".cache/results")
+# Rows per Parquet row group; results are buffered and written a group at a time
+ROW_GROUP_SIZE = 65536
+# Columns read for analytics; the text columns stay on disk
+ANALYTICS_COLUMNS = ["row", "question", "code_ids", "confidence", "error"]
+RESULTS_SCHEMA = pa.schema([
+    ("row", pa.int64()),
+    ("question", pa.dictionary(pa.int32(), pa.string())),
+    ("response", pa.string()),
+    ("cleaned_response", pa.string()),
+    # Codes as integer IDs, positions in the codeframe's code list (stored in the metadata)
+    ("code_ids", pa.list_(pa.int32())),
+    # Confidence of each code in code_ids
+    ("confidence", pa.list_(pa.float32())),
+    ("explanation", pa.string()),
+    ("relevant_quotes", pa.string()),
+    ("error", pa.string()),
+    ("codeframe_version", pa.string()),
+    # 'classifier' for codings made by the local classifier
+    ("coded_by", pa.string())
+])
+
+
+class CodedResults:
+    """
+    Coded responses held as NumPy arrays, for vectorized analytics.
+
+    Codes are stored sparsely, CSR-style: the code IDs of response i are
+    code_ids[indptr[i]:indptr[i + 1]], with their confidences in the same
+    positions of `confidence`. The dense response × code matrices are built
+    on demand.
+    """
+
+    def __init__(
+        self,
+        codes: Sequence[str],
+        questions: Sequence[str],
+        rows: np.ndarray,
+        question_ids: np.ndarray,
+        indptr: np.ndarray,
+        code_ids: np.ndarray,
+        confidence: np.ndarray,
+        errors: np.ndarray
+    ):
+        self.codes = tuple(codes)
+        self.questions = list(questions)
+        self.rows = rows
+        self.question_ids = question_ids
+        self.indptr = indptr
+        self.code_ids = code_ids
+        self.confidence = confidence
+        self.errors = errors
+        # Response index of each entry of code_ids
+        self.response_ids = np.repeat(np.arange(len(rows), dtype=np.int64), np.diff(indptr))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def code_matrix(self) -> np.ndarray:
+        """Boolean response × code matrix, True where a code was assigned."""
+        matrix = np.zeros((len(self), len(self.codes)), dtype=bool)
+        matrix[self.response_ids, self.code_ids] = True
+        return matrix
+
+    def confidence_matrix(self) -> np.ndarray:
+        """Float response × code matrix of confidences, 0 where a code was not assigned."""
+        matrix = np.zeros((len(self), len(self.codes)), dtype=np.float32)
+        matrix[self.response_ids, self.code_ids] = self.confidence
+        return matrix
+
+    def code_frequencies(self) -> np.ndarray:
+        """Number of responses given each code, by code ID."""
+        return np.bincount(self.code_ids, minlength=len(self.codes))
+
+    def mean_confidence(self) -> np.ndarray:
+        """Mean confidence of each code where assigned, NaN for unused codes."""
+        totals = np.bincount(self.code_ids, weights=self.confidence, minlength=len(self.codes))
+        counts = self.code_frequencies()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, totals / counts, np.nan)
+
+    def question_breakdown(self) -> np.ndarray:
+        """
+        Code counts per question.
+
+        Returns:
+            Integer matrix of shape (questions, codes)
+        """
+        entry_questions = self.question_ids[self.response_ids].astype(np.int64)
+        counts = np.bincount(
+            entry_questions * len(self.codes) + self.code_ids,
+            minlength=len(self.questions) * len(self.codes)
+        )
+        return counts.reshape(len(self.questions), len(self.codes))
+
+    def responses_per_question(self) -> np.ndarray:
+        """Number of responses to each question."""
+        return np.bincount(self.question_ids, minlength=len(self.questions))
+
+    def co_occurrence(self, code_ids: Optional[Sequence[int]] = None) -> np.ndarray:
+        """
+        Count the responses given each pair of codes.
+
+        Pairs are counted without building the dense code matrix: the codes
+        of a response are contiguous, so entries `gap` positions apart
+        belong to the same response when their response indices match.
+
+        Args:
+            code_ids: Codes to include, e.g. the most frequent ones; all by default
+
+        Returns:
+            Symmetric integer matrix over the included codes, in the order
+            given, with each code's frequency on the diagonal
+        """
+        if code_ids is None:
+            code_ids = range(len(self.codes))
+        selected = np.asarray(code_ids, dtype=np.int64)
+        # Position of each code in the output, -1 for codes left out
+        positions = np.full(len(self.codes), -1, dtype=np.int64)
+        positions[selected] = np.arange(len(selected))
+
+        entries = positions[self.code_ids]
+        responses = self.response_ids
+        keep = entries >= 0
+        if not keep.all():
+            entries = entries[keep]
+            responses = responses[keep]
+        size = len(selected)
+
+        # Each pair is counted once, in the order the codes were assigned;
+        # entries of different responses fall in an overflow bin at size * size
+        counts = np.zeros(size * size + 1, dtype=np.int64)
+        for gap in range(1, int(np.diff(self.indptr).max(initial=0))):
+            same = responses[gap:] == responses[:-gap]
+            keys = np.where(same, entries[:-gap] * size + entries[gap:], size * size)
+            counts += np.bincount(keys, minlength=size * size + 1)
+        counts = counts[:-1].reshape(size, size)
+        counts = counts + counts.T
+        counts[np.diag_indices(size)] = np.bincount(entries, minlength=size)
+        return counts
+
+
+class ResultsStore:
+    """
+    Directory of coded results in Parquet, one file per run.
+
+    Codes are stored as integer IDs into the codeframe's code list, which
+    is saved in each file's metadata, so a file stays readable after the
+    codeframe changes: on loading, IDs are mapped onto the current
+    codeframe and codes it no longer has are dropped.
+    """
+
+    def __init__(self, codeframe: Codeframe, directory: str = DEFAULT_RESULTS_DIR):
+        self.codeframe = codeframe
+        self.directory = directory
+        self._code_ids = {code: position for position, code in enumerate(codeframe.codes)}
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.parquet")
+
+    def names(self) -> List[str]:
+        """Names of the stored runs, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        paths = [
+            os.path.join(self.directory, filename)
+            for filename in os.listdir(self.directory)
+            if filename.endswith(".parquet")
+        ]
+        paths.sort(key=os.path.getmtime)
+        return [os.path.basename(path)[:-len(".parquet")] for path in paths]
+
+    def signature(self, names: Optional[Sequence[str]] = None) -> Tuple:
+        """Names and modification times of stored runs, for cache keys."""
+        names = self.names() if names is None else names
+        return tuple((name, os.path.getmtime(self.path(name))) for name in names)
+
+    def _table(self, records: List[Dict]) -> pa.Table:
+        code_ids = []
+        confidence = []
+        for record in records:
+            ids = []
+            scores = []
+            for code in dict.fromkeys(record.get("codes") or []):
+                if code in self._code_ids:
+                    ids.append(self._code_ids[code])
+                    scores.append(float((record.get("confidence") or {}).get(code, 0.0)))
+            code_ids.append(ids)
+            confidence.append(scores)
+        return pa.table({
+            "row": [record["row"] for record in records],
+            "question": pa.array([record["question"] for record in records]).dictionary_encode(),
+            "response": [record["response"] for record in records],
+            "cleaned_response": [record.get("cleaned_response") for record in records],
+            "code_ids": code_ids,
+            "confidence": confidence,
+            "explanation": [json.dumps(record.get("explanation") or {}) for record in records],
+            "relevant_quotes": [json.dumps(record.get("relevant_quotes") or {}) for record in records],
+            "error": [record.get("error") for record in records],
+            "codeframe_version": [record.get("codeframe_version") for record in records],
+            "coded_by": [record.get("coded_by") for record in records]
+        }, schema=RESULTS_SCHEMA)
+
+    def write(self, name: str, records: Iterable[Dict]) -> str:
+        """
+        Store a run's output records.
+
+        Records are streamed in row groups of ROW_GROUP_SIZE; the file only
+        appears once complete, replacing any earlier run of the same name.
+
+        Args:
+            name: Name of the run, e.g. its job ID
+            records: Output records, as produced by to_output_record
+
+        Returns:
+            Path of the Parquet file
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(name)
+        temp_path = f"{path}.tmp"
+        schema = RESULTS_SCHEMA.with_metadata({
+            "codes": json.dumps(self.codeframe.codes),
+            "codeframe_version": self.codeframe.content_hash
+        })
+        try:
+            with pq.ParquetWriter(temp_path, schema) as writer:
+                buffer: List[Dict] = []
+                for record in records:
+                    buffer.append(record)
+                    if len(buffer) >= ROW_GROUP_SIZE:
+                        writer.write_table(self._table(buffer).replace_schema_metadata(schema.metadata))
+                        buffer = []
+                if buffer:
+                    writer.write_table(self._table(buffer).replace_schema_metadata(schema.metadata))
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return path
+
+    def add_results_file(self, file: IO[str], output_format: str, name: str) -> str:
+        """
+        Store a batch results file.
+
+        Args:
+            file: Text file object of JSONL or CSV results
+            output_format: 'jsonl' or 'csv'
+            name: Name of the run
+
+        Returns:
+            Path of the Parquet file
+        """
+        return self.write(name, read_result_records(file, output_format))
+
+    def remove(self, name: str) -> None:
+        """Delete a stored run."""
+        if os.path.exists(self.path(name)):
+            os.remove(self.path(name))
+
+    def iter_codings(
+        self,
+        names: Optional[Sequence[str]] = None,
+        batch_size: int = ROW_GROUP_SIZE
+    ) -> Iterator[Tuple[List[str], List[str], List[List[str]]]]:
+        """
+        Stream the cleaned text and codes of stored responses, e.g. to train on.
+
+        Rows with errors or coded by the local classifier are skipped, and
+        codes no longer in the codeframe are dropped.
+
+        Args:
+            names: Runs to read; all by default
+            batch_size: Rows read at a time
+
+        Yields:
+            Tuples of cleaned responses, their questions and their codes
+        """
+        names = self.names() if names is None else names
+        for name in names:
+            parquet = pq.ParquetFile(self.path(name))
+            stored_codes = json.loads(parquet.schema_arrow.metadata[b"codes"])
+            # Runs stored before codings were attributed have no coded_by column
+            columns = ["question", "cleaned_response", "code_ids", "error"]
+            if "coded_by" in parquet.schema_arrow.names:
+                columns.append("coded_by")
+            for batch in parquet.iter_batches(batch_size, columns=columns):
+                values = batch.to_pydict()
+                coded_by = values.get("coded_by") or [None] * batch.num_rows
+                kept = [
+                    position for position, (error, coder) in enumerate(zip(values["error"], coded_by))
+                    if error is None and coder != "classifier"
+                ]
+                yield (
+                    [values["cleaned_response"][position] or "" for position in kept],
+                    [values["question"][position] for position in kept],
+                    [
+                        [stored_codes[code_id] for code_id in values["code_ids"][position]
+                         if stored_codes[code_id] in self._code_ids]
+                        for position in kept
+                    ]
+                )
+
+    def load(self, names: Optional[Sequence[str]] = None) -> CodedResults:
+        """
+        Load stored runs for analytics, reading only the columns needed.
+
+        Args:
+            names: Runs to load; all by default
+
+        Returns:
+            CodedResults over the runs' responses, with code IDs of the
+            current codeframe
+        """
+        names = self.names() if names is None else names
+        questions: Dict[str, int] = {}
+        parts = []
+        for name in names:
+            parquet = pq.ParquetFile(self.path(name))
+            stored_codes = json.loads(parquet.schema_arrow.metadata[b"codes"])
+            # Stored code ID -> current code ID, -1 for codes no longer in the codeframe
+            remap = np.array([self._code_ids.get(code, -1) for code in stored_codes], dtype=np.int32)
+            table = parquet.read(columns=ANALYTICS_COLUMNS)
+
+            question_column = table.column("question").combine_chunks()
+            dictionary_ids = np.array(
+                [questions.setdefault(question, len(questions)) for question in question_column.dictionary.to_pylist()],
+                dtype=np.int32
+            )
+            question_ids = dictionary_ids[question_column.indices.to_numpy(zero_copy_only=False)]
+
+            lengths = pc.list_value_length(table.column("code_ids")).to_numpy(zero_copy_only=False)
+            code_ids = remap[pc.list_flatten(table.column("code_ids")).to_numpy(zero_copy_only=False)]
+            confidence = pc.list_flatten(table.column("confidence")).to_numpy(zero_copy_only=False)
+            errors = table.column("error").is_valid().to_numpy(zero_copy_only=False)
+            parts.append((
+                table.column("row").to_numpy(), question_ids, lengths, code_ids, confidence, errors
+            ))
+
+        if not parts:
+            parts.append((
+                np.zeros(0, np.int64), np.zeros(0, np.int32), np.zeros(0, np.int64),
+                np.zeros(0, np.int32), np.zeros(0, np.float32), np.zeros(0, bool)
+            ))
+        rows, question_ids, lengths, code_ids, confidence, errors = (
+            np.concatenate(column) for column in zip(*parts)
+        )
+        # Drop codes that left the codeframe, shortening their responses' code lists
+        dropped = code_ids < 0
+        if dropped.any():
+            entry_responses = np.repeat(np.arange(len(lengths)), lengths)
+            lengths = lengths - np.bincount(entry_responses[dropped], minlength=len(lengths))
+            code_ids = code_ids[~dropped]
+            confidence = confidence[~dropped]
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        return CodedResults(
+            self.codeframe.codes, list(questions), rows, question_ids,
+            indptr, code_ids.astype(np.int64), confidence.astype(np.float32), errors
+        )
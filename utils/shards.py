@@ -0,0 +1,184 @@
+import glob
+import heapq
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from utils.batch import DEFAULT_CHUNK_SIZE, OUTPUT_FORMATS, ResultWriter, read_result_records
+
+# Missing or duplicated row numbers quoted in a failed merge's error
+MAX_REPORTED_ROWS = 10
+
+
+def output_format_for(path: str) -> str:
+    """
+    Infer the results format from a file extension.
+
+    Args:
+        path: Results file path ending in .jsonl or .csv
+
+    Returns:
+        'jsonl' or 'csv'
+
+    Raises:
+        ValueError: If the extension is not a supported output format
+    """
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    if extension not in OUTPUT_FORMATS:
+        raise ValueError(f"Output file must end in .jsonl or .csv: {path}")
+    return extension
+
+
+def shard_output_path(output_path: str, shard_index: int, shard_count: int) -> str:
+    """
+    Path of one shard's results, next to the merged output.
+
+    For example, shard 2 of 8 of outputs/run.jsonl is
+    outputs/run.shard-002-of-008.jsonl.
+
+    Args:
+        output_path: Path of the merged results
+        shard_index: Shard number
+        shard_count: Number of shards
+
+    Returns:
+        Shard results path
+    """
+    stem, extension = os.path.splitext(output_path)
+    return f"{stem}.shard-{shard_index:03d}-of-{shard_count:03d}{extension}"
+
+
+def find_shard_paths(output_path: str) -> List[str]:
+    """
+    Find every shard file written for a merged output.
+
+    Args:
+        output_path: Path of the merged results
+
+    Returns:
+        Shard results paths, ordered by shard number
+
+    Raises:
+        ValueError: If no shards are found, shards of different runs are
+            mixed, or a shard is missing
+    """
+    stem, extension = os.path.splitext(output_path)
+    pattern = re.compile(re.escape(stem) + r"\.shard-(\d+)-of-(\d+)" + re.escape(extension) + "$")
+    shards: Dict[int, str] = {}
+    counts = set()
+    for path in glob.glob(f"{glob.escape(stem)}.shard-*-of-*{glob.escape(extension)}"):
+        match = pattern.match(path)
+        if match:
+            shards[int(match.group(1))] = path
+            counts.add(int(match.group(2)))
+    if not shards:
+        raise ValueError(f"No shard files found for {output_path}")
+    if len(counts) > 1:
+        raise ValueError(f"Shard files of different shard counts found for {output_path}: {sorted(counts)}")
+    shard_count = counts.pop()
+    missing = [index for index in range(shard_count) if index not in shards]
+    if missing:
+        raise ValueError(f"Missing shard files for {output_path}: {missing}")
+    return [shards[index] for index in range(shard_count)]
+
+
+def _shard_records(path: str, shard: int, output_format: str) -> Iterator[Tuple[int, int, Dict]]:
+    """Yield (row, shard, record) from a shard file, checking its rows are in order."""
+    previous = -1
+    with open(path, encoding="utf-8", newline="") as f:
+        for record in read_result_records(f, output_format):
+            if record["row"] < previous:
+                raise ValueError(f"Rows of {path} are out of order at row {record['row']}")
+            previous = record["row"]
+            yield record["row"], shard, record
+
+
+def merge_shards(
+    shard_paths: List[str],
+    output_path: str,
+    expected_rows: Optional[int] = None
+) -> Dict:
+    """
+    Merge shard results into one file in input row order, verifying it.
+
+    Shard files are streamed and merged by row number, so memory use does
+    not grow with their size. The merge fails if any row number is
+    duplicated, or missing from 0 to the last row (or to `expected_rows`,
+    when the input row count is known). The output is only written if it
+    verifies. Duplicate cluster IDs are per shard, so cluster c of shard s
+    becomes c * len(shard_paths) + s, which needs no table of the clusters
+    seen and no extra pass over the shards.
+
+    Args:
+        shard_paths: Shard results files, all in the output's format
+        output_path: Path of the merged results
+        expected_rows: Number of rows in the input, if known
+
+    Returns:
+        Dictionary with 'rows', 'shards', 'errors' and 'output_path'
+
+    Raises:
+        ValueError: If the shards do not cover every row exactly once
+    """
+    output_format = output_format_for(output_path)
+    streams = [
+        _shard_records(path, shard, output_format_for(path))
+        for shard, path in enumerate(shard_paths)
+    ]
+    missing: List[int] = []
+    missing_count = 0
+    duplicated: List[int] = []
+    duplicated_count = 0
+    rows = errors = 0
+    previous = -1
+    buffer: List[Dict] = []
+
+    temp_path = f"{output_path}.tmp"
+    try:
+        with ResultWriter(temp_path, output_format) as writer:
+            for row, shard, record in heapq.merge(*streams, key=lambda item: item[0]):
+                if row == previous:
+                    duplicated_count += 1
+                    if len(duplicated) < MAX_REPORTED_ROWS:
+                        duplicated.append(row)
+                    continue
+                if row > previous + 1:
+                    missing_count += row - previous - 1
+                    missing.extend(range(previous + 1, row)[:MAX_REPORTED_ROWS - len(missing)])
+                previous = row
+
+                if record.get("cluster_id") is not None:
+                    record["cluster_id"] = record["cluster_id"] * len(shard_paths) + shard
+                buffer.append(record)
+                rows += 1
+                errors += 1 if record["error"] else 0
+                if len(buffer) >= DEFAULT_CHUNK_SIZE:
+                    writer.write(buffer)
+                    buffer = []
+            writer.write(buffer)
+
+        if expected_rows is not None:
+            if previous >= expected_rows:
+                raise ValueError(
+                    f"Shards contain row {previous}, but the input has only {expected_rows} rows"
+                )
+            if previous < expected_rows - 1:
+                missing_count += expected_rows - 1 - previous
+                missing.extend(range(previous + 1, expected_rows)[:MAX_REPORTED_ROWS - len(missing)])
+        if missing_count or duplicated_count:
+            raise ValueError(
+                f"Shards do not cover every row exactly once: "
+                f"{missing_count} rows missing (e.g. {missing}), "
+                f"{duplicated_count} rows duplicated (e.g. {duplicated})"
+            )
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return {
+        "rows": rows,
+        "shards": len(shard_paths),
+        "errors": errors,
+        "output_path": output_path
+    }
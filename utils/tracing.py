@@ -0,0 +1,297 @@
+import cProfile
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Tracing is configured from the environment: TRACE_PATH enables the JSONL
+# sink and TRACE_PROFILE_RATE sets the fraction of profiled spans captured
+DEFAULT_PROFILE_DIR = os.getenv("TRACE_PROFILE_DIR", ".cache/profiles")
+# Allocation sites reported for a profiled span
+TOP_ALLOCATIONS = 10
+
+# Innermost open span, the parent of spans started in the same context
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+# Span list of the innermost collect() block
+_collected: contextvars.ContextVar[Optional[List[Dict]]] = contextvars.ContextVar("collected_spans", default=None)
+
+
+class _NoopSpan:
+    """Span returned while tracing is off; every operation does nothing."""
+
+    recording = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """
+    A timed stage of the pipeline, with attributes describing its work.
+
+    Spans nest: a span started while another is open in the same thread or
+    asyncio task becomes its child and shares its trace ID.
+    """
+
+    recording = True
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent: Optional[Span] = None
+        self.trace_id = ""
+        self._token = None
+        self._started = 0.0
+        self._start_time = 0.0
+
+    def set(self, **attributes) -> None:
+        """Add or update attributes, e.g. token counts known only at the end."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self.trace_id = self.parent.trace_id if self.parent is not None else uuid.uuid4().hex
+        self._token = _current_span.set(self)
+        self._start_time = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._started
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # A span around a generator may be closed from another context,
+            # which never saw it as current
+            pass
+        if exc is not None:
+            self.attributes["error"] = str(exc) or exc_type.__name__
+        self.tracer.emit({
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            "name": self.name,
+            "start": self._start_time,
+            "duration_ms": duration * 1000,
+            "thread": threading.current_thread().name,
+            "attributes": self.attributes
+        })
+        return False
+
+
+class Tracer:
+    """
+    Creates spans and passes finished ones to the registered sinks.
+
+    While no sink is registered and no collect() block is active, span()
+    returns a shared no-op object, so instrumented code pays only a function
+    call and a context-variable lookup. A sink is any callable taking a
+    finished span record.
+
+    Args:
+        profile_rate: Fraction of profiled spans that capture a profile
+        profile_dir: Directory of captured .prof files
+    """
+
+    def __init__(self, profile_rate: float = 0.0, profile_dir: str = DEFAULT_PROFILE_DIR):
+        self.sinks: List[Callable[[Dict], None]] = []
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        # cProfile allows one active profiler at a time
+        self._profiling = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sinks) or _collected.get() is not None
+
+    def add_sink(self, sink: Callable[[Dict], None]) -> None:
+        """Register a callable receiving every finished span record."""
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink: Callable[[Dict], None]) -> None:
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+
+    def span(self, name: str, **attributes):
+        """Start a span, or return the no-op span while tracing is off."""
+        if not self.sinks and _collected.get() is None:
+            return NOOP_SPAN
+        return Span(self, name, attributes)
+
+    def emit(self, record: Dict) -> None:
+        collected = _collected.get()
+        if collected is not None:
+            collected.append(record)
+        for sink in self.sinks:
+            try:
+                sink(record)
+            except Exception as e:
+                logging.error(f"Error in trace sink: {str(e)}")
+
+    @contextmanager
+    def profiled(self, name: str, **attributes) -> Iterator:
+        """
+        Start a span that, for a sampled fraction of calls, is also profiled.
+
+        A profiled span records 'profile_path' (a cProfile .prof file, for
+        pstats or snakeviz), 'peak_memory_kb' and the 'top_allocations'
+        grown during the span. The profile covers everything the thread
+        runs meanwhile. Profiles are only captured one at a time;
+        overlapping spans are traced without one.
+        """
+        sampled = (
+            self.profile_rate > 0
+            and random.random() < self.profile_rate
+            and self._profiling.acquire(blocking=False)
+        )
+        with self.span(name, **attributes) as span:
+            if not sampled:
+                yield span
+                return
+            try:
+                profiler = cProfile.Profile()
+                started_tracemalloc = not tracemalloc.is_tracing()
+                if started_tracemalloc:
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+                before = tracemalloc.take_snapshot()
+                profiler.enable()
+                try:
+                    yield span
+                finally:
+                    profiler.disable()
+                    after = tracemalloc.take_snapshot()
+                    _, peak = tracemalloc.get_traced_memory()
+                    if started_tracemalloc:
+                        tracemalloc.stop()
+                    os.makedirs(self.profile_dir, exist_ok=True)
+                    path = os.path.join(self.profile_dir, f"{name}_{uuid.uuid4().hex[:16]}.prof")
+                    profiler.dump_stats(path)
+                    span.set(
+                        profile_path=path,
+                        peak_memory_kb=peak // 1024,
+                        top_allocations=[
+                            f"{stat.traceback[0].filename}:{stat.traceback[0].lineno} +{stat.size_diff // 1024} KiB"
+                            for stat in after.compare_to(before, "lineno")[:TOP_ALLOCATIONS]
+                        ]
+                    )
+            finally:
+                self._profiling.release()
+
+
+class JsonlSink:
+    """
+    Sink appending span records to a JSON Lines trace file.
+
+    Safe to share between threads; processes sharing a file each append
+    whole lines.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __call__(self, record: Dict) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+tracer = Tracer(
+    profile_rate=float(os.getenv("TRACE_PROFILE_RATE", 0) or 0),
+    profile_dir=DEFAULT_PROFILE_DIR
+)
+if os.getenv("TRACE_PATH"):
+    tracer.add_sink(JsonlSink(os.environ["TRACE_PATH"]))
+
+
+def span(name: str, **attributes):
+    """
+    Time a stage of the pipeline.
+
+    Usage:
+        with span("parse", codes=3) as s:
+            ...
+            if s.recording:
+                s.set(valid=2)
+
+    Args:
+        name: Stage name
+        **attributes: Attributes recorded with the span
+
+    Returns:
+        Context manager yielding the span (the no-op span when tracing is off)
+    """
+    if not tracer.sinks and _collected.get() is None:
+        return NOOP_SPAN
+    return Span(tracer, name, attributes)
+
+
+def profiled(name: str, **attributes):
+    """Start a span of the global tracer that is profiled at TRACE_PROFILE_RATE."""
+    return tracer.profiled(name, **attributes)
+
+
+@contextmanager
+def collect() -> Iterator[List[Dict]]:
+    """
+    Trace the enclosed code, collecting its finished span records.
+
+    Tracing is on inside the block even without sinks, for the current
+    thread or task and those it starts.
+
+    Yields:
+        List filled with span records as spans finish
+    """
+    spans: List[Dict] = []
+    token = _collected.set(spans)
+    try:
+        yield spans
+    finally:
+        _collected.reset(token)
+
+
+def summarize_spans(records: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """
+    Total time per stage name.
+
+    Args:
+        records: Span records, e.g. read from a trace file
+
+    Returns:
+        Mapping of span name to 'count', 'total_ms' and 'max_ms', slowest first
+    """
+    summary: Dict[str, Dict[str, float]] = {}
+    for record in records:
+        stage = summary.setdefault(record["name"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stage["count"] += 1
+        stage["total_ms"] += record["duration_ms"]
+        stage["max_ms"] = max(stage["max_ms"], record["duration_ms"])
+    return dict(sorted(summary.items(), key=lambda item: -item[1]["total_ms"]))
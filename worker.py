@@ -0,0 +1,83 @@
+"""
+Background worker pool for queued batch jobs.
+
+Codes the jobs submitted from the Batch Processing tab outside the
+Streamlit process, so they keep running when browser tabs close or the app
+restarts. Settings are read from the environment (or .env) as in the app.
+
+Usage:
+    python worker.py [--workers 2]
+"""
+import argparse
+import logging
+import os
+import threading
+
+from dotenv import load_dotenv
+
+from llm.claude_coder import ClaudeCoder
+from llm.classifier import DEFAULT_CLASSIFIER_PATH, ClassifierRouter, CodeClassifier
+from utils.codeframe import DEFAULT_CODEFRAME_PATH, load_codeframe
+from utils.jobs import DEFAULT_JOBS_DIR, DEFAULT_JOBS_PATH, JobQueue, start_workers
+from utils.results_store import DEFAULT_RESULTS_DIR, ResultsStore
+
+
+def build_coder(route: bool = True):
+    """
+    Build a ClaudeCoder from environment settings, as the app does.
+
+    With CLASSIFIER_THRESHOLD set (and `route`), the coder is wrapped in a
+    ClassifierRouter using the classifier saved at CLASSIFIER_PATH.
+    """
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise ValueError("ANTHROPIC_API_KEY not found. Please set it in your .env file.")
+    shortlist_k = os.getenv("SHORTLIST_K")
+    coder = ClaudeCoder(
+        api_key=api_key,
+        model_name=os.getenv("MODEL_NAME", "claude-3-opus-20240229"),
+        max_tokens=int(os.getenv("MAX_TOKENS", 4000)),
+        temperature=float(os.getenv("TEMPERATURE", 0.7)),
+        shortlist_k=int(shortlist_k) if shortlist_k else None,
+        codeframe=load_codeframe(os.getenv("CODEFRAME_PATH", DEFAULT_CODEFRAME_PATH)),
+        cascade_model=os.getenv("CASCADE_MODEL") or None,
+        escalation_threshold=float(os.getenv("ESCALATION_THRESHOLD", 0.7))
+    )
+    threshold = os.getenv("CLASSIFIER_THRESHOLD")
+    if not route or not threshold:
+        return coder
+    classifier_path = os.getenv("CLASSIFIER_PATH", DEFAULT_CLASSIFIER_PATH)
+    return ClassifierRouter(
+        CodeClassifier.load(classifier_path, coder.codeframe),
+        coder,
+        threshold=float(threshold),
+        audit_rate=float(os.getenv("CLASSIFIER_AUDIT_RATE", 0) or 0),
+        path=classifier_path
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2, help="Jobs coded at the same time")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, force=True)
+    queue = JobQueue(os.getenv("JOBS_PATH", DEFAULT_JOBS_PATH), os.getenv("JOBS_DIR", DEFAULT_JOBS_DIR))
+    stop = threading.Event()
+    coder = build_coder()
+    # Completed jobs are added to the store the app's Analytics tab reads
+    results_store = ResultsStore(coder.codeframe, os.getenv("RESULTS_STORE_DIR", DEFAULT_RESULTS_DIR))
+    threads = start_workers(queue, coder, args.workers, stop, results_store=results_store)
+    logging.info(f"Started {len(threads)} job workers on {queue.path}")
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1.0)
+    except KeyboardInterrupt:
+        # Slices in progress resume from their checkpoints on the next start
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()